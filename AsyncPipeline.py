@@ -0,0 +1,242 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# AsyncPipeline
+#
+#   Replays a trip with asyncio in three stages joined by bounded queues
+#
+#       reader --> rows --> formatter --> messages --> publisher
+#
+# The reader paces rows on a ReplayScheduler, the formatter turns them into payloads
+# and topics, and the publisher keeps up to `window` QoS 1 messages waiting for their
+# PUBACK. A full queue or window holds back the stage before it, so the pipeline is
+# paced by the connection instead of by sleeps. Reconnecting runs in its own task, on
+# an executor thread, while the other stages wait on the queues.
+#
+#   read() and format() block -- file and S3 reads, payload encoding -- so each runs on
+# its own single worker thread and the loop stays free to take acks. One thread per
+# stage keeps rows in order and keeps a stateful encoder on one thread, and the reader
+# waits for read() to return before it touches the scheduler.
+#
+#   read() returns the next (timestamp_ms, row), a number of seconds to pause before
+# replaying again, or None at the end. format(row) returns (payload, topic).
+#
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+import Metrics
+
+logger = logging.getLogger("TelemetryThing.pipeline")
+
+RECONNECT_BACKOFF_MAX = 30      # seconds between failed reconnect attempts
+
+
+class AsyncPipeline():
+    def __init__(self, connection, read, format, replay=None, window=32, queue_depth=256, qos=1, ack_timeout=30.0) -> None:
+        self.connection = connection
+        self.read = read
+        self.format = format
+        self.replay = replay
+        self.window = max(int(window), 1)
+        self.queue_depth = max(int(queue_depth), 1)
+        self.qos = qos
+        self.ack_timeout = ack_timeout
+
+        self.inflight = {}
+        self.stats = {
+            'rows': 0,
+            'formatted': 0,
+            'published': 0,
+            'acked': 0,
+            'queued_offline': 0,
+            'failed_publishes': 0,
+            'reconnects': 0,
+            'unacked': 0,
+            'max_inflight': 0,
+        }
+
+    # the queues and events belong to the loop that runs the pipeline
+    def _setup(self):
+        self.loop = asyncio.get_running_loop()
+        self.rows = asyncio.Queue(self.queue_depth)
+        self.messages = asyncio.Queue(self.queue_depth)
+        self.slots = asyncio.Semaphore(self.window)
+        self.acked = asyncio.Event()
+        self.online = asyncio.Event()
+        self.online.set()
+        self.reconnecting = asyncio.Event()
+        self.inflight = {}
+        self.readExecutor = ThreadPoolExecutor(1, thread_name_prefix="pipeline-read")
+        self.formatExecutor = ThreadPoolExecutor(1, thread_name_prefix="pipeline-format")
+
+        Metrics.gauge('telemetry_pipeline_queue_depth', 'rows or messages waiting between pipeline stages',
+                        self.rows.qsize, {'queue': 'rows'})
+        Metrics.gauge('telemetry_pipeline_queue_depth', 'rows or messages waiting between pipeline stages',
+                        self.messages.qsize, {'queue': 'messages'})
+        Metrics.gauge('telemetry_pipeline_window', 'messages in the publish window', lambda: len(self.inflight))
+
+    async def run(self):
+        self._setup()
+        reconnector = asyncio.create_task(self._reconnector())
+        try:
+            await asyncio.gather(self._reader(), self._formatter(), self._publisher())
+        finally:
+            reconnector.cancel()
+            self.readExecutor.shutdown(wait=False)
+            self.formatExecutor.shutdown(wait=False)
+
+    async def _reader(self):
+        while True:
+            item = await self.loop.run_in_executor(self.readExecutor, self.read)
+            if item is None:
+                break
+            if not isinstance(item, tuple):
+                await asyncio.sleep(item)
+                continue
+
+            timestamp_ms, row = item
+            if self.replay is not None:
+                delay = self.replay.peek(timestamp_ms/1000.0)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self.replay.delay(timestamp_ms/1000.0)
+
+            self.stats['rows'] += 1
+            await self.rows.put(row)
+        await self.rows.put(None)
+
+    async def _formatter(self):
+        while True:
+            row = await self.rows.get()
+            if row is None:
+                break
+            payload, topic = await self.loop.run_in_executor(self.formatExecutor, self.format, row)
+            self.stats['formatted'] += 1
+            logger.debug(f"{self.stats['formatted']} - {topic}:{payload}")
+            await self.messages.put((payload, topic))
+        await self.messages.put(None)
+
+    async def _publisher(self):
+        while True:
+            message = await self.messages.get()
+            if message is None:
+                break
+            await self._takeSlot()
+            while not self._publish(*message):
+                await self._publishBlocked()
+        await self._drain()
+
+    # wait for room in the window, a window that never drains means a dead connection
+    async def _takeSlot(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.slots.acquire(), self.ack_timeout)
+                return
+            except asyncio.TimeoutError as e:
+                logger.warning(f"no PUBACK for {self.ack_timeout} sec with {len(self.inflight)} in flight -- re-connecting")
+                self._requestReconnect()
+                await self.online.wait()
+
+    def _publish(self, payload, topic):
+        if not self.online.is_set():
+            return False
+        try:
+            mid = self.connection.publishTracked(payload, topic, qos=self.qos, ackCallback=self._onAck)
+        except ConnectionError as e:
+            mid = None
+        if mid is None:
+            self.stats['failed_publishes'] += 1
+            return False
+
+        self.stats['published'] += 1
+        if mid == 0 or self.qos == 0:
+            # nothing will acknowledge it, don't hold its slot
+            if mid == 0:
+                self.stats['queued_offline'] += 1
+            self.slots.release()
+        else:
+            self.inflight[mid] = self.loop.time()
+            self.stats['max_inflight'] = max(self.stats['max_inflight'], len(self.inflight))
+        return True
+
+    # a publish failed, wait for an ack to make room or for a reconnect, never a fixed sleep
+    async def _publishBlocked(self):
+        if self.online.is_set() and self.inflight and self.connection.isConnected():
+            self.acked.clear()
+            try:
+                await asyncio.wait_for(self.acked.wait(), self.ack_timeout)
+                return
+            except asyncio.TimeoutError as e:
+                pass
+        self._requestReconnect()
+        await self.online.wait()
+
+    # called on the MQTT client's thread
+    def _onAck(self, mid):
+        self.loop.call_soon_threadsafe(self._acked, mid)
+
+    def _acked(self, mid):
+        if self.inflight.pop(mid, None) is None:
+            return
+        self.stats['acked'] += 1
+        self.slots.release()
+        self.acked.set()
+
+    async def _drain(self):
+        deadline = self.loop.time() + self.ack_timeout
+        while self.inflight and self.loop.time() < deadline:
+            self.acked.clear()
+            try:
+                await asyncio.wait_for(self.acked.wait(), deadline - self.loop.time())
+            except asyncio.TimeoutError as e:
+                break
+
+    def _requestReconnect(self):
+        self.online.clear()
+        self.reconnecting.set()
+
+    def _reconnect(self):
+        try:
+            self.connection.disconnect()
+            self.connection.connect()
+        except Exception as e:
+            logger.warning(f"reconnect failed: {type(e)}")
+        return self.connection.isConnected()
+
+    async def _reconnector(self):
+        backoff = [1, 1]
+        while True:
+            await self.reconnecting.wait()
+            self.stats['reconnects'] += 1
+            if await self.loop.run_in_executor(None, self._reconnect):
+                # acks for messages sent on the old connection will not come
+                self.stats['unacked'] += len(self.inflight)
+                for mid in self.inflight:
+                    self.slots.release()
+                self.inflight = {}
+                self.reconnecting.clear()
+                self.online.set()
+                backoff = [1, 1]
+            else:
+                backoff.append(sum(backoff))
+                await asyncio.sleep(min(backoff.pop(0), RECONNECT_BACKOFF_MAX))
+
+    def getStats(self):
+        stats = dict(self.stats)
+        stats['inflight'] = len(self.inflight)
+        return stats
@@ -0,0 +1,212 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# BatchPublisher
+#
+#   Packs many encoded payloads into one message holding an array of records.
+# A batch is published when it reaches max_records, when the next record would take
+# it past max_bytes (the IoT Core message size limit by default), or max_latency seconds
+# after its first record. The topic is made from the first or last record of the batch.
+# A record too large for any batch is published alone, as an array of one.
+#
+#   Deadlines are kept by one flusher thread for every BatchPublisher in the process.
+#
+
+import heapq
+import logging
+import threading
+import time
+
+import PayloadEncoding
+
+IOT_MAX_MESSAGE_BYTES = 128*1024
+
+logger = logging.getLogger("TelemetryThing.batch")
+
+
+# calls publisher._deadline() at the times asked for, from one long lived thread
+class _Flusher():
+    def __init__(self) -> None:
+        self.cond = threading.Condition()
+        self.deadlines = []
+        self.seq = 0
+        self.thread = None
+
+    def schedule(self, when, publisher):
+        with self.cond:
+            self.seq += 1
+            heapq.heappush(self.deadlines, (when, self.seq, publisher))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="batch-flusher", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.deadlines or self.deadlines[0][0] > time.monotonic():
+                    self.cond.wait(self.deadlines[0][0] - time.monotonic() if self.deadlines else None)
+                when, seq, publisher = heapq.heappop(self.deadlines)
+            # not holding the condition, the publisher's lock is taken by add() before schedule()
+            try:
+                publisher._deadline()
+            except Exception as e:
+                logger.error(f"flushing a batch at its deadline failed: {e}")
+
+_flusher = _Flusher()
+
+
+class BatchPublisher():
+    def __init__(self, connection, max_records=50, max_bytes=IOT_MAX_MESSAGE_BYTES, max_latency=1.0,
+                    topic_from='first', encoding='json', qos=1) -> None:
+        self.connection = connection
+        self.lock = threading.RLock()
+
+        self.records = []
+        self.bytes = 0
+        self.first_time = None
+
+        self.stats = {
+            'batches': 0,
+            'records': 0,
+            'bytes': 0,
+            'failed_flushes': 0,
+            'max_records': 0,
+            'max_bytes': 0,
+            'flush_reasons': { 'count': 0, 'bytes': 0, 'latency': 0, 'explicit': 0, 'oversize': 0 },
+        }
+        self.configure(max_records, max_bytes, max_latency, topic_from, encoding, qos)
+
+    def configure(self, max_records=50, max_bytes=IOT_MAX_MESSAGE_BYTES, max_latency=1.0, topic_from='first', encoding='json', qos=1):
+        with self.lock:
+            self.max_records = max(int(max_records), 1)
+            self.max_bytes = int(max_bytes)
+            self.max_latency = max_latency
+            self.topic_from = topic_from
+            self.qos = qos
+            self.new_encoding = encoding
+            self._useEncoding()
+
+    # records of one batch share an encoding, so it only changes once the batch is out
+    #   False while a batch in the old encoding could not be published
+    def _useEncoding(self):
+        if self.new_encoding == getattr(self, 'encoding', None):
+            return True
+        if not self._flush('explicit'):
+            return False
+        self.encoding = self.new_encoding
+        self.join, self.per_record, self.header = PayloadEncoding.ARRAYS[self.encoding]
+        return True
+
+    def pending(self):
+        return len(self.records)
+
+    # add an encoded payload, topic_args are what topicGenerator needs to name it
+    #   returns False, without adding the record, if a full batch or an oversize record
+    # could not be published
+    def add(self, payload, topicGenerator, topic_args):
+        with self.lock:
+            # a batch in an encoding being replaced, or a full one left over from a
+            # failed publish, goes first
+            if not self._useEncoding():
+                return False
+            if len(self.records) >= self.max_records and not self._flush('count'):
+                return False
+
+            size = len(payload) + self.per_record
+            if self.records and self.bytes + size + self.header > self.max_bytes:
+                if not self._flush('bytes'):
+                    return False
+            if self.header + size > self.max_bytes:
+                # any batch before it was sent just above, so it goes alone
+                logger.warning(f"record of {len(payload)} bytes is larger than a batch, publishing it alone")
+                self.records.append((payload, topicGenerator, topic_args))
+                if not self._flush('oversize'):
+                    self.records = []
+                    return False
+                return True
+
+            self.records.append((payload, topicGenerator, topic_args))
+            self.bytes += size
+            if len(self.records) == 1:
+                self.first_time = time.monotonic()
+                self._scheduleDeadline()
+
+            if len(self.records) >= self.max_records:
+                self._flush('count')
+            return True
+
+    def _scheduleDeadline(self):
+        if self.max_latency is None:
+            return
+        _flusher.schedule(self.first_time + self.max_latency, self)
+
+    # called by the flusher -- a deadline left from a batch already sent does nothing
+    def _deadline(self):
+        with self.lock:
+            if not self.records or self.max_latency is None:
+                return
+            if time.monotonic() - self.first_time < self.max_latency*0.999:
+                # max_latency changed since, wait for the batch's own deadline
+                self._scheduleDeadline()
+                return
+            if not self._flush('latency'):
+                # try again at the next deadline
+                self.first_time = time.monotonic()
+                self._scheduleDeadline()
+
+    def flush(self):
+        with self.lock:
+            return self._flush('explicit')
+
+    def _flush(self, reason):
+        if not self.records:
+            return True
+
+        payload, topicGenerator, topic_args = self.records[0] if self.topic_from == 'first' else self.records[-1]
+        topic = topicGenerator.make_topicname(**topic_args)
+        message = self.join([ r[0] for r in self.records ])
+
+        try:
+            published = self.connection.publishMessageOnTopic(message, topic, qos=self.qos)
+        except ConnectionError as e:
+            published = False
+        if not published:
+            self.stats['failed_flushes'] += 1
+            return False
+
+        count = len(self.records)
+        self.stats['batches'] += 1
+        self.stats['records'] += count
+        self.stats['bytes'] += len(message)
+        self.stats['max_records'] = max(self.stats['max_records'], count)
+        self.stats['max_bytes'] = max(self.stats['max_bytes'], len(message))
+        self.stats['flush_reasons'][reason] += 1
+
+        self.records = []
+        self.bytes = 0
+        self.first_time = None
+        return True
+
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['flush_reasons'] = dict(self.stats['flush_reasons'])
+            batches = stats['batches']
+            stats['mean_records'] = stats['records']/batches if batches else 0.0
+            stats['mean_bytes'] = stats['bytes']/batches if batches else 0.0
+            stats['pending'] = len(self.records)
+            return stats
@@ -0,0 +1,104 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# ColumnTypes
+#
+#   Infers a type for every column from a sample of rows, so payloads can carry
+# numbers and booleans instead of the text read from the file.
+#
+#   kinds
+#       int, float, bool    every non-empty sampled value parses as that type
+#       str                 anything else
+#       empty               no sampled value at all, sent as text if one shows up later
+#
+# An empty value converts to None for every kind, and so does an inf or nan in a float
+# column, which JSON can't carry. A value that doesn't parse as its column's kind is
+# kept as text rather than lost.
+#
+
+import math
+
+SCHEMA_SAMPLE_ROWS = 200
+
+BOOLS = { 'true': True, 'false': False }
+
+
+def _isInt(v):
+    try:
+        int(v)
+        return True
+    except ValueError:
+        return False
+
+def _isFloat(v):
+    try:
+        return math.isfinite(float(v))
+    except ValueError:
+        return False
+
+def _isBool(v):
+    return v.lower() in BOOLS
+
+
+def toInt(v):
+    if v == '' or v is None:
+        return None
+    try:
+        return int(v)
+    except (ValueError, TypeError):
+        return v
+
+def toFloat(v):
+    if v == '' or v is None:
+        return None
+    try:
+        f = float(v)
+    except (ValueError, TypeError):
+        return v
+    return f if math.isfinite(f) else None
+
+def toBool(v):
+    if v == '' or v is None:
+        return None
+    return BOOLS.get(v.lower(), v) if isinstance(v, str) else v
+
+def toStr(v):
+    return None if v == '' else v
+
+CONVERTERS = {
+    'int': toInt,
+    'float': toFloat,
+    'bool': toBool,
+    'str': toStr,
+    'empty': toStr,
+}
+
+
+def inferKind(values):
+    present = [ v for v in values if v != '' and v is not None ]
+    if len(present) == 0:
+        return 'empty'
+    if all(isinstance(v, str) and _isInt(v) for v in present):
+        return 'int'
+    if all(isinstance(v, str) and _isFloat(v) for v in present):
+        return 'float'
+    if all(isinstance(v, str) and _isBool(v) for v in present):
+        return 'bool'
+    return 'str'
+
+# { column: kind } for the sampled rows
+def inferColumnTypes(cols, samples):
+    return { c: inferKind([ s.get(c) for s in samples ]) for c in dict.fromkeys(cols) }
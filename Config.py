@@ -27,6 +27,19 @@ state = {
     'file': 'file:///OBDII_Capture.csv',
     'record_separator': ';',
     'quote_records': True,
+    'trip_cache': True,                             # compile the file to a binary cache beside it for fast replay
+    'mmap_reader': False,                           # map the file and read rows in place -- for very large files, skips trip_cache
+    # read 's3://' files in ranges as they download, instead of downloading the whole file first
+    's3_streaming': False,
+    's3_chunk_bytes': 8*1024*1024,                  # bytes per ranged GET
+    's3_readahead': 2,                              # ranges fetched in the background ahead of the one being read
+    's3_write_through': True,                       # keep the streamed file in local_dir for the next run
+    's3_endpoint_url': None,                        # an S3 compatible server instead of AWS, e.g. 'http://localhost:9000'
+    # trips to play one after the other with at_end 'next', in place of 'file'
+    'playlist': None,                               # e.g. ['s3://bucket/trip1.csv', 's3://bucket/trip2.csv']
+    'playlist_order': 'ordered',                    # or 'shuffle', a new order each time round
+    'playlist_prefetch': 2,                         # trips fetched and parsed in the background ahead of the one playing
+    'local_cache_max_bytes': None,                  # evict the least recently used s3 files from local_dir beyond this size
 
     #
     # Timestamp handling
@@ -43,13 +56,79 @@ state = {
     'measure_column':  'PID',
     'value_column': 'VALUE',
     'ignore_columns': ['UNITS'],
+    # merge consecutive rows with the same time into one message of all their metrics
+    'pivot': False,
+    'pivot_tolerance': 0.0,                         # rows within this many time units of the first are merged
+
+    # send numbers and booleans typed (inferred from the first rows) and leave out empty values
+    #   for SimpleLabelledPayload
+    'infer_types': False,
+    'omit_empty': False,
+
+    # serializer from PayloadEncoding.py -- 'json', 'json_fast', 'msgpack', 'cbor' or 'delta'
+    'payload_encoding': 'json',
+    'delta_keyframe_interval': 50,                  # with 'delta', send a full frame this often
+
+    # pack records into array messages, published at a count, size (IoT Core's 128 KB) or age limit
+    'batch_publish': False,
+    'batch_max_records': 50,
+    'batch_max_bytes': 131072,
+    'batch_max_latency': 1.0,                       # seconds after the first record of a batch
+    'batch_topic_from': 'first',                    # name the batch's topic from its 'first' or 'last' record
 
     # Topic to publish messages, different payload_strategies may need different templates using local vars
     'topic_name': "vt/cvra/{deviceid}/cardata/{timestamp_ms}",
 
+    # replay with the asyncio pipeline -- reader, formatter and publisher joined by bounded queues
+    'async_pipeline': False,
+    'publish_window': 32,                           # QoS 1 messages waiting for PUBACK
+    'pipeline_queue_depth': 256,                    # rows or messages waiting between stages
+    'ack_timeout': 30.0,                            # seconds without a PUBACK before re-connecting
+
     # throttle of messages per second
     'message_publish_rate': 10.0,
 
-    # what to do at the end of the file... 'stop' or 'repeat'
+    # replay speed, 2.0 replays twice as fast as recorded, 'max' as fast as possible
+    'time_warp': 1.0,
+    'max_lag': 5.0,                                 # seconds behind before giving up on catching up
+
+    # what to do at the end of the file... 'stop', 'repeat' or 'next' trip in the playlist
     'at_end': 'stop',
+
+    # changes to the state are reported to the shadow as one diff per this many seconds
+    'shadow_debounce': 1.0,
+
+    # set 'profile' (from the shadow) to { "mode": "cpu" | "memory" | "stages", "duration": 30 } to profile
+    # the device -- written here, and summarised in the reported shadow as 'profile_result'
+    'profile_dir': '/tmp',
+
+    # metrics -- Prometheus text at http://metrics_addr:metrics_port/metrics when a port is set
+    'metrics_port': None,
+    'metrics_addr': '127.0.0.1',
+    'metrics_log_interval': 60,                     # seconds between summary log lines, 0 for none
+
+    # 'aws' for AWS IoT, or 'local' for an in-process broker (LocalTransport.py) -- to try things out without an account
+    'TRANSPORT': 'aws',
+    'LOCAL_PUBACK_LATENCY': 0.005,                  # seconds until the local broker acknowledges a QoS 1 message
+    'LOCAL_PUBACK_JITTER': 0.0,                     # +- seconds, at random
+    'LOCAL_MAX_INFLIGHT': 0,                        # QoS 1 messages a client may have unacknowledged, 0 for no limit
+
+    # Greengrass discovery is cached in GROUP_CA_PATH/discovery/ -- refreshed in the background after this many seconds, 0 to always discover
+    'DISCOVERY_CACHE_TTL': 24*60*60,
+
+    # connect to a core's endpoints in parallel, starting one every CONNECT_RACE_STAGGER seconds -- None to try them in turn
+    'CONNECT_RACE_STAGGER': 0.25,
+    'CONNECT_RACE_TIMEOUT': 10.0,
+
+    # seconds a QoS 1 message may wait for its PUBACK before it is dropped from the in-flight table
+    'INFLIGHT_TIMEOUT': 60,
+
+    # keep messages on disk while offline, in SPOOL_DIR/<thingName> -- None to use the SDK's in-memory queue
+    'SPOOL_DIR': None,
+    'SPOOL_MAX_BYTES': 256*1024*1024,               # oldest messages are dropped past this
+    'SPOOL_SEGMENT_BYTES': 4*1024*1024,
+    'SPOOL_FSYNC_INTERVAL': 1.0,                    # seconds, or SPOOL_FSYNC_RECORDS, between fsyncs
+    'SPOOL_FSYNC_RECORDS': 100,
+    'SPOOL_DRAIN_RATE': 50,                         # messages per second sent from the spool once back online
+    'SPOOL_WINDOW': 20,                             # spooled messages waiting for PUBACK
 }
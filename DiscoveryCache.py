@@ -0,0 +1,119 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# DiscoveryCache
+#
+#   Keeps the result of Greengrass discovery for each thing, so a restart can connect
+# without asking the discovery service again. An entry is a small JSON file
+#
+#       { "time": ..., "groupId": ..., "caFile": ..., "coreThingArn": ...,
+#         "connectivity": [[host, port], ...] }
+#
+# with groupId None when the thing isn't in a Greengrass group and talks to IoT Core.
+# The group CA is written once to {groupId}_CA.crt, and only rewritten if it changes.
+#
+#   An entry older than ttl seconds is still used, but should be refreshed -- it is only
+# thrown away with invalidate(), when connecting with it fails. With a ttl of 0 nothing
+# is cached, save only writes the CA.
+#
+
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger("GreengrassAwareConnection.discovery")
+
+
+class DiscoveryCache():
+    def __init__(self, group_ca_path="./groupCA/", ttl=24*60*60) -> None:
+        self.group_ca_path = group_ca_path
+        self.path = os.path.join(group_ca_path, 'discovery')
+        self.ttl = ttl
+
+    def _entryPath(self, thingName):
+        return os.path.join(self.path, f"{thingName}.json")
+
+    def _writeFile(self, path, text):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    # the group CA at a name fixed by the group, written only if it changed
+    def writeCA(self, groupId, ca):
+        caFile = os.path.join(self.group_ca_path, f"{groupId}_CA.crt")
+        try:
+            with open(caFile) as f:
+                if f.read() == ca:
+                    return caFile
+        except OSError as e:
+            pass
+        self._writeFile(caFile, ca)
+        return caFile
+
+    # the cached entry for thingName, however old, or None
+    def load(self, thingName):
+        try:
+            with open(self._entryPath(thingName)) as f:
+                entry = json.load(f)
+            if entry.get('groupId') is not None and not os.path.exists(entry['caFile']):
+                return None
+            if not entry.get('connectivity'):
+                return None
+            return entry
+        except (OSError, ValueError, KeyError) as e:
+            return None
+
+    def isFresh(self, entry):
+        return time.time() - entry.get('time', 0) < self.ttl
+
+    # cache a discovery result, groupId and ca None for IoT Core
+    def save(self, thingName, groupId, ca, coreThingArn, connectivity):
+        entry = {
+            'time': time.time(),
+            'groupId': groupId,
+            'caFile': self.writeCA(groupId, ca) if groupId is not None else None,
+            'coreThingArn': coreThingArn,
+            'connectivity': [ [host, port] for host, port in connectivity ],
+        }
+        if not self.ttl:
+            # caching is off, only the CA is needed
+            return entry
+        try:
+            self._writeFile(self._entryPath(thingName), json.dumps(entry))
+        except OSError as e:
+            logger.warning(f"could not cache discovery for {thingName}: {e}")
+        return entry
+
+    # move an endpoint to the front of the cached connectivity list
+    def preferEndpoint(self, thingName, host, port):
+        entry = self.load(thingName)
+        if entry is None or [host, port] not in entry['connectivity']:
+            return
+        entry['connectivity'].remove([host, port])
+        entry['connectivity'].insert(0, [host, port])
+        try:
+            self._writeFile(self._entryPath(thingName), json.dumps(entry))
+        except OSError as e:
+            logger.warning(f"could not cache discovery for {thingName}: {e}")
+
+    def invalidate(self, thingName):
+        try:
+            os.remove(self._entryPath(thingName))
+        except OSError as e:
+            pass
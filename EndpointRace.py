@@ -0,0 +1,179 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# EndpointRace
+#
+#   Happy eyeballs for the connectivity list of a Greengrass core. Rather than waiting
+# out a full connect timeout on each unreachable address in turn, TCP and TLS
+# connections are started to every candidate, stagger seconds apart (or as soon as the
+# one before fails), and the first to finish its TLS handshake wins. The rest are
+# closed.
+#
+#   Only the handshake is raced -- the MQTT CONNECT is then made once, on the winner,
+# since two CONNECTs with the same client id would take the session from each other.
+# Names are resolved on worker threads as the race starts, so a slow resolver for one
+# candidate doesn't hold up the others.
+#
+
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import logging
+import selectors
+import socket
+import ssl
+import time
+
+logger = logging.getLogger("GreengrassAwareConnection.race")
+
+ALPN_PORT = 443
+ALPN_PROTOCOL = 'x-amzn-mqtt-ca'
+RESOLVE_POLL = 0.01             # seconds between checks for a name still being resolved
+
+
+# TLS with the device certificate, checking the server against the CA but not its name
+#   None if the files can't be loaded -- the race then only opens TCP connections
+def makeContext(ca, cert, key, alpn=False):
+    try:
+        context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=ca)
+        context.check_hostname = False
+        context.load_cert_chain(cert, key)
+        if alpn:
+            context.set_alpn_protocols([ALPN_PROTOCOL])
+        return context
+    except (OSError, ssl.SSLError, TypeError) as e:
+        return None
+
+# { port: context } for the ports raced, only port 443 offers ALPN
+#   a context is shared by every attempt to its port, so it is never changed after
+def makeContexts(ca, cert, key, ports):
+    return { port: makeContext(ca, cert, key, alpn=(port == ALPN_PORT)) for port in set(ports) }
+
+def _resolve(endpoint):
+    host, port = endpoint
+    return socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0]
+
+
+class Attempt():
+    def __init__(self, endpoint, context) -> None:
+        self.endpoint = endpoint
+        self.context = context
+        self.sock = None
+        self.state = 'connecting'
+
+    # addrinfo is the endpoint already resolved, see _resolve
+    def start(self, addrinfo):
+        host, port = self.endpoint
+        family, kind, proto, name, address = addrinfo
+        self.sock = socket.socket(family, kind, proto)
+        self.sock.setblocking(False)
+        err = self.sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS):
+            raise OSError(err, f"connect to {host}:{port}")
+
+    # move the attempt on once its socket is ready, returns True when done
+    def step(self):
+        if self.state == 'connecting':
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err != 0:
+                raise OSError(err, f"connect to {self.endpoint[0]}:{self.endpoint[1]}")
+            if self.context is None:
+                return True
+            self.sock = self.context.wrap_socket(self.sock, server_hostname=self.endpoint[0], do_handshake_on_connect=False)
+            self.state = 'handshake'
+        try:
+            self.sock.do_handshake()
+            return True
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError) as e:
+            return False
+
+    def events(self):
+        if self.state == 'connecting':
+            return selectors.EVENT_WRITE
+        return selectors.EVENT_READ | selectors.EVENT_WRITE
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError as e:
+                pass
+
+
+# the first (host, port) to complete a TLS handshake, or None if none did within timeout
+#   contexts are { port: ssl context } from makeContexts, None only races TCP
+def raceEndpoints(candidates, contexts=None, stagger=0.25, timeout=10.0):
+    contexts = {} if contexts is None else contexts
+    selector = selectors.DefaultSelector()
+    waiting = list(candidates)
+    attempts = []
+    winner = None
+    deadline = time.monotonic() + timeout
+    next_start = time.monotonic()
+    resolver = ThreadPoolExecutor(max_workers=max(len(waiting), 1), thread_name_prefix="race-resolve")
+    resolved = { endpoint: resolver.submit(_resolve, endpoint) for endpoint in waiting }
+
+    try:
+        while winner is None and (waiting or attempts):
+            now = time.monotonic()
+            if now >= deadline:
+                break
+
+            # start the next candidate on schedule, or at once if nothing is in flight --
+            # the first in order whose name is resolved, one slow to resolve waits its turn
+            ready = next((e for e in waiting if resolved[e].done()), None)
+            if ready is not None and (now >= next_start or not attempts):
+                endpoint = ready
+                waiting.remove(endpoint)
+                attempt = Attempt(endpoint, contexts.get(endpoint[1]))
+                try:
+                    attempt.start(resolved[endpoint].result())
+                    attempts.append(attempt)
+                    selector.register(attempt.sock, attempt.events(), attempt)
+                except OSError as e:
+                    logger.info(f"{attempt.endpoint[0]}:{attempt.endpoint[1]} failed: {e}")
+                    attempt.close()
+                    # a failure lets the next candidate start now
+                    next_start = now
+                    continue
+                next_start = now + stagger
+                continue
+
+            wait = deadline - now
+            if waiting:
+                # poll for the next candidate's name, or sleep until it is due
+                wait = min(wait, max(next_start - now, 0) if ready is not None else RESOLVE_POLL)
+            for key, mask in selector.select(wait):
+                attempt = key.data
+                try:
+                    if attempt.step():
+                        winner = attempt
+                        break
+                    selector.modify(attempt.sock, attempt.events(), attempt)
+                except (OSError, ssl.SSLError) as e:
+                    logger.info(f"{attempt.endpoint[0]}:{attempt.endpoint[1]} failed: {e}")
+                    selector.unregister(attempt.sock)
+                    attempt.close()
+                    attempts.remove(attempt)
+                    # a failure lets the next candidate start now
+                    next_start = time.monotonic()
+    finally:
+        for attempt in attempts:
+            attempt.close()
+        selector.close()
+        # don't wait on a resolver that is still stuck
+        resolver.shutdown(wait=False)
+
+    return winner.endpoint if winner is not None else None
@@ -17,13 +17,20 @@
 # FileReader
 #
 
-import boto3
+import os
 from pathlib import Path
 
 from Config import state
+import LocalCache
+from MappedTrip import MappedTrip
+import Metrics
+import S3Stream
+from TripCache import TripCache
+
+rows_read = Metrics.counter('telemetry_rows_read_total', 'rows read for replay')
 
 class FileReader():
-    def __init__(self, fileURI = None, local_dir = "/tmp", record_separator=",", quote_records=False):
+    def __init__(self, fileURI = None, local_dir = "/tmp", record_separator=",", quote_records=False, use_cache=True, use_mmap=False, stream_s3=False):
         super().__init__()
         self.file = None
 
@@ -31,6 +38,18 @@ class FileReader():
         self.record_separator = record_separator
         self.quote_records = quote_records
 
+        # serve regular files from a compiled TripCache instead of parsing every line
+        self.use_cache = use_cache
+        self.cache = None
+        # or map the file and index its lines, for files too big to cache -- takes precedence
+        self.use_mmap = use_mmap
+        self.mapped = None
+        # read s3 objects as they download, rather than after -- see S3Stream
+        self.stream_s3 = stream_s3
+        # the file fetched from s3 held in the LocalCache while open, not to be evicted
+        self.pinned = None
+        self.row = 0
+
         self._setLocalFile(None)
         self.useFileURI(fileURI)
 
@@ -44,11 +63,18 @@ class FileReader():
 
         if self.isOpen():
             self.close()
+        self.cache = None
+        self.mapped = None
         self.cols = []
         self.fileURI = fileURI
         self.open()
         
 
+    # the same file again from the start, useFileURI does nothing for the file already in use
+    def reopen(self):
+        self.close()
+        self.open()
+
     def getFileURI(self):
         uri = None
         try:
@@ -59,7 +85,7 @@ class FileReader():
             return uri
 
     def isOpen(self):
-        return (self.file is not None)
+        return (self.file is not None) or (self.row is not None and self.getIndexedSource() is not None)
 
     def _getLocalFilePath(self, key):
         return "/".join([self.local_dir, key])
@@ -68,16 +94,19 @@ class FileReader():
         self.localFile = filename
 
     def _fetchFromS3(self, bucket, key):
-        s3 = boto3.client('s3')
-
         localFile = self._getLocalFilePath(key)
-        result = s3.download_file(bucket, key, localFile)
+        os.makedirs(os.path.dirname(localFile) or ".", exist_ok=True)
+        S3Stream.getClient().download_file(bucket, key, localFile)
 
         self.localFile = localFile        
 
+    # read the object as it arrives, written through to where _fetchFromS3 would put it
+    def _streamFromS3(self, bucket, key):
+        self.file = S3Stream.openText(bucket, key, self._getLocalFilePath(key))
+
     def _fetchFileFromURI(self):
         try:
-            handlers = { 's3:': self._fetchFromS3 }
+            handlers = { 's3:': self._streamFromS3 if self.stream_s3 else self._fetchFromS3 }
             src = self.fileURI.split("/")
 
             protocol = src[0]
@@ -89,29 +118,96 @@ class FileReader():
             localFile = self._getLocalFilePath(key)
             if Path(localFile).exists():
                 self._setLocalFile(localFile)
-            else:
+            elif protocol in handlers:
                 handlers[protocol](bucket, key)
+            else:
+                print(f'{self.fileURI} not found in {self.local_dir}')
+                return
+            if protocol in handlers:
+                self._useLocalCache(localFile)
         except Exception as err:
-            pass
+            print(f'error fetching {self.fileURI}: {err}')
         
+    # pin the file while open, and let the cache evict older ones beyond its limit
+    def _useLocalCache(self, localFile):
+        cache = LocalCache.getCache(self.local_dir)
+        cache.pin(localFile)
+        self.pinned = localFile
+        cache.use(localFile)
+
+    def _unpin(self):
+        if self.pinned is not None:
+            LocalCache.getCache(self.local_dir).unpin(self.pinned)
+            self.pinned = None
+
     def open(self):
         try:
             if self.localFile == None:
                 self._fetchFileFromURI()
 
+            if self.file is not None:
+                # streaming from s3, there's no local file (yet)
+                self._readHeader()
+                return
+            if self.localFile is None:
+                # _fetchFileFromURI said why
+                return
+
+            if self.use_mmap and MappedTrip.isMappable(self.localFile):
+                self._openMapped()
+                return
+
+            if self.use_cache and TripCache.isCacheable(self.localFile):
+                self._openCache()
+                return
+
             self.file = open(self.localFile, 'r')
-            header = self.file.readline().rstrip()
-            self.cols = header.split(self.record_separator)
-            if self.quote_records:
-                self.cols = [ c.strip('"') for c in self.cols ]
+            self._readHeader()
         except Exception as err:
-            print(f'error opening {self.localFile}: {err}')
+            print(f'error opening {self.localFile or self.fileURI}: {err}')
+
+    def _readHeader(self):
+        header = self.file.readline().rstrip()
+        self.cols = header.split(self.record_separator)
+        if self.quote_records:
+            self.cols = [ c.strip('"') for c in self.cols ]
+
+    def _openCache(self):
+        # a repeat re-opens the same file, keep the cache already in memory if still current
+        if self.cache is None or not self.cache.isValidFor(self.localFile):
+            self.cache = TripCache.getCache(self.localFile, self.record_separator, self.quote_records)
+        self.cols = self.cache.cols
+        self.row = 0
+
+    def _openMapped(self):
+        self.mapped = MappedTrip.get(self.localFile, self.record_separator, self.quote_records)
+        self.cols = self.mapped.cols
+        self.row = 0
+
+    def getCache(self):
+        return self.cache
+
+    # the random access source of samples, a TripCache or MappedTrip -- None when streaming lines
+    def getIndexedSource(self):
+        return self.cache if self.cache is not None else self.mapped
+
+    # row number of the sample last returned by getSample -- None when streaming lines
+    def getSampleIndex(self):
+        if self.getIndexedSource() is None or not self.row:
+            return None
+        return self.row - 1
 
     def close(self):
         if self.isOpen():
-            self.file.close()
-            self.file = None
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self.row = None
             self.localFile = None
+        if self.mapped is not None:
+            self.mapped.release()
+            self.mapped = None
+        self._unpin()
 
     def _makeSample(self, lineCSV):
         sample = {}
@@ -123,10 +219,22 @@ class FileReader():
 
         return sample
 
+    def _nextSample(self):
+        source = self.getIndexedSource()
+        if source is not None:
+            sample = source.getSample(self.row)
+            self.row += 1
+            rows_read.inc()
+            return sample
+
+        sample = self._makeSample(self.file.readline().rstrip())
+        rows_read.inc()
+        return sample
+
     def getSample(self):
         readbuffer = {}
         try:
-            readbuffer = self._makeSample(self.file.readline().rstrip())
+            readbuffer = self._nextSample()
         except IndexError as ie:
             print("End of File Reached...")
             self.close()
@@ -136,3 +244,48 @@ class FileReader():
             print("Exception while reading from file")
 
         return readbuffer
+
+    # the first rows of the file, without moving the read position
+    #   a pipe or an s3 stream can only be read once, so it gives no rows
+    def sampleRows(self, count):
+        samples = []
+        source = self.getIndexedSource()
+        try:
+            if source is not None:
+                for r in range(min(count, len(source))):
+                    samples.append(source.getSample(r))
+            elif self.localFile is not None and TripCache.isCacheable(self.localFile):
+                with open(self.localFile, 'r') as f:
+                    f.readline()
+                    for lineCSV in f:
+                        if len(samples) >= count:
+                            break
+                        samples.append(self._makeSample(lineCSV.rstrip()))
+        except IndexError as ie:
+            pass
+        except Exception as e:
+            print(f"Exception while sampling {self.localFile}")
+
+        return samples
+
+    # read every remaining row of the file in one pass and close it
+    #   used to share one parsed copy of a trip between many readers
+    def getAllSamples(self):
+        samples = []
+        try:
+            source = self.getIndexedSource()
+            if source is not None:
+                for r in range(self.row, len(source)):
+                    samples.append(source.getSample(r))
+                self.close()
+                return samples
+
+            for lineCSV in self.file:
+                samples.append(self._makeSample(lineCSV.rstrip()))
+        except IndexError as ie:
+            pass
+        except Exception as e:
+            print("Exception while reading from file")
+        self.close()
+
+        return samples
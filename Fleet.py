@@ -0,0 +1,467 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Fleet
+#
+#   Drives many simulated vehicles from one process.
+# Each Vehicle replays a trip over its own connection, every Vehicle is stepped
+# from a single event scheduler, and vehicles replaying the same trip share
+# one parsed copy of it.
+#
+
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import logging
+import os
+import sched
+import threading
+import time
+
+from dict_recursive_update import recursive_update
+
+from BatchPublisher import BatchPublisher, IOT_MAX_MESSAGE_BYTES
+import ColumnTypes
+from FileReader import FileReader
+import LocalCache
+import MessagePayload
+import Metrics
+from Observer import Observer
+import PayloadEncoding
+from Playlist import Playlist
+from ReplayScheduler import ReplayScheduler
+from RuntimeConfig import RuntimeConfig
+from ShadowReporter import ShadowReporter
+
+DEFAULT_SAMPLE_DURATION_MS = 1000
+REPEAT_DELAY = 30           # seconds to wait before replaying a trip again
+
+logger = logging.getLogger("TelemetryThing.fleet")
+
+rows_read = Metrics.counter('telemetry_rows_read_total', 'rows read for replay')
+
+
+# SharedTrip holds the parsed rows of one trip file
+#   the file is read once, no matter how many vehicles replay it
+#   a playlist's next trips are read ahead by prefetch, on a background thread
+#   vehicles hold the trips they play or will play next, one no vehicle holds is dropped
+class SharedTrip():
+    _trips = {}
+    _loading = {}
+    _holds = {}
+    _lock = threading.Lock()
+    _executor = None
+
+    @staticmethod
+    def _key(fileURI, local_dir=".", record_separator=",", quote_records=False, use_cache=True, use_mmap=False, stream_s3=False):
+        return (fileURI, local_dir, record_separator, quote_records, use_cache, use_mmap)
+
+    @classmethod
+    def hold(cls, fileURI, **settings):
+        key = cls._key(fileURI, **settings)
+        with cls._lock:
+            cls._holds[key] = cls._holds.get(key, 0) + 1
+        return key
+
+    @classmethod
+    def release(cls, key):
+        with cls._lock:
+            count = cls._holds.get(key, 0) - 1
+            if count > 0:
+                cls._holds[key] = count
+                return
+            cls._holds.pop(key, None)
+            cls._trips.pop(key, None)
+
+    # the local copy of a trip was evicted from the LocalCache, read it again when next wanted
+    @classmethod
+    def forget(cls, path):
+        with cls._lock:
+            for key in [ k for k, t in cls._trips.items() if t.cachedFile is not None and os.path.abspath(t.cachedFile) == path ]:
+                del cls._trips[key]
+
+    @classmethod
+    def get(cls, fileURI, local_dir=".", record_separator=",", quote_records=False, use_cache=True, use_mmap=False, stream_s3=False):
+        key = cls._key(fileURI, local_dir, record_separator, quote_records, use_cache, use_mmap)
+        with cls._lock:
+            trip = cls._trips.get(key)
+            future = cls._loading.get(key)
+        if trip is None and future is not None:
+            # still prefetching, wait for it rather than read the file twice
+            trip = future.result()
+        if trip is None:
+            trip = cls(fileURI, local_dir, record_separator, quote_records, use_cache, use_mmap, stream_s3)
+            with cls._lock:
+                cls._trips[key] = trip
+        return trip
+
+    # read the trip in the background, for a later get to find
+    @classmethod
+    def prefetch(cls, fileURI, local_dir=".", record_separator=",", quote_records=False, use_cache=True, use_mmap=False, stream_s3=False):
+        key = cls._key(fileURI, local_dir, record_separator, quote_records, use_cache, use_mmap)
+        with cls._lock:
+            if key in cls._trips or key in cls._loading:
+                return
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+            cls._loading[key] = cls._executor.submit(cls._prefetch, key, stream_s3)
+
+    @classmethod
+    def _prefetch(cls, key, stream_s3):
+        trip = None
+        try:
+            trip = cls(*key, stream_s3)
+        except Exception as e:
+            logger.warning(f"prefetching {key[0]} failed: {type(e)} {e}")
+        with cls._lock:
+            # unless released while loading
+            if trip is not None and key in cls._holds:
+                cls._trips[key] = trip
+            del cls._loading[key]
+        return trip
+
+    def __init__(self, fileURI, local_dir=".", record_separator=",", quote_records=False, use_cache=True, use_mmap=False, stream_s3=False):
+        reader = FileReader(fileURI, local_dir=local_dir, record_separator=record_separator, quote_records=quote_records,
+                            use_cache=use_cache, use_mmap=use_mmap, stream_s3=stream_s3)
+        self.fileURI = fileURI
+        self.cols = reader.cols
+        # the copy fetched into the LocalCache, if any
+        self.cachedFile = reader.pinned
+
+        # a TripCache or MappedTrip is already one shared copy, otherwise keep the parsed rows
+        self.source = reader.getIndexedSource()
+        # a MappedTrip stays shared while a reader holds it, keep this one open
+        self.reader = reader if reader.mapped is not None else None
+        self.samples = None if self.source is not None else reader.getAllSamples()
+        self.timestamps = {}
+        self.column_types = None
+
+    def __len__(self):
+        return len(self.source) if self.source is not None else len(self.samples)
+
+    # the time column converted by a TimestampReader, computed once per column and reader
+    #   None if the column is missing or holds a value that can't be converted
+    def getTimestamps(self, time_col_name, reader):
+        key = (time_col_name, reader)
+        if key not in self.timestamps:
+            if self.source is not None:
+                column = self.source.getColumn(time_col_name)
+            else:
+                column = [ s.get(time_col_name) for s in self.samples ] if self.samples and time_col_name in self.samples[0] else None
+            self.timestamps[key] = reader.getColumnTimestampsMS(column) if column is not None else None
+        return self.timestamps[key]
+
+    # types inferred from the first rows, once for every vehicle on this trip
+    def getColumnTypes(self):
+        if self.column_types is None:
+            samples = []
+            for r in range(min(ColumnTypes.SCHEMA_SAMPLE_ROWS, len(self))):
+                try:
+                    samples.append(self.getSample(r))
+                except IndexError as ie:
+                    break
+            self.column_types = ColumnTypes.inferColumnTypes(self.cols, samples)
+        return self.column_types
+
+    def getSample(self, index):
+        if self.source is not None:
+            return self.source.getSample(index)
+        # payload strategies modify the dict they are given, so hand out a copy
+        return dict(self.samples[index])
+
+
+LocalCache.onEvict(SharedTrip.forget)
+
+
+# Vehicle is one simulated device
+#   the equivalent of telemetryThing's do_something, but with its own state, connection
+# and position in a (shared) trip. #step never sleeps, it returns how long the scheduler
+# should wait before stepping again, or None when the vehicle is done.
+class Vehicle(Observer):
+    def __init__(self, thingName, connection, state, deltas=None):
+        self.thingName = thingName
+        self.connection = connection
+        self.state = state
+        # the config snapshot, swapped whole by a delta and applied at the next step
+        self.config = RuntimeConfig(state, thingName)
+        self.applied = None
+        self.lock = threading.Lock()
+
+        self.trip = None
+        self.index = 0
+        self.playlist = None
+        # SharedTrip keys of the trip playing and the next ones
+        self.holding = []
+        self.timestamps = None
+        self.payloadEncoder = None
+        self.payloadEncoding = None
+        self.batcher = None
+        self.replay = ReplayScheduler()
+        self.shadowReporter = ShadowReporter(connection, state.get('shadow_debounce', 1.0))
+        self.message_count = 0
+        self.backoff = [0, 1]
+        # set to a LatencyHistogram to record the seconds from each row being due to its PUBACK
+        self.enqueue_latency = None
+
+        if deltas is not None:
+            deltas.addObserver(self)
+
+    # shadow deltas for this vehicle, called on its connection's thread
+    #   a delta that doesn't make a valid config is ignored
+    def update(self, updateList):
+        with self.lock:
+            # a delta only holds the nested keys that changed, merge it into a copy
+            candidate = copy.deepcopy(self.state)
+            [ recursive_update(candidate, u) for u in updateList ]
+            try:
+                config = RuntimeConfig(candidate, self.thingName)
+            except Exception as e:
+                logger.error(f"{self.thingName} - ignoring shadow delta {updateList}: {e}")
+                return
+            self.state.update(candidate)
+            self.config = config
+
+    def _useConfig(self, cfg):
+        if cfg.get('pivot', False):
+            logger.warning(f"{self.thingName} - pivot is not supported by the fleet, publishing one message per row")
+        self._useTrip(cfg)
+        self.shadowReporter.report(dict(cfg.state))
+        self.applied = cfg
+
+    def _tripSettings(self, cfg):
+        return { 'local_dir': cfg.get('local_dir', "."),
+                    'record_separator': cfg.get('record_separator', ','),
+                    'quote_records': cfg.get('quote_records', False),
+                    'use_cache': cfg.get('trip_cache', True),
+                    'use_mmap': cfg.get('mmap_reader', False),
+                    'stream_s3': cfg.get('s3_streaming', False) }
+
+    # the trip to play, from the playlist when there is one -- a delta changing
+    # anything else carries on from the trip playing
+    def _usePlaylist(self, cfg):
+        if cfg.playlist is None:
+            self.playlist = None
+            return cfg.file
+        if self.playlist is None or not self.playlist.isSame(cfg.playlist, cfg.playlist_order):
+            self.playlist = Playlist(cfg.playlist, cfg.playlist_order)
+        return self.playlist.current
+
+    def _useTrip(self, cfg):
+        fileURI = self._usePlaylist(cfg)
+        settings = self._tripSettings(cfg)
+        upcoming = self.playlist.upcoming(cfg.playlist_prefetch) if self.playlist is not None else []
+        # hold the new trips before letting go of the old, the ones in both stay
+        holding = [ SharedTrip.hold(uri, **settings) for uri in [ fileURI ] + upcoming ]
+        trip = SharedTrip.get(fileURI, **settings)
+        for uri in upcoming:
+            SharedTrip.prefetch(uri, **settings)
+        for key in self.holding:
+            SharedTrip.release(key)
+        self.holding = holding
+        if trip is not self.trip:
+            self.trip = trip
+            self.index = 0
+
+        self.timestampReader = cfg.timestampReader
+        self.time_col_name = cfg.time_col_name
+        self.timestamps = self.trip.getTimestamps(self.time_col_name, self.timestampReader)
+        self._usePayloadFormatter(cfg)
+        self._useBatching(cfg)
+        self.replay.configure(cfg.time_warp, cfg.rate, cfg.max_lag)
+
+    # compiled formatters are shared by every vehicle with the same header and config
+    #   a stateful encoder (delta) is per vehicle, applied outside the shared formatter
+    def _usePayloadFormatter(self, cfg):
+        # rebuilt when the encoding or its keyframe interval changes
+        encoding = (cfg.payload_encoding, cfg.get('delta_keyframe_interval', PayloadEncoding.DEFAULT_KEYFRAME_INTERVAL))
+        if self.payloadEncoder is None or encoding != self.payloadEncoding:
+            self.payloadEncoder = PayloadEncoding.makeFormatter(encoding[0], keyframe_interval=encoding[1])
+            self.payloadEncoding = encoding
+
+        config = dict(cfg.payload_config)
+        if cfg.infer_types:
+            config['column_types'] = self.trip.getColumnTypes()
+        self.payloadFormatter = MessagePayload.compilePayload(cfg.payload_strategy, self.trip.cols, config, self.payloadEncoder)
+
+    def makePayload(self, telemetry):
+        return self.payloadFormatter(telemetry)
+
+    def _useBatching(self, cfg):
+        if not cfg.batch_publish:
+            if self.batcher is not None:
+                self.batcher.flush()
+                self.batcher = None
+            return
+
+        if self.batcher is None:
+            self.batcher = BatchPublisher(self.connection)
+        self.batcher.configure(max_records=cfg.get('batch_max_records', 50),
+                                max_bytes=cfg.get('batch_max_bytes', IOT_MAX_MESSAGE_BYTES),
+                                max_latency=cfg.get('batch_max_latency', 1.0),
+                                topic_from=cfg.get('batch_topic_from', 'first'),
+                                encoding=cfg.payload_encoding)
+
+    def _publish(self, payload, cfg, timestamp_ms):
+        if self.batcher is not None:
+            return self.batcher.add(payload, cfg.topicGenerator, cfg.getTopicArgs(timestamp_ms))
+        if self.enqueue_latency is None:
+            return self.connection.publishMessageOnTopic(payload, cfg.makeTopic(timestamp_ms), qos=1)
+
+        due = time.monotonic() + self.replay.peek(timestamp_ms/1000.0)
+        histogram = self.enqueue_latency
+        def onAck(mid):
+            histogram.record(time.monotonic() - due)
+        return self.connection.publishTracked(payload, cfg.makeTopic(timestamp_ms), qos=1, ackCallback=onAck) is not None
+
+    def getTimestampMS(self, index):
+        if self.timestamps is not None and index < len(self.timestamps):
+            return self.timestamps[index]
+        telemetry = self.trip.getSample(index)
+        return self.timestampReader.getTimestampMS(telemetry.get(self.time_col_name, DEFAULT_SAMPLE_DURATION_MS))
+
+    # seconds until the next row is due on the replay timeline
+    def _nextDelay(self):
+        # the trip is already parsed, so look ahead to the next row's timestamp
+        try:
+            next_ms = self.getTimestampMS(self.index)
+        except IndexError as ie:
+            return 0
+        return max(self.replay.peek(next_ms/1000.0), 0)
+
+    def _publishBlocked(self):
+        # fibonacci backoff, but handed back to the scheduler instead of sleeping
+        self.backoff.append(sum(self.backoff))
+        timeout = self.backoff.pop(0)
+        if timeout > 300:
+            logger.warning(f"{self.thingName} - timeout escalated to 30 sec -- re-connecting")
+            try:
+                self.connection.disconnect()
+                self.connection.connect()
+            except Exception as e:
+                pass
+            self.backoff = [0, 1]
+        return timeout/10.0
+
+    def step(self):
+        cfg = self.config
+        if cfg is not self.applied:
+            self._useConfig(cfg)
+
+        try:
+            telemetry = self.trip.getSample(self.index)
+            rows_read.inc()
+        except IndexError as ie:
+            if cfg.at_end == 'repeat':
+                self.index = 0
+                self.replay.reset()
+                return REPEAT_DELAY
+            if cfg.at_end == 'next':
+                self.playlist.advance()
+                self._useTrip(cfg)
+                # the same trip again when it's next
+                self.index = 0
+                self.replay.reset()
+                return 0
+            logger.info(f"{self.thingName} - end of file reached")
+            if self.batcher is not None:
+                self.batcher.flush()
+            return None
+
+        timestamp_ms = self.getTimestampMS(self.index)
+        payload = self.makePayload(telemetry)
+
+        try:
+            published = self._publish(payload, cfg, timestamp_ms)
+        except ConnectionError as e:
+            published = False
+        if not published:
+            return self._publishBlocked()
+
+        self.backoff = [0, 1]
+        self.replay.delay(timestamp_ms/1000.0)
+        self.index += 1
+        self.message_count += 1
+        logger.debug(f"{self.thingName} {self.message_count} - {payload}")
+
+        return self._nextDelay()
+
+
+# expand a fleet file's vehicles into one entry per vehicle
+#   an entry with a 'count' is repeated, formatting {n} into its thingName, cert and key
+# and spacing the start of each copy by 'time_offset_step' seconds
+def expandVehicles(fleetDef):
+    vehicles = []
+    for v in fleetDef.get('vehicles', []):
+        count = v.get('count')
+        if count is None:
+            vehicles.append(v)
+            continue
+
+        for n in range(count):
+            e = dict(v)
+            for k in ['thingName', 'cert', 'key']:
+                if e.get(k) is not None:
+                    e[k] = e[k].format(n=n)
+            e['time_offset'] = v.get('time_offset', 0.0) + n*v.get('time_offset_step', 0.0)
+            vehicles.append(e)
+    return vehicles
+
+# a vehicle's state -- the defaults, overridden by the fleet's state, then the vehicle's own
+def makeVehicleState(defaults, fleetDef, v):
+    vstate = copy.deepcopy(defaults)
+    vstate.update(fleetDef.get('state', {}))
+    vstate.update(v.get('state', {}))
+    if v.get('file') is not None:
+        vstate['file'] = v['file']
+    vstate.setdefault('deviceid', v['thingName'])
+    return vstate
+
+
+# Fleet steps all of its vehicles from one scheduler
+#
+class Fleet():
+    def __init__(self):
+        self.scheduler = sched.scheduler(time.monotonic, time.sleep)
+        self.vehicles = []
+        self.stopped = False
+
+        Metrics.gauge('telemetry_scheduler_lag_seconds', 'how late the last row was sent, worst vehicle',
+                        lambda: max([ v.replay.stats['lag_last'] for v in self.vehicles ], default=None))
+        Metrics.gauge('telemetry_batch_pending', 'records waiting in batches',
+                        lambda: sum([ v.batcher.pending() for v in self.vehicles if v.batcher is not None ]))
+
+    def addVehicle(self, vehicle, time_offset=0.0):
+        self.vehicles.append(vehicle)
+        self.scheduler.enter(time_offset, 1, self._step, (vehicle,))
+
+    def _step(self, vehicle):
+        try:
+            delay = vehicle.step()
+        except Exception as e:
+            logger.error(f"{vehicle.thingName} - {str(type(e))} Error: {e}")
+            delay = REPEAT_DELAY
+
+        if delay is not None and not self.stopped:
+            self.scheduler.enter(delay, 1, self._step, (vehicle,))
+
+    def messageCount(self):
+        return sum([ v.message_count for v in self.vehicles ])
+
+    def run(self):
+        self.scheduler.run()
+
+    # vehicles aren't stepped again, run returns once the steps already due are done
+    def stop(self):
+        self.stopped = True
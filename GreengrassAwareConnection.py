@@ -25,34 +25,65 @@
 import json
 import logging
 import os
+import threading
 import time
-import uuid
-
-from AWSIoTPythonSDK.core.greengrass.discovery.providers import DiscoveryInfoProvider
-from AWSIoTPythonSDK.core.protocol.connection.cores import ProgressiveBackOffCore
-from AWSIoTPythonSDK.exception.AWSIoTExceptions import DiscoveryFailure, DiscoveryInvalidRequestException, publishQueueFullException
-from AWSIoTPythonSDK.core.protocol.paho.client import MQTT_ERR_SUCCESS
-from AWSIoTPythonSDK.exception.AWSIoTExceptions import publishError
-
-from AWSIoTPythonSDK.MQTTLib import *
+import weakref
+
+from DiscoveryCache import DiscoveryCache
+from EndpointRace import makeContexts, raceEndpoints
+from LatencyHistogram import LatencyHistogram
+import Metrics
+from OfflineSpool import OfflineSpool
+from Transport import DiscoveryFailure, DiscoveryInvalidRequestException, publishQueueFullException, publishError
+from Transport import MQTT_ERR_SUCCESS, DROP_OLDEST, makeTransport
+
+# process wide metrics, shared by every connection
+published_count = Metrics.counter('telemetry_messages_published_total', 'messages handed to the MQTT client')
+published_bytes = Metrics.counter('telemetry_bytes_published_total', 'message bytes handed to the MQTT client')
+reconnect_count = Metrics.counter('telemetry_reconnects_total', 'connections made after the first')
+ack_latency = Metrics.histogram('telemetry_ack_latency_seconds', 'seconds from publish to PUBACK')
+connections = weakref.WeakSet()
+Metrics.gauge('telemetry_inflight', 'messages waiting for PUBACK', lambda: sum([ c.getInflightCount() for c in list(connections) ]))
+spooled_count = Metrics.counter('telemetry_spooled_total', 'messages written to the offline spool')
+Metrics.gauge('telemetry_spool_pending', 'spooled messages waiting to be sent',
+                lambda: sum([ c.spool.pending() for c in list(connections) if c.spool is not None ]))
+
+def countPublishFailure(e):
+    Metrics.counter('telemetry_publish_failures_total', 'publishes that failed, by exception', {'type': type(e).__name__}).inc()
 
 
 class Obj(object):
     pass
 
 class GreengrassAwareConnection:
-    def __init__(self, host, rootCA, cert, key, thingName, stateChangeQueue = None, config={}):
+    def __init__(self, host, rootCA, cert, key, thingName, stateChangeQueue = None, config={}, transport=None):
         self.logger = logging.getLogger("GreengrassAwareConnection")
         self.logger.setLevel(logging.DEBUG)
-        streamHandler = logging.StreamHandler()
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        streamHandler.setFormatter(formatter)
-        self.logger.addHandler(streamHandler)
+        # many connections may share one process (fleet mode), only attach the handler once
+        if not self.logger.handlers:
+            streamHandler = logging.StreamHandler()
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+            streamHandler.setFormatter(formatter)
+            self.logger.addHandler(streamHandler)
         
         self.config = config
         self.max_discovery_retries = self.config.get('MAX_DISCOVERY_RETRIES', 3)
         self.group_ca_path = self.config.get('GROUP_CA_PATH', "./groupCA/")
         self.offline_queue_depth = self.config.get('OFFLINE_QUEUE_DEPTH', 100)
+        # the telemetry client's queue -- the shadow client keeps offline_queue_depth
+        self.publish_queue_depth = self.offline_queue_depth
+        self.inflight_timeout = self.config.get('INFLIGHT_TIMEOUT', 60)
+
+        # QoS 1 messages waiting for PUBACK, mid -> (send time, topic, size)
+        #   acks come on the client's thread
+        self.inflight = {}
+        self.early_acks = {}
+        self.inflight_lock = threading.Lock()
+        self.last_sweep = time.monotonic()
+        self.ack_latency = LatencyHistogram()
+        self.inflight_stats = { 'published': 0, 'acked': 0, 'expired': 0, 'unknown_acks': 0, 'max_inflight': 0 }
+        self.connect_count = 0
+        connections.add(self)
 
         self.host = host
         self.rootCA = rootCA
@@ -60,10 +91,34 @@ class GreengrassAwareConnection:
         self.key = key
         self.thingName = thingName
 
+        # messages that can't be published now go to disk, and are sent in order once online
+        #   the telemetry client's own offline queue is turned off, the spool takes its place
+        self.online = False
+        self.spool = None
+        if self.config.get('SPOOL_DIR') is not None:
+            self.spool = OfflineSpool(os.path.join(self.config['SPOOL_DIR'], thingName),
+                                        max_bytes=self.config.get('SPOOL_MAX_BYTES', 256*1024*1024),
+                                        segment_bytes=self.config.get('SPOOL_SEGMENT_BYTES', 4*1024*1024),
+                                        fsync_interval=self.config.get('SPOOL_FSYNC_INTERVAL', 1.0),
+                                        fsync_records=self.config.get('SPOOL_FSYNC_RECORDS', 100))
+            self.spool_drain_rate = self.config.get('SPOOL_DRAIN_RATE', 50)
+            self.spool_window = self.config.get('SPOOL_WINDOW', 20)
+            self.spool_wake = threading.Event()
+            self.spool_progress = time.monotonic()
+            self.publish_queue_depth = 0
+
         self.stateChangeQueue = stateChangeQueue
 
-        self.backOffCore = ProgressiveBackOffCore()
+        # where the clients come from, AWS IoT or an in-process broker (TRANSPORT 'local')
+        self.transport = transport if transport is not None else makeTransport(self.config)
+        self.backOffCore = self.transport.makeBackOffCore()
 
+        # discovery is cached for DISCOVERY_CACHE_TTL seconds, 0 to always ask
+        #   a local transport answers at once, it isn't cached
+        ttl = self.config.get('DISCOVERY_CACHE_TTL', 24*60*60) if not self.transport.local else 0
+        self.discoveryCache = DiscoveryCache(self.group_ca_path, ttl) if ttl else None
+        self.discovery_cached = False
+        self.groupCA = None
         self.discovered = False
         self.discoverBroker()
 
@@ -73,25 +128,55 @@ class GreengrassAwareConnection:
         self.shadowConnected = False
         self.connectShadow()
 
-        self.published_ids = []
+        if self.spool is not None:
+            threading.Thread(target=self._drainSpool, name=f"spool-{thingName}", daemon=True).start()
 
     def hasDiscovered(self):
         return self.discovered
 
 
+    # use a cached discovery if there is one, refreshing it in the background once stale
     def discoverBroker(self):
         if self.hasDiscovered():
             return
 
+        entry = self.discoveryCache.load(self.thingName) if self.discoveryCache is not None else None
+        if entry is not None:
+            self.logger.info(f"Using cached discovery for {self.thingName}")
+            self._useDiscovery(entry)
+            self.discovery_cached = True
+            if not self.discoveryCache.isFresh(entry):
+                threading.Thread(target=self._queryDiscovery, name=f"discovery-{self.thingName}", daemon=True).start()
+            return
+
+        entry = self._queryDiscovery()
+        if entry is not None:
+            self._useDiscovery(entry)
+
+    def _useDiscovery(self, entry):
+        self.coreInfo = Obj()
+        self.coreInfo.coreThingArn = entry.get('coreThingArn')
+        self.coreInfo.connectivityInfoList = []
+        for host, port in entry['connectivity']:
+            cl = Obj()
+            cl.host = host
+            cl.port = port
+            self.coreInfo.connectivityInfoList.append(cl)
+
+        self.groupCA = entry.get('caFile')
+        self.discovered = self.groupCA is not None
+
+    # ask the discovery service, caching the answer
+    #   returns the entry, or None if discovery failed
+    def _queryDiscovery(self):
         # Discover GGCs
-        discoveryInfoProvider = DiscoveryInfoProvider()
+        discoveryInfoProvider = self.transport.makeDiscoveryInfoProvider()
         discoveryInfoProvider.configureEndpoint(self.host)
         discoveryInfoProvider.configureCredentials(self.rootCA, self.cert, self.key)
         discoveryInfoProvider.configureTimeout(10)  # 10 sec
 
         retryCount = self.max_discovery_retries
-        self.groupCA = None
-        coreInfo = None
+        cache = self.discoveryCache if self.discoveryCache is not None else DiscoveryCache(self.group_ca_path, 0)
 
         while retryCount != 0:
             try:
@@ -101,27 +186,14 @@ class GreengrassAwareConnection:
 
                 # We only pick the first ca and core info
                 groupId, ca = caList[0]
-                self.coreInfo = coreList[0]
-                self.logger.info("Discovered GGC: %s from Group: %s" % (self.coreInfo.coreThingArn, groupId))
-
-                self.groupCA = self.group_ca_path + groupId + "_CA_" + str(uuid.uuid4()) + ".crt"
-                if not os.path.exists(self.group_ca_path):
-                    os.makedirs(self.group_ca_path)
-                groupCAFile = open(self.groupCA, "w")
-                groupCAFile.write(ca)
-                groupCAFile.close()
+                coreInfo = coreList[0]
+                self.logger.info("Discovered GGC: %s from Group: %s" % (coreInfo.coreThingArn, groupId))
 
-                self.discovered = True
-                break
+                connectivity = [ (c.host, c.port) for c in coreInfo.connectivityInfoList ]
+                return cache.save(self.thingName, groupId, ca, coreInfo.coreThingArn, connectivity)
             except DiscoveryFailure as e:
                 # device is not configured for greengrass, revert to IoT Core
-                cl = Obj()
-                cl.host = self.host
-                cl.port = 8883
-
-                self.coreInfo = Obj()
-                self.coreInfo.connectivityInfoList = [cl]
-                break
+                return cache.save(self.thingName, None, None, None, [(self.host, 8883)])
             except DiscoveryInvalidRequestException as e:
                 print("Invalid discovery request detected!")
                 print("Type: %s" % str(type(e)))
@@ -136,6 +208,7 @@ class GreengrassAwareConnection:
                 print("\n%d/%d retries left\n" % (retryCount, self.max_discovery_retries))
                 print("Backing off...\n")
                 self.backOffCore.backOff()
+        return None
 
 
     def isConnected(self):
@@ -146,27 +219,32 @@ class GreengrassAwareConnection:
 
     def onOnline(self):
         # print("online callback")
-        pass
+        self.online = True
+        if self.spool is not None:
+            self.spool_wake.set()
 
     def onOffline(self):
         # print("offline callback")
-        pass
+        self.online = False
+        if self.spool is not None:
+            # acks for what was sent won't come, send it again once back online
+            self.spool.rewind()
 
     def connect(self):
         if self.isConnected():
             return
 
-        self.client = AWSIoTMQTTClient(self.thingName)
+        self.client = self.transport.makeClient(self.thingName)
         self.client.configureCredentials(self._getCA(), self.key, self.cert)
 
-        for connectivityInfo in self.coreInfo.connectivityInfoList:
+        for connectivityInfo in self._raceEndpoints():
             currentHost = connectivityInfo.host
             currentPort = connectivityInfo.port
             self.logger.info("Trying to connect to core at %s:%d" % (currentHost, currentPort))
             self.client.configureEndpoint(currentHost, currentPort)
             try:
                 self.client.configureAutoReconnectBackoffTime(1, 128, 20)
-                self.client.configureOfflinePublishQueueing(self.offline_queue_depth)
+                self.client.configureOfflinePublishQueueing(self.publish_queue_depth)
                 self.client.configureDrainingFrequency(50)
                 self.client.configureMQTTOperationTimeout(10)
 
@@ -175,13 +253,53 @@ class GreengrassAwareConnection:
 
                 self.client.connect()
                 self.connected = True
+                self.online = True
+                if self.connect_count > 0:
+                    reconnect_count.inc()
+                self.connect_count += 1
 
                 self.currentHost = currentHost
                 self.currentPort = currentPort
+                self._preferEndpoint(connectivityInfo)
                 break
             except BaseException as e:
                 self.logger.warn("Error in Connect: Type: %s" % str(type(e)))
 
+        if not self.connected and self.discovery_cached:
+            # the cached cores may have moved, ask again
+            self.logger.warning(f"could not connect with cached discovery for {self.thingName} -- discovering again")
+            self.discoveryCache.invalidate(self.thingName)
+            self.discovery_cached = False
+            self.discovered = False
+            self.discoverBroker()
+            self.connect()
+
+    # the connectivity list, with the first endpoint to finish a TLS handshake moved to the front
+    #   CONNECT_RACE_STAGGER None tries them in order, as listed
+    def _raceEndpoints(self):
+        endpoints = list(self.coreInfo.connectivityInfoList)
+        stagger = self.config.get('CONNECT_RACE_STAGGER', 0.25)
+        if len(endpoints) < 2 or stagger is None or self.transport.local:
+            return endpoints
+
+        contexts = makeContexts(self._getCA(), self.cert, self.key, [ e.port for e in endpoints ])
+        winner = raceEndpoints([ (e.host, e.port) for e in endpoints ], contexts, stagger,
+                                self.config.get('CONNECT_RACE_TIMEOUT', 10.0))
+        if winner is None:
+            return endpoints
+        self.logger.info("Fastest core endpoint %s:%d" % winner)
+        return sorted(endpoints, key=lambda e: (e.host, e.port) != winner)
+
+    # try the endpoint that connected first next time, and after a restart
+    def _preferEndpoint(self, connectivityInfo):
+        endpoints = self.coreInfo.connectivityInfoList
+        if endpoints[0] is connectivityInfo:
+            return
+        endpoints.remove(connectivityInfo)
+        endpoints.insert(0, connectivityInfo)
+        if self.discoveryCache is not None:
+            self.discoveryCache.preferEndpoint(self.thingName, connectivityInfo.host, connectivityInfo.port)
+
     def disconnect(self):
         if not self.isConnected():
             return
@@ -191,39 +309,203 @@ class GreengrassAwareConnection:
 
         self.client.disconnect()
         self.connected = False
+        self.onOffline()
+        if self.spool is not None:
+            self.spool.sync()
 
     def pubAck(self, mid):
         # print(f"puback: {mid}")
-        self.published_ids.remove(mid)
+        now = time.monotonic()
+        with self.inflight_lock:
+            sent = self.inflight.pop(mid, None)
+            if sent is None:
+                # the ack beat publishTracked to the table
+                self.early_acks[mid] = now
+                return
+            self.inflight_stats['acked'] += 1
+        self.ack_latency.record(now - sent[0])
+        ack_latency.record(now - sent[0])
+
+    def _trackPublish(self, mid, sent, topic, size):
+        with self.inflight_lock:
+            self.inflight_stats['published'] += 1
+            acked = self.early_acks.pop(mid, None)
+            if acked is not None:
+                self.inflight_stats['acked'] += 1
+            else:
+                if mid in self.inflight:
+                    # the id wrapped around while the old message was still waiting
+                    self.inflight_stats['expired'] += 1
+                self.inflight[mid] = (sent, topic, size)
+                self.inflight_stats['max_inflight'] = max(self.inflight_stats['max_inflight'], len(self.inflight))
+        if acked is not None:
+            self.ack_latency.record(max(acked - sent, 0.0))
+            ack_latency.record(max(acked - sent, 0.0))
+
+        if sent - self.last_sweep > 1.0:
+            self.sweepInflight()
+
+    # drop messages waiting longer than timeout seconds for their ack
+    #   returns [(mid, topic, size, age)] of the dropped messages
+    def sweepInflight(self, timeout=None):
+        timeout = self.inflight_timeout if timeout is None else timeout
+        now = time.monotonic()
+        expired = []
+        with self.inflight_lock:
+            self.last_sweep = now
+            for mid, (sent, topic, size) in self.inflight.items():
+                if now - sent > timeout:
+                    expired.append((mid, topic, size, now - sent))
+            for e in expired:
+                del self.inflight[e[0]]
+            self.inflight_stats['expired'] += len(expired)
+            # an early ack whose publish never got an id is not coming back
+            early_acks = { mid: t for mid, t in self.early_acks.items() if now - t <= timeout }
+            self.inflight_stats['unknown_acks'] += len(self.early_acks) - len(early_acks)
+            self.early_acks = early_acks
+        if expired:
+            self.logger.warning(f"{len(expired)} messages waited more than {timeout} sec for PUBACK")
+        return expired
+
+    def getInflightCount(self):
+        return len(self.inflight)
+
+    # oldest message still waiting for its ack, (mid, topic, size, age) or None
+    def getOldestInflight(self):
+        now = time.monotonic()
+        with self.inflight_lock:
+            if not self.inflight:
+                return None
+            mid, (sent, topic, size) = next(iter(self.inflight.items()))
+            return (mid, topic, size, now - sent)
+
+    # seconds from publish to PUBACK -- count, mean, min, p50, p95, p99, max
+    def getAckLatency(self):
+        return self.ack_latency.getStats()
+
+    def getInflightStats(self):
+        with self.inflight_lock:
+            stats = dict(self.inflight_stats)
+            stats['inflight'] = len(self.inflight)
+            stats['inflight_bytes'] = sum(size for sent, topic, size in self.inflight.values())
+        stats['ack_latency'] = self.getAckLatency()
+        return stats
 
     def publicationIsBlocked(self):
         # return self.pubIsQueued
         return False
 
     def publishMessageOnTopic(self, message, topic, qos=0):
+        return self.publishTracked(message, topic, qos) is not None
+
+    # publish, calling ackCallback(mid) as well when the broker acknowledges the message
+    #   returns the message id, 0 if the client queued the message while offline (it will
+    # not be acknowledged), or None if it could not be published
+    def publishTracked(self, message, topic, qos=0, ackCallback=None):
+        if self.spool is not None and (not self.online or self.spool.pending() > 0 or self.spool.unackedCount() > 0):
+            # offline, or behind spooled messages -- sent or not, those not acked may be sent again
+            return self._spoolMessage(message, topic, qos)
+
         if not self.isConnected():
-            raise ConnectionError()
+            e = ConnectionError()
+            countPublishFailure(e)
+            raise e
+
+        def onAck(mid):
+            if ackCallback is not None:
+                ackCallback(mid)
+            self.pubAck(mid)
 
         result = MQTT_ERR_SUCCESS
-        did_publish = False
+        mid = None
         try:
-            result = self.client.publishAsync(topic, message, qos, self.pubAck)
-            did_publish = True
+            sent = time.monotonic()
+            result = self.client.publishAsync(topic, message, qos, onAck)
+            mid = 0
 
             # may be QUEUED or has ID
-            self.published_ids.append(int(result))
+            mid = int(result)
+            if qos > 0:
+                self._trackPublish(mid, sent, topic, len(message))
 
         except ValueError as e:
             # print(f"message queued - {result}")
             pass
         except publishError as e:
             print(f"Publish Error: {e.message}")
+            countPublishFailure(e)
         except publishQueueFullException as e:
             print(f"Publish Full Exception: {e.message}")
+            countPublishFailure(e)
         except Exception as e:
             print(f"Another Exception: {type(e)}")
+            countPublishFailure(e)
+
+        if mid is None and self.spool is not None:
+            return self._spoolMessage(message, topic, qos)
+        if mid is not None:
+            published_count.inc()
+            published_bytes.inc(len(message))
+        return mid
+
+    # like a message queued by the SDK, a spooled message is not acknowledged to the caller
+    #   None if it can't be written either, so the caller backs off as for a failed publish
+    def _spoolMessage(self, message, topic, qos):
+        try:
+            self.spool.append(topic, message, qos)
+        except OSError as e:
+            self.logger.error(f"could not spool message: {e}")
+            countPublishFailure(e)
+            return None
+        spooled_count.inc()
+        self.spool_wake.set()
+        return 0
+
+    # send the spool in order at SPOOL_DRAIN_RATE, with up to SPOOL_WINDOW waiting for PUBACK
+    def _drainSpool(self):
+        while True:
+            self.spool_wake.wait(1.0)
+            self.spool_wake.clear()
+
+            if self.spool.unackedCount() > 0 and time.monotonic() - self.spool_progress > self.inflight_timeout:
+                self.logger.warning(f"no PUBACK for spooled messages in {self.inflight_timeout} sec, sending them again")
+                self.spool.rewind()
+                self.spool_progress = time.monotonic()
+
+            while self.online and self.spool.pending() > 0 and self.spool.unackedCount() < self.spool_window:
+                record = self.spool.next()
+                if record is None:
+                    break
+                if not self._publishSpooled(*record):
+                    self.spool.rewind()
+                    break
+                if self.spool_drain_rate:
+                    time.sleep(1.0/self.spool_drain_rate)
+
+    def _publishSpooled(self, position, topic, message, qos):
+        def onAck(mid):
+            self.spool.ack(position)
+            self.spool_progress = time.monotonic()
+            self.spool_wake.set()
+            self.pubAck(mid)
 
-        return did_publish
+        try:
+            sent = time.monotonic()
+            mid = int(self.client.publishAsync(topic, message, qos, onAck))
+        except Exception as e:
+            countPublishFailure(e)
+            return False
+
+        if self.spool.unackedCount() == 1:
+            # the wait for an ack starts now
+            self.spool_progress = sent
+        if qos > 0:
+            self._trackPublish(mid, sent, topic, len(message))
+        else:
+            self.spool.ack(position)
+        published_count.inc()
+        published_bytes.inc(len(message))
+        return True
 
     def isShadowConnected(self):
         return self.shadowConnected
@@ -254,7 +536,7 @@ class GreengrassAwareConnection:
             self.logger.warn("connect regula client first to get host and port")
             raise ConnectionError
 
-        self.shadowClient = AWSIoTMQTTShadowClient(self.thingName)
+        self.shadowClient = self.transport.makeShadowClient(self.thingName)
         self.shadowClient.configureEndpoint(self.currentHost, self.currentPort)
         self.shadowClient.configureCredentials(self._getCA(), self.key, self.cert)
 
@@ -282,17 +564,26 @@ class GreengrassAwareConnection:
         self.shadowConnected = False
 
 
-    def updateShadow(self, update):
+    # report update, calling callback(payload, responseStatus, token) as well when the update is answered
+    #   returns False if the update could not be sent
+    def updateShadow(self, update, callback=None):
         if not self.isShadowConnected():
             raise ConnectionError
 
+        def onUpdate(payload, responseStatus, token):
+            self.shadowUpdate_callback(payload, responseStatus, token)
+            if callback is not None:
+                callback(payload, responseStatus, token)
+
         state = {'state': {
                     'reported': update
         }}
         try:
-            self.deviceShadowHandler.shadowUpdate(json.dumps(state), self.shadowUpdate_callback, 10)
+            self.deviceShadowHandler.shadowUpdate(json.dumps(state), onUpdate, 10)
+            return True
         except Exception as e:
             print("Exception updating shadow")
+            return False
 
 
 
@@ -0,0 +1,121 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# LatencyHistogram
+#
+#   Fixed size histogram of latencies in seconds, with log spaced buckets so a
+# percentile is within a few percent of the true value from 100 us to over an hour.
+# Recording is O(1) and the memory doesn't grow with the number of samples.
+#
+
+import math
+from math import frexp
+import threading
+
+MIN_LATENCY = 0.0001            # seconds, anything faster lands in the first bucket
+BUCKETS_PER_DOUBLING = 16       # at most about 6% between bucket edges
+BUCKET_COUNT = 400              # up to MIN_LATENCY * 2^25, about an hour
+INV_MIN_LATENCY = 1/MIN_LATENCY
+
+
+class LatencyHistogram():
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.buckets = [0]*BUCKET_COUNT
+            self.count = 0
+            self.total = 0.0
+            self.min = math.inf
+            self.max = -math.inf
+
+    # buckets are linear within each doubling, from the float's exponent and mantissa
+    def _bucket(self, seconds):
+        if seconds <= MIN_LATENCY:
+            return 0
+        m, e = frexp(seconds*INV_MIN_LATENCY)
+        b = (e - 1)*BUCKETS_PER_DOUBLING + int((m*2 - 1)*BUCKETS_PER_DOUBLING) + 1
+        return b if b < BUCKET_COUNT else BUCKET_COUNT - 1
+
+    # upper edge of a bucket
+    def _edge(self, b):
+        if b == 0:
+            return MIN_LATENCY
+        e, sub = divmod(b - 1, BUCKETS_PER_DOUBLING)
+        return MIN_LATENCY * 2**e * (1 + (sub + 1)/BUCKETS_PER_DOUBLING)
+
+    # one histogram holding the samples of many
+    @classmethod
+    def merged(cls, histograms):
+        m = cls()
+        for h in histograms:
+            with h.lock:
+                m.buckets = [ a + b for a, b in zip(m.buckets, h.buckets) ]
+                m.count += h.count
+                m.total += h.total
+                m.min = min(m.min, h.min)
+                m.max = max(m.max, h.max)
+        return m
+
+    # acks of many connections record from their own threads, so the update is locked
+    #   the bucket is found outside the lock to keep it short
+    def record(self, seconds):
+        if seconds <= MIN_LATENCY:
+            b = 0
+        else:
+            m, e = frexp(seconds*INV_MIN_LATENCY)
+            b = (e - 1)*BUCKETS_PER_DOUBLING + int((m + m - 1)*BUCKETS_PER_DOUBLING) + 1
+            if b >= BUCKET_COUNT:
+                b = BUCKET_COUNT - 1
+        with self.lock:
+            self.buckets[b] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+            if seconds < self.min:
+                self.min = seconds
+
+    # latency at or below which p percent of the samples fall, None when empty
+    def percentile(self, p):
+        with self.lock:
+            return self._percentile(p)
+
+    def _percentile(self, p):
+        if self.count == 0:
+            return None
+        rank = max(math.ceil(self.count*p/100.0), 1)
+        seen = 0
+        for b, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                # never report beyond what was actually seen
+                return min(max(self._edge(b), self.min), self.max)
+        return self.max
+
+    def getStats(self):
+        with self.lock:
+            return {
+                'count': self.count,
+                'mean': self.total/self.count if self.count else None,
+                'min': self.min if self.count else None,
+                'p50': self._percentile(50),
+                'p95': self._percentile(95),
+                'p99': self._percentile(99),
+                'max': self.max if self.count else None,
+            }
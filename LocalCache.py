@@ -0,0 +1,152 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# LocalCache
+#
+#   Keeps the trips fetched from S3 into a local_dir under a size limit, evicting the
+# least recently used. Only files fetched through FileReader are known to it -- anything
+# else in the directory is never touched. When a trip is used its time is recorded in
+# local_dir/.local_cache.json, so the order survives a restart, and a file that is open
+# (pinned) is never evicted. Its .tripcache goes with it and counts towards the limit.
+#
+#       LocalCache.configure(max_bytes)         # None for no limit
+#       cache = LocalCache.getCache(local_dir)
+#       cache.use(path); cache.pin(path) ... cache.unpin(path)
+#       LocalCache.onEvict(callback)            # callback(path) for each file evicted
+#
+
+import json
+import logging
+import os
+import threading
+import time
+
+from TripCache import CACHE_SUFFIX
+
+INDEX_FILE = '.local_cache.json'
+
+logger = logging.getLogger("TelemetryThing.cache")
+
+settings = { 'max_bytes': None }
+
+_caches = {}
+_caches_lock = threading.Lock()
+_listeners = []
+
+
+def configure(max_bytes=None):
+    if max_bytes is not None and int(max_bytes) <= 0:
+        raise ValueError(f"local_cache_max_bytes must be positive, not {max_bytes!r}")
+    settings['max_bytes'] = int(max_bytes) if max_bytes is not None else None
+
+# called with the absolute path of each evicted file, while the cache is locked
+def onEvict(callback):
+    _listeners.append(callback)
+
+# the cache of a directory, shared by every reader using it
+def getCache(directory):
+    directory = os.path.abspath(directory)
+    with _caches_lock:
+        cache = _caches.get(directory)
+        if cache is None:
+            cache = LocalCache(directory)
+            _caches[directory] = cache
+        return cache
+
+
+class LocalCache():
+    def __init__(self, directory) -> None:
+        self.directory = directory
+        self.index_path = os.path.join(directory, INDEX_FILE)
+        self.lock = threading.Lock()
+        self.pinned = {}
+        self.used = {}
+        try:
+            with open(self.index_path) as f:
+                self.used = json.load(f)
+        except (OSError, ValueError) as e:
+            pass
+
+    def _key(self, path):
+        return os.path.relpath(os.path.abspath(path), self.directory)
+
+    def _save(self):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = f"{self.index_path}.{os.getpid()}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(self.used, f)
+            os.replace(tmp, self.index_path)
+        except OSError as e:
+            logger.warning(f"could not write {self.index_path}: {e}")
+
+    # path was just used, evicting others if over the limit
+    def use(self, path):
+        with self.lock:
+            self.used[self._key(path)] = time.time()
+            self._evict()
+            self._save()
+
+    def pin(self, path):
+        key = self._key(path)
+        with self.lock:
+            self.pinned[key] = self.pinned.get(key, 0) + 1
+
+    def unpin(self, path):
+        key = self._key(path)
+        with self.lock:
+            count = self.pinned.get(key, 0) - 1
+            if count > 0:
+                self.pinned[key] = count
+            else:
+                self.pinned.pop(key, None)
+
+    def _size(self, key):
+        size = 0
+        for p in [ key, key + CACHE_SUFFIX ]:
+            try:
+                size += os.stat(os.path.join(self.directory, p)).st_size
+            except OSError as e:
+                pass
+        return size
+
+    def getBytes(self):
+        with self.lock:
+            return sum(self._size(k) for k in self.used)
+
+    def _evict(self):
+        max_bytes = settings['max_bytes']
+        if max_bytes is None:
+            return
+        sizes = { k: self._size(k) for k in self.used }
+        total = sum(sizes.values())
+        for key in sorted(self.used, key=self.used.get):
+            if total <= max_bytes:
+                break
+            if key in self.pinned:
+                continue
+            for p in [ key, key + CACHE_SUFFIX ]:
+                try:
+                    os.remove(os.path.join(self.directory, p))
+                except OSError as e:
+                    pass
+            del self.used[key]
+            total -= sizes[key]
+            logger.info(f"evicted {key} from {self.directory}, {sizes[key]} bytes")
+            for callback in _listeners:
+                callback(os.path.join(self.directory, key))
+        if total > max_bytes:
+            logger.debug(f"{self.directory} holds {total} bytes of open trips, over the limit of {max_bytes}")
@@ -0,0 +1,549 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# LocalTransport
+#
+#   An in-process stand-in for AWS IoT, for running the replay, the fleet and the
+# benchmarks without an account, certificates or a network. Clients publish to a
+# LocalBroker shared by the whole process, which acknowledges QoS 1 messages after
+# LOCAL_PUBACK_LATENCY (+- LOCAL_PUBACK_JITTER) seconds on its own thread, keeps a
+# shadow document per thing, and answers discovery.
+#
+#   Faults can be injected from a test or scenario through the broker --
+#       disconnect(clientId) / reconnect(clientId)   drop and restore clients, None for all
+#       setQueueFull(full)                            publishes raise publishQueueFullException
+#       failNextPublishes(count)                      the next publishes raise publishError
+#       setPubAckLatency(latency, jitter)             change the ack delay
+#       setDesired(thingName, desired)                change the shadow, sending a delta
+#       setGreengrassGroup(...)                       answer discovery with a core
+#
+
+import copy
+import heapq
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+from Transport import DiscoveryFailure, publishError, publishQueueFullException, DROP_OLDEST
+
+logger = logging.getLogger("GreengrassAwareConnection.local")
+
+# what publishAsync returns for a message queued while offline, as the SDK does
+QUEUED_MID = "QUEUED"
+
+
+class LocalBroker():
+    def __init__(self, puback_latency=0.005, puback_jitter=0.0, max_inflight=0, keep_messages=1000) -> None:
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.puback_latency = puback_latency
+        self.puback_jitter = puback_jitter
+        # QoS 1 messages a client may have waiting for PUBACK, 0 for no limit
+        self.max_inflight = max_inflight
+        self.queue_full = False
+        self.fail_publishes = 0
+
+        self.shadows = {}
+        self.delta_callbacks = {}
+        self.greengrass = None
+
+        # the last keep_messages messages published, (time, clientId, topic, payload, qos)
+        self.messages = deque(maxlen=keep_messages)
+        self.stats = { 'published': 0, 'published_bytes': 0, 'acked': 0, 'dropped_acks': 0,
+                        'queue_full': 0, 'failed': 0, 'disconnects': 0, 'shadow_updates': 0, 'deltas': 0 }
+        self.topic_counts = {}
+
+        # callbacks due on the broker's thread, (due, seq, fn, args)
+        self.pending = []
+        self.seq = itertools.count()
+        self.wake = threading.Condition(self.lock)
+        threading.Thread(target=self._dispatch, name="local-broker", daemon=True).start()
+
+    def _dispatch(self):
+        while True:
+            with self.wake:
+                while not self.pending or self.pending[0][0] > time.monotonic():
+                    self.wake.wait(self.pending[0][0] - time.monotonic() if self.pending else None)
+                due, seq, fn, args = heapq.heappop(self.pending)
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.warning(f"local broker callback failed: {type(e)} {e}")
+
+    # call fn(*args) on the broker's thread after delay seconds
+    def _schedule(self, delay, fn, *args):
+        with self.wake:
+            heapq.heappush(self.pending, (time.monotonic() + delay, next(self.seq), fn, args))
+            self.wake.notify()
+
+    def _ackDelay(self):
+        if not self.puback_jitter:
+            return self.puback_latency
+        return max(0.0, self.puback_latency + random.uniform(-self.puback_jitter, self.puback_jitter))
+
+    def register(self, client):
+        with self.lock:
+            self.clients[client.clientId] = client
+
+    def unregister(self, client):
+        with self.lock:
+            if self.clients.get(client.clientId) is client:
+                del self.clients[client.clientId]
+
+    # a message from a connected client, raises as the SDK would if it can't be sent
+    def receive(self, client, topic, payload, qos):
+        with self.lock:
+            if self.fail_publishes > 0:
+                self.fail_publishes -= 1
+                self.stats['failed'] += 1
+                raise publishError("injected publish failure")
+            if self.queue_full or (qos > 0 and self.max_inflight and client.getInflightCount() >= self.max_inflight):
+                self.stats['queue_full'] += 1
+                raise publishQueueFullException("local broker queue full")
+
+            self.stats['published'] += 1
+            self.stats['published_bytes'] += len(payload)
+            self.topic_counts[topic] = self.topic_counts.get(topic, 0) + 1
+            self.messages.append((time.time(), client.clientId, topic, payload, qos))
+
+    def _pubAck(self, client, generation, mid, ackCallback):
+        if not client.acked(generation, mid):
+            # the client went offline since, the ack is lost with the connection
+            self.stats['dropped_acks'] += 1
+            return
+        self.stats['acked'] += 1
+        if ackCallback is not None:
+            ackCallback(mid)
+
+    def scheduleAck(self, client, generation, mid, ackCallback):
+        self._schedule(self._ackDelay(), self._pubAck, client, generation, mid, ackCallback)
+
+    def _select(self, clientId):
+        with self.lock:
+            return [ c for c in self.clients.values() if clientId is None or c.clientId == clientId ]
+
+    # fault injection
+
+    def disconnect(self, clientId=None):
+        for c in self._select(clientId):
+            self.stats['disconnects'] += 1
+            c.goOffline()
+
+    def reconnect(self, clientId=None):
+        for c in self._select(clientId):
+            c.goOnline()
+
+    def setQueueFull(self, full=True):
+        self.queue_full = full
+
+    def failNextPublishes(self, count=1):
+        with self.lock:
+            self.fail_publishes = count
+
+    def setPubAckLatency(self, latency, jitter=0.0):
+        self.puback_latency = latency
+        self.puback_jitter = jitter
+
+    # discovery finds groupId's core at endpoints [(host, port)], None to fail discovery as IoT Core does
+    def setGreengrassGroup(self, groupId=None, ca=None, coreThingArn=None, endpoints=None):
+        if groupId is None:
+            self.greengrass = None
+            return
+        self.greengrass = { 'groupId': groupId, 'ca': ca, 'coreThingArn': coreThingArn,
+                            'endpoints': list(endpoints or []) }
+
+    # inspection
+
+    # the messages kept, optionally only those on topic
+    def getMessages(self, topic=None):
+        with self.lock:
+            return [ m for m in self.messages if topic is None or m[2] == topic ]
+
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['topics'] = dict(self.topic_counts)
+            stats['clients'] = len(self.clients)
+        return stats
+
+    # shadows
+
+    def _getShadow(self, thingName):
+        return self.shadows.setdefault(thingName, { 'state': {}, 'version': 0 })
+
+    def getShadow(self, thingName):
+        with self.lock:
+            return copy.deepcopy(self.shadows.get(thingName))
+
+    def registerDelta(self, thingName, callback):
+        with self.lock:
+            if callback is None:
+                self.delta_callbacks.pop(thingName, None)
+            else:
+                self.delta_callbacks[thingName] = callback
+
+    # apply a shadow update document, returning the response and any delta to send
+    def updateShadow(self, thingName, update):
+        with self.lock:
+            shadow = self._getShadow(thingName)
+            for section in ['desired', 'reported']:
+                if section in update.get('state', {}):
+                    merged = _merge(shadow['state'].get(section, {}), update['state'][section])
+                    shadow['state'][section] = merged
+            shadow['version'] += 1
+            self.stats['shadow_updates'] += 1
+
+            response = { 'state': update.get('state', {}), 'version': shadow['version'], 'timestamp': int(time.time()) }
+            delta = None
+            if 'desired' in update.get('state', {}):
+                delta = _delta(shadow['state'].get('desired', {}), shadow['state'].get('reported', {}))
+            return response, (delta or None), shadow['version']
+
+    def setDesired(self, thingName, desired):
+        response, delta, version = self.updateShadow(thingName, { 'state': { 'desired': desired } })
+        self._sendDelta(thingName, delta, version)
+
+    def _sendDelta(self, thingName, delta, version):
+        if delta is None:
+            return
+        with self.lock:
+            callback = self.delta_callbacks.get(thingName)
+            self.stats['deltas'] += 1
+        if callback is None:
+            return
+        payload = json.dumps({ 'version': version, 'timestamp': int(time.time()), 'state': delta })
+        self._schedule(self._ackDelay(), callback, payload, f"delta/{thingName}", None)
+
+    def deleteShadow(self, thingName):
+        with self.lock:
+            return self.shadows.pop(thingName, None) is not None
+
+
+# shadow merge -- None removes a key, dicts merge
+def _merge(current, update):
+    merged = dict(current)
+    for k, v in update.items():
+        if v is None:
+            merged.pop(k, None)
+        elif isinstance(v, dict) and isinstance(merged.get(k), dict):
+            merged[k] = _merge(merged[k], v)
+        else:
+            merged[k] = copy.deepcopy(v)
+    return merged
+
+# the desired values reported doesn't match
+def _delta(desired, reported):
+    delta = {}
+    for k, v in desired.items():
+        if isinstance(v, dict) and isinstance(reported.get(k), dict):
+            d = _delta(v, reported[k])
+            if d:
+                delta[k] = d
+        elif reported.get(k) != v:
+            delta[k] = copy.deepcopy(v)
+    return delta
+
+
+# the process wide broker, made from the first connection's config
+_broker = None
+_broker_lock = threading.Lock()
+
+def getBroker(config={}):
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            _broker = LocalBroker(puback_latency=config.get('LOCAL_PUBACK_LATENCY', 0.005),
+                                    puback_jitter=config.get('LOCAL_PUBACK_JITTER', 0.0),
+                                    max_inflight=config.get('LOCAL_MAX_INFLIGHT', 0),
+                                    keep_messages=config.get('LOCAL_KEEP_MESSAGES', 1000))
+        return _broker
+
+
+# an AWSIoTMQTTClient that publishes to a LocalBroker
+class LocalMQTTClient():
+    def __init__(self, broker, clientId) -> None:
+        self.broker = broker
+        self.clientId = clientId
+        self.connected = False
+        self.online = False
+        self.onOnline = None
+        self.onOffline = None
+
+        self.offline_queue = deque()
+        self.offline_queue_depth = -1
+        self.drop_behavior = DROP_OLDEST
+
+        self.lock = threading.Lock()
+        self.mids = itertools.cycle(range(1, 65536))
+        self.inflight = set()
+        # bumped each time the connection drops, acks from before are lost
+        self.generation = 0
+
+    # accepted and ignored, nothing here uses them
+    def configureCredentials(self, CAFilePath, KeyPath="", CertificatePath=""):
+        pass
+
+    def configureEndpoint(self, hostName, portNumber):
+        self.endpoint = (hostName, portNumber)
+
+    def configureAutoReconnectBackoffTime(self, baseReconnectQuietTimeSecond, maxReconnectQuietTimeSecond, stableConnectionTimeSecond):
+        pass
+
+    def configureDrainingFrequency(self, frequencyInHz):
+        pass
+
+    def configureMQTTOperationTimeout(self, timeoutSecond):
+        pass
+
+    def configureConnectDisconnectTimeout(self, timeoutSecond):
+        pass
+
+    # -1 for no limit, 0 to not queue at all
+    def configureOfflinePublishQueueing(self, queueSize, dropBehavior=DROP_OLDEST):
+        self.offline_queue_depth = queueSize
+        self.drop_behavior = dropBehavior
+
+    def connect(self, keepAliveIntervalSecond=600):
+        self.broker.register(self)
+        self.connected = True
+        self.goOnline()
+        return True
+
+    def disconnect(self):
+        self.connected = False
+        self.broker.unregister(self)
+        self.goOffline()
+        return True
+
+    def goOffline(self):
+        with self.lock:
+            if not self.online:
+                return
+            self.online = False
+            self.generation += 1
+            self.inflight.clear()
+        if self.onOffline is not None:
+            self.onOffline()
+
+    def goOnline(self):
+        with self.lock:
+            if self.online or not self.connected:
+                return
+            self.online = True
+            queued = list(self.offline_queue)
+            self.offline_queue.clear()
+        if self.onOnline is not None:
+            self.onOnline()
+        # the SDK's queued messages go out without their callbacks
+        for topic, payload, qos in queued:
+            try:
+                self.publishAsync(topic, payload, qos)
+            except Exception as e:
+                logger.warning(f"dropped queued message on {topic}: {type(e)}")
+
+    def getInflightCount(self):
+        return len(self.inflight)
+
+    def acked(self, generation, mid):
+        with self.lock:
+            if generation != self.generation:
+                return False
+            self.inflight.discard(mid)
+            return True
+
+    def _queue(self, topic, payload, qos):
+        with self.lock:
+            if self.offline_queue_depth == 0:
+                raise publishError("offline and queueing is disabled")
+            if self.offline_queue_depth > 0 and len(self.offline_queue) >= self.offline_queue_depth:
+                if self.drop_behavior != DROP_OLDEST:
+                    raise publishQueueFullException("offline queue full")
+                self.offline_queue.popleft()
+            self.offline_queue.append((topic, payload, qos))
+        return QUEUED_MID
+
+    def publishAsync(self, topic, payload, QoS, ackCallback=None):
+        if not self.online:
+            return self._queue(topic, payload, QoS)
+
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        self.broker.receive(self, topic, payload, QoS)
+
+        mid = next(self.mids)
+        if QoS > 0:
+            with self.lock:
+                self.inflight.add(mid)
+                generation = self.generation
+            self.broker.scheduleAck(self, generation, mid, ackCallback)
+        return mid
+
+    def publish(self, topic, payload, QoS):
+        return self.publishAsync(topic, payload, QoS) is not None
+
+
+# an AWSIoTMQTTShadowClient on a LocalBroker
+class LocalShadowClient():
+    def __init__(self, broker, clientId) -> None:
+        self.broker = broker
+        # the name the SDK gives its underlying client
+        self._AWSIoTMQTTClient = LocalMQTTClient(broker, clientId + "-shadow")
+
+    def configureEndpoint(self, hostName, portNumber):
+        self._AWSIoTMQTTClient.configureEndpoint(hostName, portNumber)
+
+    def configureCredentials(self, CAFilePath, KeyPath="", CertificatePath=""):
+        pass
+
+    def configureAutoReconnectBackoffTime(self, baseReconnectQuietTimeSecond, maxReconnectQuietTimeSecond, stableConnectionTimeSecond):
+        pass
+
+    def configureConnectDisconnectTimeout(self, timeoutSecond):
+        pass
+
+    def configureMQTTOperationTimeout(self, timeoutSecond):
+        pass
+
+    def connect(self, keepAliveIntervalSecond=600):
+        return self._AWSIoTMQTTClient.connect(keepAliveIntervalSecond)
+
+    def disconnect(self):
+        return self._AWSIoTMQTTClient.disconnect()
+
+    def createShadowHandlerWithName(self, shadowName, isPersistentSubscribe):
+        return LocalShadowHandler(self.broker, self._AWSIoTMQTTClient, shadowName)
+
+
+class LocalShadowHandler():
+    def __init__(self, broker, client, shadowName) -> None:
+        self.broker = broker
+        self.client = client
+        self.shadowName = shadowName
+        self.tokens = itertools.count(1)
+
+    def _token(self):
+        return f"{self.client.clientId}-{next(self.tokens)}"
+
+    # answers 'timeout' while the client is offline, as an update lost on the way would
+    def _answer(self, callback, timeout, respond):
+        token = self._token()
+        if not self.client.online:
+            self.broker._schedule(timeout, callback, None, 'timeout', token)
+            return token
+
+        def answer():
+            payload, status = respond()
+            payload['clientToken'] = token
+            callback(json.dumps(payload), status, token)
+        self.broker._schedule(self.broker._ackDelay(), answer)
+        return token
+
+    def shadowUpdate(self, srcJSONPayload, srcCallback, srcTimeout):
+        update = json.loads(srcJSONPayload)
+
+        def respond():
+            response, delta, version = self.broker.updateShadow(self.shadowName, update)
+            self.broker._sendDelta(self.shadowName, delta, version)
+            return response, 'accepted'
+        return self._answer(srcCallback, srcTimeout, respond)
+
+    def shadowGet(self, srcCallback, srcTimeout):
+        def respond():
+            shadow = self.broker.getShadow(self.shadowName)
+            if shadow is None:
+                return { 'code': 404, 'message': f"No shadow exists with name: '{self.shadowName}'" }, 'rejected'
+            return shadow, 'accepted'
+        return self._answer(srcCallback, srcTimeout, respond)
+
+    def shadowDelete(self, srcCallback, srcTimeout):
+        def respond():
+            if not self.broker.deleteShadow(self.shadowName):
+                return { 'code': 404, 'message': f"No shadow exists with name: '{self.shadowName}'" }, 'rejected'
+            return { 'version': 0, 'timestamp': int(time.time()) }, 'accepted'
+        return self._answer(srcCallback, srcTimeout, respond)
+
+    def shadowRegisterDeltaCallback(self, srcCallback):
+        self.broker.registerDelta(self.shadowName, srcCallback)
+
+    def shadowUnregisterDeltaCallback(self):
+        self.broker.registerDelta(self.shadowName, None)
+
+
+class Obj(object):
+    pass
+
+# a DiscoveryInfoProvider answering from the broker's greengrass group
+class LocalDiscoveryInfoProvider():
+    def __init__(self, broker) -> None:
+        self.broker = broker
+
+    def configureEndpoint(self, host, port=8443):
+        pass
+
+    def configureCredentials(self, caPath, certPath, keyPath):
+        pass
+
+    def configureTimeout(self, timeoutSecond):
+        pass
+
+    def discover(self, thingName):
+        group = self.broker.greengrass
+        if group is None:
+            raise DiscoveryFailure("No greengrass group for " + thingName)
+
+        core = Obj()
+        core.coreThingArn = group['coreThingArn']
+        core.connectivityInfoList = []
+        for host, port in group['endpoints']:
+            c = Obj()
+            c.host = host
+            c.port = port
+            core.connectivityInfoList.append(c)
+
+        info = Obj()
+        info.getAllCas = lambda: [ (group['groupId'], group['ca']) ]
+        info.getAllCores = lambda: [ core ]
+        return info
+
+
+# retries locally don't need to wait long
+class LocalBackOffCore():
+    def backOff(self):
+        time.sleep(0.01)
+
+
+class LocalTransport():
+    # nothing to race and nothing worth caching
+    local = True
+
+    def __init__(self, broker=None) -> None:
+        self.broker = broker if broker is not None else getBroker()
+
+    def makeDiscoveryInfoProvider(self):
+        return LocalDiscoveryInfoProvider(self.broker)
+
+    def makeClient(self, clientId):
+        return LocalMQTTClient(self.broker, clientId)
+
+    def makeShadowClient(self, clientId):
+        return LocalShadowClient(self.broker, clientId)
+
+    def makeBackOffCore(self):
+        return LocalBackOffCore()
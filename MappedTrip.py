@@ -0,0 +1,238 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# MappedTrip
+#
+#   Memory-mapped access to the rows of a trip CSV.
+# Row boundaries come from a newline offset index built once per file, and fields
+# stay as spans of the row's bytes until a value is asked for. Every reader of the
+# same file, in this process or any other, shares the OS page cache for it.
+#
+#   A sample copies the bytes of its one line out of the mapping, so it stays readable
+# after the last reader has released the trip and the mapping is closed.
+#
+
+from array import array
+from collections.abc import MutableMapping, Sequence
+import mmap
+import os
+import stat
+import threading
+
+WHITESPACE = b' \t\r\n\x0b\x0c'
+
+
+# MappedSample is the dict-like sample handed to payload strategies
+#   a field is only decoded to str the first time it is read
+class MappedSample(MutableMapping):
+    __slots__ = ('_trip', '_line', '_bounds', '_values', '_deleted')
+
+    def __init__(self, trip, line, bounds):
+        self._trip = trip
+        self._line = line
+        self._bounds = bounds
+        self._values = {}
+        self._deleted = None
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        if self._deleted is not None and key in self._deleted:
+            raise KeyError(key)
+        value = self._trip.decodeField(self._bounds, self._trip.colIndex[key], self._line)
+        self._values[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+        if self._deleted is not None:
+            self._deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._values.pop(key, None)
+        if self._deleted is None:
+            self._deleted = set()
+        self._deleted.add(key)
+
+    def __contains__(self, key):
+        if key in self._values:
+            return True
+        return key in self._trip.colIndex and (self._deleted is None or key not in self._deleted)
+
+    def __iter__(self):
+        deleted = self._deleted or ()
+        for k in self._trip.colIndex:
+            if k not in deleted:
+                yield k
+        for k in self._values:
+            if k not in self._trip.colIndex:
+                yield k
+
+    def __len__(self):
+        return sum(1 for k in self)
+
+    def copy(self):
+        return dict(self.items())
+
+
+class MappedTrip():
+    _trips = {}
+    _lock = threading.Lock()
+
+    # one mapping and index per file version, shared by every reader in the process
+    #   each get is a reference, given back with release()
+    @classmethod
+    def get(cls, path, record_separator=",", quote_records=False):
+        st = os.stat(path)
+        key = (os.path.realpath(path), st.st_size, st.st_mtime_ns, record_separator, quote_records)
+        with cls._lock:
+            trip = cls._trips.get(key)
+            if trip is None:
+                trip = cls(path, record_separator, quote_records)
+                trip.key = key
+                cls._trips[key] = trip
+            trip.refs += 1
+        return trip
+
+    # the last reader done with it takes the trip out of the shared table and closes
+    # the mapping -- samples already handed out hold their own line
+    def release(self):
+        with MappedTrip._lock:
+            self.refs -= 1
+            if self.refs > 0:
+                return
+            if MappedTrip._trips.get(self.key) is self:
+                del MappedTrip._trips[self.key]
+            self.mm.close()
+
+    def isClosed(self):
+        return self.mm.closed
+
+    @staticmethod
+    def isMappable(path):
+        # only regular, non-empty files can be mapped
+        try:
+            st = os.stat(path)
+            return stat.S_ISREG(st.st_mode) and st.st_size > 0
+        except OSError:
+            return False
+
+    def __init__(self, path, record_separator=",", quote_records=False):
+        self.path = path
+        self.separator = record_separator.encode('utf-8')
+        self.quote_records = quote_records
+        self.key = None
+        self.refs = 0
+
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.offsets = self._indexLines()
+
+        self.cols = self.decodeLine(0)
+        # like a dict built from the row, a repeated column name reads its last field
+        self.colIndex = {}
+        for i in range(len(self.cols)):
+            self.colIndex[self.cols[i]] = i
+
+    # start offset of every line, plus the end of the data
+    def _indexLines(self):
+        mm = self.mm
+        size = len(mm)
+        offsets = array('q', [0])
+        find = mm.find
+        pos = find(b'\n')
+        while pos >= 0:
+            offsets.append(pos + 1)
+            pos = find(b'\n', pos + 1)
+        if offsets[-1] != size:
+            offsets.append(size)
+        return offsets
+
+    # number of data rows, not counting the header
+    def __len__(self):
+        return max(len(self.offsets) - 2, 0)
+
+    # [start, end) spans of every field of line n, without copying the line
+    def _bounds(self, n):
+        mm = self.mm
+        start = self.offsets[n]
+        end = self.offsets[n + 1]
+        while end > start and mm[end - 1] in WHITESPACE:
+            end -= 1
+
+        bounds = [start]
+        find = mm.find
+        sep = self.separator
+        step = len(sep)
+        pos = find(sep, start, end)
+        while pos >= 0:
+            bounds.append(pos)
+            bounds.append(pos + step)
+            pos = find(sep, pos + step, end)
+        bounds.append(end)
+        return bounds
+
+    # field i of a line, from the mapping or from a sample's copy of the line
+    def decodeField(self, bounds, i, line=None):
+        value = (self.mm if line is None else line)[bounds[2*i]:bounds[2*i + 1]].decode('utf-8')
+        return value.strip('"') if self.quote_records else value
+
+    def decodeLine(self, n):
+        bounds = self._bounds(n)
+        return [ self.decodeField(bounds, i) for i in range(len(bounds)//2) ]
+
+    # the named column, decoded a value at a time as it is read -- None if there is no such column
+    def getColumn(self, name):
+        i = self.colIndex.get(name)
+        if i is None:
+            return None
+        return MappedColumn(self, i)
+
+    # sample for data row r -- a short row ends the file, as with a line-by-line read
+    def getSample(self, r):
+        if r < 0 or r >= len(self):
+            raise IndexError(r)
+        bounds = self._bounds(r + 1)
+        if len(bounds)//2 < len(self.cols):
+            raise IndexError(r)
+        start = bounds[0]
+        return MappedSample(self, self.mm[start:bounds[-1]], [ b - start for b in bounds ])
+
+
+# one column of a MappedTrip, read through the line index without decoding the rest
+#   a short row ends the file here too, its index raises IndexError
+class MappedColumn(Sequence):
+    lazy = True
+
+    def __init__(self, trip, i) -> None:
+        self.trip = trip
+        self.i = i
+
+    def __len__(self):
+        return len(self.trip)
+
+    def __getitem__(self, r):
+        if r < 0 or r >= len(self.trip):
+            raise IndexError(r)
+        bounds = self.trip._bounds(r + 1)
+        if len(bounds)//2 < len(self.trip.cols):
+            raise IndexError(r)
+        return self.trip.decodeField(bounds, self.i)
@@ -19,11 +19,19 @@
 #   Takes dict of keys/vals and makes a formatted payload message.
 # Implemented as factory pattern that allows for variations in message formatting.
 #
+#   A strategy can also be compiled once for a header (see compilePayload), giving a
+# callable that maps a sample straight to the formatted message with the same result
+# as building the strategy object for every sample.
+#
 
 from abc import ABC, abstractmethod
 import ast
 from dict_recursive_update import recursive_update
 import json
+import re
+import sys
+
+from ColumnTypes import CONVERTERS
 
 
 class MessagePayload(ABC):
@@ -33,15 +41,12 @@ class MessagePayload(ABC):
     #   Typically, the caller will only supply preDropKeys if any and 
     # subclasses would set the postDropKeys as needed.
     #
-    def __init__(self, d, config={'preDropKeys':[], 'postDropKeys':[]}) -> None:
+    def __init__(self, d, config=None) -> None:
+        config = {} if config is None else config
         self.payload = {}
-        self.preDropKeys = config.get('preDropKeys')
-        if self.preDropKeys is None:
-            self.preDropKeys = []
-        self.preDropKeys.append('') 
-        self.postDropKeys = config.get('postDropKeys')
-        if self.postDropKeys is None:
-            self.postDropKeys = []
+        # copies, the caller's lists (often straight from state) must not grow
+        self.preDropKeys = list(config.get('preDropKeys') or []) + ['']
+        self.postDropKeys = list(config.get('postDropKeys') or [])
         self._prepare_message(d)
 
     def _prepare_message(self, d):
@@ -57,13 +62,67 @@ class MessagePayload(ABC):
     def make_message(self, d):
         raise NotImplementedError("MessagePayload must be subclassed with an implementation of #prepare_message")
 
+    # keys of the header kept in the message, in sample order
+    @staticmethod
+    def _keptKeys(cols, dropKeys):
+        return [ k for k in dict.fromkeys(cols) if k not in dropKeys ]
+
+    # compile the strategy for samples with the columns cols
+    #   returns a callable: sample -> formatted message. Subclasses override this with
+    # a version that works the drops out once, this default builds the strategy per sample.
+    @classmethod
+    def compile(cls, cols, config=None, formatter=json.dumps):
+        config = {} if config is None else dict(config)
+        return lambda d: cls(d, config).message(formatter)
+
 # SimpleLabelled Strategy just returns the dict
 #   the dict is assumed to be structured with 'key': value
 # so no changes.
+#
+#   Unless configured with 'column_types' ({ key: kind } see ColumnTypes), which converts
+# the values, and 'omit_empty', which leaves out keys with empty values.
 class SimpleLabelledPayload(MessagePayload):
+    def __init__(self, d, config=None) -> None:
+        config = {} if config is None else config
+        self.column_types = config.get('column_types') or {}
+        self.omit_empty = config.get('omit_empty', False)
+        super().__init__(d, config)
+
     def make_message(self, d):
         # self.payload = d.copy()
-        pass
+        if not (self.column_types or self.omit_empty):
+            return
+        payload = {}
+        for k, v in self.payload.items():
+            v = CONVERTERS[self.column_types.get(k, 'str')](v) if self.column_types else v
+            if self.omit_empty and (v is None or v == ''):
+                continue
+            payload[k] = v
+        self.payload = payload
+
+    @classmethod
+    def compile(cls, cols, config=None, formatter=json.dumps):
+        config = {} if config is None else config
+        dropKeys = set(config.get('preDropKeys') or []) | set(config.get('postDropKeys') or []) | {''}
+        keys = cls._keptKeys(cols, dropKeys)
+        column_types = config.get('column_types') or {}
+        omit_empty = config.get('omit_empty', False)
+
+        if not (column_types or omit_empty):
+            def format(d):
+                return formatter({ k: d[k] for k in keys })
+            return format
+
+        converters = [ (k, CONVERTERS[column_types.get(k, 'str')] if column_types else None) for k in keys ]
+        def format(d):
+            payload = {}
+            for k, convert in converters:
+                v = d[k] if convert is None else convert(d[k])
+                if omit_empty and (v is None or v == ''):
+                    continue
+                payload[k] = v
+            return formatter(payload)
+        return format
     
 # DotLabelledPayload Strategy will expand any property labels with dots .. e.g. "a.b" 
 #   into a: { b }
@@ -88,35 +147,214 @@ class DotLabelledPayload(MessagePayload):
         self.payload = {}
         [ recursive_update(self.payload, self.dot_expand(key, d[key])) for key in d ]
 
+    # where dot_expand puts a key -- a trailing empty part doesn't nest
+    @staticmethod
+    def _path(k):
+        parts = k.split('.')
+        if len(parts) > 1 and parts[-1] == '':
+            return parts[:-1], len(parts)
+        return parts, len(parts)
+
+    # compiled into a tree of the header's keys, filled in place for each sample
+    #   headers where one key nests under another, or repeats, merge values the way
+    # recursive_update does, those keep building the strategy per sample
+    @classmethod
+    def compile(cls, cols, config=None, formatter=json.dumps):
+        config = {} if config is None else config
+        keys = cls._keptKeys(cols, set(config.get('preDropKeys') or []) | {''})
+        postDropKeys = set(config.get('postDropKeys') or [])
+
+        full = [ tuple(cls._path(k)[0]) for k in keys ]
+        prefixes = set(p[:i] for p in full for i in range(1, len(p)))
+        if len(set(full)) != len(full) or any(p in prefixes for p in full):
+            return super().compile(cols, config, formatter)
+
+        root = {}
+        leaves = []
+        for k, path in zip(keys, full):
+            if path[0] in postDropKeys:
+                continue
+            node = root
+            for p in path[:-1]:
+                node = node.setdefault(p, {})
+            node[path[-1]] = None
+            leaves.append((node, path[-1], k, _LiteralColumn(cls._path(k)[1])))
+
+        fills = [ (node, key, k, literal.convert) for (node, key, k, literal) in leaves ]
+
+        # the tree is reused for every sample, the formatter must not keep a reference to it
+        def format(d):
+            for node, key, k, convert in fills:
+                node[key] = convert(d[k])
+            return formatter(root)
+        return format
+
+
+# _LiteralColumn converts the values of one column as ast.literal_eval would in dot_expand
+#   the kind of column (numeric, literal or plain text) is decided from its first value,
+# every kind checks its fast path and falls back to literal_eval so results never differ
+_INT = re.compile(r'[-+]?(?:0|[1-9][0-9]*)')
+_FLOAT = re.compile(r'[-+]?(?:[0-9]+\.[0-9]*|\.[0-9]+|[0-9]+(?=[eE]))(?:[eE][-+]?[0-9]+)?')
+_LITERAL_START = set('0123456789.+-([{\'"\\')
+_LITERAL_NAMES = ('True', 'False', 'None')
+_STRING_PREFIXES = set('bBrRuUfF')
+
+class _LiteralColumn():
+    NUMERIC = 'numeric'
+    LITERAL = 'literal'
+    TEXT = 'text'
+
+    def __init__(self, depth) -> None:
+        # dot_expand evaluates the value again at every level of the key
+        self.depth = depth
+        self.kind = None
+
+    def _eval(self, v):
+        for i in range(self.depth):
+            try:
+                v = ast.literal_eval(v)
+            except Exception as e:
+                break
+        return v
+
+    @staticmethod
+    def _maybeLiteral(v):
+        s = v.lstrip()
+        if len(s) == 0:
+            return True
+        if s[0] in _LITERAL_START or s.startswith(_LITERAL_NAMES):
+            return True
+        return s[0] in _STRING_PREFIXES and ('"' in s[:3] or "'" in s[:3])
+
+    def _classify(self, v):
+        if not isinstance(v, str):
+            return self.LITERAL
+        if _INT.fullmatch(v) or _FLOAT.fullmatch(v):
+            return self.NUMERIC
+        return self.LITERAL if self._maybeLiteral(v) else self.TEXT
+
+    def convert(self, v):
+        if self.kind is None:
+            self.kind = self._classify(v)
+
+        if isinstance(v, str):
+            if self.kind == self.NUMERIC:
+                if _INT.fullmatch(v):
+                    return int(v)
+                if _FLOAT.fullmatch(v):
+                    return float(v)
+            elif self.kind == self.TEXT:
+                if not self._maybeLiteral(v):
+                    return v
+        return self._eval(v)
+
 # DynamicLabelledPayload takes apart the dict and builds the payload
 #   the dict is of the format 'name': metric, 'value': reading
 # and will be reformatted to 'metric': reading
 #
+#   rows pivoted by PivotReader hold lists of metrics and readings, and give
+# one 'metric': reading per pair
+#
 class DynamicLabelledPayload(MessagePayload):
-    def __init__(self, d, config={'metricKey':'status', 'readingKey':'value', 'value_transform_function': float}) -> None:
+    def __init__(self, d, config=None) -> None:
+        config = {} if config is None else dict(config)
         self.metricKey = config.get('metricKey', 'status')
         self.readingKey = config.get('readingKey', 'value')
         self.transform = config.get('value_transform_function', float)
 
-        pdk = config.get('postDropKeys', [])
-        pdk.extend([self.metricKey, self.readingKey])
-        config['postDropKeys'] = pdk
+        config['postDropKeys'] = self._postDropKeys(config)
 
         super().__init__(d, config)
 
+    @classmethod
+    def _postDropKeys(cls, config):
+        return list(config.get('postDropKeys') or []) + [config.get('metricKey', 'status'), config.get('readingKey', 'value')]
+
+    @classmethod
+    def compile(cls, cols, config=None, formatter=json.dumps):
+        config = {} if config is None else config
+        metricKey = config.get('metricKey', 'status')
+        readingKey = config.get('readingKey', 'value')
+        transform = config.get('value_transform_function', float)
+        postDropKeys = set(cls._postDropKeys(config))
+        keys = cls._keptKeys(cols, set(config.get('preDropKeys') or []) | postDropKeys | {''})
+
+        def format(d):
+            payload = { k: d[k] for k in keys }
+            try:
+                metrics = d[metricKey]
+                readings = d[readingKey]
+            except Exception as e:
+                print("key or value didn't exist")
+                return formatter(payload)
+
+            if not isinstance(metrics, list):
+                metrics = [ metrics ]
+                readings = [ readings ]
+            for metric, reading in zip(metrics, readings):
+                try:
+                    if metric not in postDropKeys:
+                        payload[metric] = transform(reading)
+                except Exception as e:
+                    print("key or value didn't exist")
+            return formatter(payload)
+        return format
+
     def make_message(self, d):
         try:
-            self.payload[d[self.metricKey]] = self.transform(d[self.readingKey])
+            metrics = d[self.metricKey]
+            readings = d[self.readingKey]
         except Exception as e:
             print("key or value didn't exist")
+            return
+
+        if not isinstance(metrics, list):
+            metrics = [ metrics ]
+            readings = [ readings ]
+        for metric, reading in zip(metrics, readings):
+            try:
+                self.payload[metric] = self.transform(reading)
+            except Exception as e:
+                print("key or value didn't exist")
 
 # UntimedDynamicLabelledPayload removes the timestamp from the payload
 #   
 class UntimedDynamicLabelledPayload(DynamicLabelledPayload):
-    def __init__(self, d, config={'metricKey':'status', 'readingKey':'value', 'time_col_name': 'timestamp'}) -> None:
+    def __init__(self, d, config=None) -> None:
+        config = {} if config is None else config
         self.time_col_name = config.get('time_col_name', 'timestamp')
-        pdk = config.get('postDropKeys', [])
-        pdk.extend([self.time_col_name])
-        config['postDropKeys'] = pdk
+        super().__init__(d, config)
+
+    @classmethod
+    def _postDropKeys(cls, config):
+        return super()._postDropKeys(config) + [config.get('time_col_name', 'timestamp')]
+
+
+_compiled = {}
+
+def _hashable(v):
+    if isinstance(v, list):
+        return tuple(v)
+    if isinstance(v, dict):
+        return tuple(sorted(v.items()))
+    return v
+
+def _asDict(payload):
+    return payload
 
-        super().__init__(d, config)
\ No newline at end of file
+# compiled formatter for the named strategy, shared by every caller with the same
+# header, config and formatter
+#   a stateful formatter (the delta encoder) is one per device, so it is applied to the
+# shared compiled dict builder rather than compiled in and kept forever
+def compilePayload(strategy_name, cols, config=None, formatter=json.dumps):
+    config = {} if config is None else config
+    stateful = getattr(formatter, 'stateful', False)
+    key = (strategy_name, tuple(cols), _asDict if stateful else formatter, tuple(sorted((k, _hashable(v)) for k, v in config.items())))
+    compiled = _compiled.get(key)
+    if compiled is None:
+        compiled = getattr(sys.modules[__name__], strategy_name).compile(cols, config, key[2])
+        _compiled[key] = compiled
+    if stateful:
+        build = compiled
+        return lambda d: formatter(build(d))
+    return compiled
\ No newline at end of file
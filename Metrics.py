@@ -0,0 +1,233 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Metrics
+#
+#   Process wide counters, gauges and latency summaries for the telemetry device, with
+# a Prometheus text endpoint and a periodic summary log line.
+#
+#   Recording is meant to be cheap enough for every row and message: look the metric
+# up once, then each record is an add under the counter's own lock
+# (Counter.inc) or a histogram record, which is locked the same way. The locks are
+# there because the connections' ack and spool threads record too.
+# Gauges are read from a callback when the metrics are scraped or logged.
+#
+#       rows = Metrics.counter('telemetry_rows_read_total', 'rows read from the trip')
+#       rows.inc()
+#
+#       Metrics.gauge('telemetry_inflight', 'messages waiting for PUBACK', lambda: len(inflight))
+#
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import threading
+import time
+
+from LatencyHistogram import LatencyHistogram
+
+logger = logging.getLogger("TelemetryThing.metrics")
+
+
+class Counter():
+    __slots__ = ('value', 'lock')
+
+    def __init__(self) -> None:
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+
+class Metric():
+    def __init__(self, name, help, kind) -> None:
+        self.name = name
+        self.help = help
+        self.kind = kind
+        # label tuple -> Counter, gauge callback or LatencyHistogram
+        self.children = {}
+
+    def total(self):
+        values = [ _value(self.kind, c) for c in self.children.values() ]
+        values = [ v for v in values if v is not None ]
+        return sum(values) if values else None
+
+
+def _value(kind, child):
+    if kind == 'counter':
+        return child.value
+    if kind == 'gauge':
+        try:
+            return child()
+        except Exception as e:
+            return None
+    return child.count
+
+
+registry = {}
+registry_lock = threading.Lock()
+
+def _child(name, help, kind, labels, make):
+    with registry_lock:
+        metric = registry.get(name)
+        if metric is None:
+            metric = registry[name] = Metric(name, help, kind)
+        key = tuple(sorted(labels.items())) if labels else ()
+        child = metric.children.get(key)
+        if child is None:
+            child = metric.children[key] = make()
+        return child
+
+# the same name and labels always give the same Counter
+def counter(name, help='', labels=None):
+    return _child(name, help, 'counter', labels, Counter)
+
+# fn() is called for the value when scraped, None leaves the gauge out
+#   registering the same name and labels again replaces the callback
+def gauge(name, help, fn, labels=None):
+    with registry_lock:
+        metric = registry.get(name)
+        if metric is None:
+            metric = registry[name] = Metric(name, help, 'gauge')
+        metric.children[tuple(sorted(labels.items())) if labels else ()] = fn
+
+# a LatencyHistogram, exported as a summary in seconds
+def histogram(name, help='', labels=None):
+    return _child(name, help, 'summary', labels, LatencyHistogram)
+
+def reset():
+    with registry_lock:
+        registry.clear()
+
+
+def _labelText(key, extra=()):
+    labels = list(key) + list(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+def _escape(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# all metrics in the Prometheus text exposition format
+def render():
+    lines = []
+    with registry_lock:
+        metrics = list(registry.values())
+    for m in sorted(metrics, key=lambda m: m.name):
+        lines.append(f"# HELP {m.name} {m.help}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        for key, child in list(m.children.items()):
+            if m.kind == 'summary':
+                for q in (50, 95, 99):
+                    v = child.percentile(q)
+                    if v is not None:
+                        lines.append(f"{m.name}{_labelText(key, [('quantile', q/100.0)])} {v}")
+                lines.append(f"{m.name}_sum{_labelText(key)} {child.total}")
+                lines.append(f"{m.name}_count{_labelText(key)} {child.count}")
+                continue
+            v = _value(m.kind, child)
+            if v is not None:
+                lines.append(f"{m.name}{_labelText(key)} {v}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# serve /metrics on a daemon thread
+def startHttpServer(port, addr='127.0.0.1'):
+    server = ThreadingHTTPServer((addr, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True)
+    thread.start()
+    logger.info(f"metrics at http://{addr}:{server.server_address[1]}/metrics")
+    return server
+
+
+# one line with every metric's total, counters with their rate since the last line
+class SummaryLog():
+    def __init__(self, interval, log=logger) -> None:
+        self.interval = interval
+        self.log = log
+        self.last = {}
+        self.last_time = time.monotonic()
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def line(self):
+        now = time.monotonic()
+        elapsed = max(now - self.last_time, 1e-9)
+        with registry_lock:
+            metrics = list(registry.values())
+        parts = []
+        for m in sorted(metrics, key=lambda m: m.name):
+            name = m.name.replace('telemetry_', '', 1)
+            if m.kind == 'summary':
+                h = LatencyHistogram.merged(m.children.values())
+                p50, p95, p99 = h.percentile(50), h.percentile(95), h.percentile(99)
+                if p50 is not None:
+                    parts.append(f"{name} p50={p50*1000:.1f}ms p95={p95*1000:.1f}ms p99={p99*1000:.1f}ms")
+                continue
+            v = m.total()
+            if v is None:
+                continue
+            if m.kind == 'counter':
+                rate = (v - self.last.get(m.name, 0))/elapsed
+                self.last[m.name] = v
+                parts.append(f"{name}={v} ({rate:.1f}/s)")
+            else:
+                parts.append(f"{name}={v:g}")
+        self.last_time = now
+        return " ".join(parts)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.log.info(self.line())
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='metrics-log', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+
+# start what the config asks for -- metrics_port for the endpoint, metrics_log_interval for the log line
+def startFromConfig(config, log=logger):
+    port = config.get('metrics_port')
+    if port is not None:
+        try:
+            startHttpServer(int(port), config.get('metrics_addr', '127.0.0.1'))
+        except OSError as e:
+            log.error(f"metrics endpoint not started on port {port}: {e}")
+    interval = config.get('metrics_log_interval')
+    if interval:
+        SummaryLog(interval, log).start()
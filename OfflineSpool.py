@@ -0,0 +1,330 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# OfflineSpool
+#
+#   Persistent, in order store of messages that could not be published. Messages are
+# appended to a log split into segment files in one directory
+#
+#       0000000000000001.seg  0000000000000002.seg ...  cursor
+#
+# each record is
+#
+#       length:uint32  crc32:uint32  qos:uint8  is_text:uint8  topic_length:uint16  topic  payload
+#
+# where length and the crc cover everything after the crc. Appends are flushed to the
+# OS at once and fsync'ed every fsync_records records or fsync_interval seconds.
+#
+#   Records are read in order with next() and acknowledged with ack(). The oldest
+# record not acked is the ack cursor, saved in `cursor` -- after a crash the spool
+# resumes from there, so a message may be sent twice but is not lost. A segment is
+# deleted once all of its records are acked. rewind() sends everything not acked
+# again, after losing a connection. Past max_bytes the oldest segment is dropped.
+#
+
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+logger = logging.getLogger("TelemetryThing.spool")
+
+RECORD_HEADER = struct.Struct('<II')
+RECORD_META = struct.Struct('<BBH')
+SEGMENT_SUFFIX = '.seg'
+CURSOR_FILE = 'cursor'
+
+
+class OfflineSpool():
+    def __init__(self, path, max_bytes=256*1024*1024, segment_bytes=4*1024*1024, fsync_interval=1.0, fsync_records=100) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.fsync_records = fsync_records
+
+        self.lock = threading.RLock()
+        self.stats = { 'appended': 0, 'sent': 0, 'acked': 0, 'rewinds': 0, 'dropped': 0, 'fsyncs': 0, 'truncated_bytes': 0 }
+
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    def _segmentPath(self, seg):
+        return os.path.join(self.path, f"{seg:016d}{SEGMENT_SUFFIX}")
+
+    # find the segments, repair a torn write at the end and restore the cursor
+    def _load(self):
+        self.segments = sorted([ int(f[:-len(SEGMENT_SUFFIX)]) for f in os.listdir(self.path)
+                                    if f.endswith(SEGMENT_SUFFIX) and f[:-len(SEGMENT_SUFFIX)].isdigit() ])
+        # seg -> [records, bytes]
+        self.sizes = {}
+        for seg in self.segments:
+            self.sizes[seg] = self._scan(seg)
+
+        if not self.segments:
+            self.segments = [1]
+            self.sizes[1] = [0, 0]
+        self.write_seg = self.segments[-1]
+        self.file = open(self._segmentPath(self.write_seg), 'ab')
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+        cursor = self._readCursor()
+        if cursor is None or cursor[0] not in self.sizes:
+            cursor = (self.segments[0], 0)
+        self.ack_cursor = cursor
+        self.send_cursor = cursor
+        self.saved_cursor = cursor
+        # (seg, offset) of records sent and not acked, in the order sent
+        self.unacked = {}
+        # acked past the ack cursor, out of order -- skipped when a rewind sends again
+        self.acked = set()
+        self.unsent = self._countFrom(cursor)
+        self.reader = None
+        self.reader_seg = None
+
+    # count a segment's records, cutting it at the first one that is short or corrupt
+    def _scan(self, seg):
+        path = self._segmentPath(seg)
+        records = 0
+        good = 0
+        with open(path, 'rb') as f:
+            while True:
+                record = self._readRecord(f)
+                if record is None:
+                    break
+                records += 1
+                good = f.tell()
+        size = os.path.getsize(path)
+        if size > good:
+            logger.warning(f"spool segment {path} truncated from {size} to {good} bytes")
+            self.stats['truncated_bytes'] += size - good
+            with open(path, 'r+b') as f:
+                f.truncate(good)
+        return [records, good]
+
+    def _readRecord(self, f):
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return None
+        length, crc = RECORD_HEADER.unpack(header)
+        body = f.read(length)
+        if len(body) < length or zlib.crc32(body) != crc or length < RECORD_META.size:
+            return None
+        qos, is_text, topic_length = RECORD_META.unpack_from(body)
+        start = RECORD_META.size
+        topic = body[start:start + topic_length].decode('utf-8')
+        payload = body[start + topic_length:]
+        return (topic, payload.decode('utf-8') if is_text else payload, qos)
+
+    def _countFrom(self, cursor):
+        seg, offset = cursor
+        return sum([ self.sizes[s][0] for s in self.segments if s > seg ]) + self._countInSegment(seg, offset)
+
+    def _countInSegment(self, seg, offset):
+        if offset == 0:
+            return self.sizes[seg][0]
+        count = 0
+        with open(self._segmentPath(seg), 'rb') as f:
+            f.seek(offset)
+            while self._readRecord(f) is not None:
+                count += 1
+        return count
+
+    def _readCursor(self):
+        try:
+            with open(os.path.join(self.path, CURSOR_FILE)) as f:
+                c = json.load(f)
+            return (int(c['segment']), int(c['offset']))
+        except (OSError, ValueError, KeyError) as e:
+            return None
+
+    def _saveCursor(self):
+        if self.ack_cursor == self.saved_cursor:
+            return
+        tmp = os.path.join(self.path, CURSOR_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({ 'segment': self.ack_cursor[0], 'offset': self.ack_cursor[1] }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, CURSOR_FILE))
+        self.saved_cursor = self.ack_cursor
+
+    def append(self, topic, payload, qos=1):
+        is_text = isinstance(payload, str)
+        body = payload.encode('utf-8') if is_text else bytes(payload)
+        topic_bytes = topic.encode('utf-8')
+        record = RECORD_META.pack(qos, 1 if is_text else 0, len(topic_bytes)) + topic_bytes + body
+
+        with self.lock:
+            if self.sizes[self.write_seg][1] > 0 and self.sizes[self.write_seg][1] + len(record) > self.segment_bytes:
+                self._roll()
+            self.file.write(RECORD_HEADER.pack(len(record), zlib.crc32(record)) + record)
+            self.file.flush()
+            self.sizes[self.write_seg][0] += 1
+            self.sizes[self.write_seg][1] += RECORD_HEADER.size + len(record)
+            self.unsent += 1
+            self.stats['appended'] += 1
+
+            self.unsynced += 1
+            if self.unsynced >= self.fsync_records or time.monotonic() - self.last_sync >= self.fsync_interval:
+                self.sync()
+            self._enforceLimit()
+
+    # make everything appended so far durable, and save the cursor
+    def sync(self):
+        with self.lock:
+            if self.unsynced:
+                os.fsync(self.file.fileno())
+                self.stats['fsyncs'] += 1
+            self.unsynced = 0
+            self.last_sync = time.monotonic()
+            self._saveCursor()
+
+    def _roll(self):
+        self.sync()
+        self.file.close()
+        self.write_seg += 1
+        self.segments.append(self.write_seg)
+        self.sizes[self.write_seg] = [0, 0]
+        self.file = open(self._segmentPath(self.write_seg), 'ab')
+
+    def diskBytes(self):
+        return sum([ s[1] for s in self.sizes.values() ])
+
+    # drop the oldest segments, sent or not, to stay under max_bytes
+    def _enforceLimit(self):
+        while self.max_bytes is not None and len(self.segments) > 1 and self.diskBytes() > self.max_bytes:
+            seg = self.segments[0]
+            for p in [ p for p in self.unacked if p[0] == seg ]:
+                del self.unacked[p]
+            self.acked = { p for p in self.acked if p[0] != seg }
+            lost = 0
+            if self.send_cursor[0] == seg:
+                lost = self._countInSegment(seg, self.send_cursor[1])
+                self.unsent -= lost
+                self.send_cursor = (self.segments[1], 0)
+            self.stats['dropped'] += lost
+            logger.warning(f"spool over {self.max_bytes} bytes, dropped {lost} unsent messages")
+            self._deleteSegment(seg)
+            self._advanceAckCursor()
+
+    def _deleteSegment(self, seg):
+        if self.reader_seg == seg:
+            self._closeReader()
+        self.segments.remove(seg)
+        del self.sizes[seg]
+        try:
+            os.remove(self._segmentPath(seg))
+        except OSError as e:
+            logger.warning(f"could not remove spool segment {seg}: {e}")
+
+    def _closeReader(self):
+        if self.reader is not None:
+            self.reader.close()
+        self.reader = None
+        self.reader_seg = None
+
+    # records appended and not yet handed out by next()
+    def pending(self):
+        return self.unsent
+
+    def unackedCount(self):
+        return len(self.unacked)
+
+    # the next record to send, (position, topic, payload, qos), or None
+    #   ack(position) once the broker has it
+    def next(self):
+        with self.lock:
+            while self.unsent > 0:
+                seg, offset = self.send_cursor
+                if self.reader_seg != seg:
+                    self._closeReader()
+                    self.reader = open(self._segmentPath(seg), 'rb')
+                    self.reader_seg = seg
+                self.reader.seek(offset)
+                record = self._readRecord(self.reader)
+                if record is None:
+                    i = self.segments.index(seg)
+                    if i + 1 >= len(self.segments):
+                        return None
+                    self.send_cursor = (self.segments[i + 1], 0)
+                    continue
+
+                position = self.send_cursor
+                self.send_cursor = (seg, self.reader.tell())
+                if position in self.acked:
+                    # the broker has it already, rewind didn't count it
+                    self.acked.discard(position)
+                    continue
+                self.unacked[position] = True
+                self.unsent -= 1
+                self.stats['sent'] += 1
+                topic, payload, qos = record
+                return (position, topic, payload, qos)
+            return None
+
+    def ack(self, position):
+        with self.lock:
+            if self.unacked.pop(position, None) is None:
+                return
+            self.stats['acked'] += 1
+            self.acked.add(position)
+            self._advanceAckCursor()
+
+    # everything sent and not acked goes out again, in order
+    def rewind(self):
+        with self.lock:
+            if not self.unacked:
+                return
+            self.stats['rewinds'] += 1
+            self.unacked = {}
+            self.send_cursor = self.ack_cursor
+            # records acked out of order are skipped, not sent again
+            self.unsent = self._countFrom(self.ack_cursor) - len(self.acked)
+
+    def _advanceAckCursor(self):
+        self.ack_cursor = next(iter(self.unacked)) if self.unacked else self.send_cursor
+        if self.acked:
+            self.acked = { p for p in self.acked if p >= self.ack_cursor }
+        # segments wholly before the ack cursor are done with
+        while self.segments[0] < self.ack_cursor[0]:
+            self._deleteSegment(self.segments[0])
+        if self.ack_cursor[0] == self.write_seg and self.unsent == 0 and not self.unacked and self.sizes[self.write_seg][1] > self.segment_bytes/2:
+            # drained, start over in a fresh segment
+            self._roll()
+            self.send_cursor = self.ack_cursor = (self.write_seg, 0)
+            self._deleteSegment(self.segments[0])
+        if time.monotonic() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self._closeReader()
+            self.file.close()
+
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['pending'] = self.unsent
+            stats['unacked'] = len(self.unacked)
+            stats['segments'] = len(self.segments)
+            stats['bytes'] = self.diskBytes()
+            return stats
@@ -0,0 +1,419 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# PayloadEncoding
+#
+#   Serializers for payloads, plugged in through MessagePayload.message(formatter) or a
+# compiled formatter. Selected with the 'payload_encoding' state key.
+#
+#   json            json.dumps, as always (default)
+#   json_fast       orjson if installed, otherwise compact json.dumps
+#   msgpack         MessagePack -- the msgpack package if installed, otherwise built in
+#   cbor            CBOR (RFC 8949) -- cbor2 if installed, otherwise built in
+#   delta           columnar frame of deltas from the previous message of the device,
+#                   see DeltaFrameEncoder
+#
+
+import json
+import math
+import struct
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+DEFAULT_KEYFRAME_INTERVAL = 50
+
+
+#
+# MessagePack
+#
+def _packMsgpack(obj, out):
+    if obj is None:
+        out.append(0xc0)
+    elif obj is True:
+        out.append(0xc3)
+    elif obj is False:
+        out.append(0xc2)
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            out.append(obj)
+        elif -0x20 <= obj < 0:
+            out.append(obj & 0xff)
+        elif obj > 0:
+            if obj <= 0xff:
+                out += struct.pack('>BB', 0xcc, obj)
+            elif obj <= 0xffff:
+                out += struct.pack('>BH', 0xcd, obj)
+            elif obj <= 0xffffffff:
+                out += struct.pack('>BI', 0xce, obj)
+            else:
+                out += struct.pack('>BQ', 0xcf, obj)
+        else:
+            if obj >= -0x80:
+                out += struct.pack('>Bb', 0xd0, obj)
+            elif obj >= -0x8000:
+                out += struct.pack('>Bh', 0xd1, obj)
+            elif obj >= -0x80000000:
+                out += struct.pack('>Bi', 0xd2, obj)
+            else:
+                out += struct.pack('>Bq', 0xd3, obj)
+    elif isinstance(obj, float):
+        out += struct.pack('>Bd', 0xcb, obj)
+    elif isinstance(obj, str):
+        b = obj.encode('utf-8')
+        n = len(b)
+        if n < 32:
+            out.append(0xa0 | n)
+        elif n <= 0xff:
+            out += struct.pack('>BB', 0xd9, n)
+        elif n <= 0xffff:
+            out += struct.pack('>BH', 0xda, n)
+        else:
+            out += struct.pack('>BI', 0xdb, n)
+        out += b
+    elif isinstance(obj, (bytes, bytearray)):
+        n = len(obj)
+        if n <= 0xff:
+            out += struct.pack('>BB', 0xc4, n)
+        elif n <= 0xffff:
+            out += struct.pack('>BH', 0xc5, n)
+        else:
+            out += struct.pack('>BI', 0xc6, n)
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        n = len(obj)
+        if n < 16:
+            out.append(0x90 | n)
+        elif n <= 0xffff:
+            out += struct.pack('>BH', 0xdc, n)
+        else:
+            out += struct.pack('>BI', 0xdd, n)
+        [ _packMsgpack(o, out) for o in obj ]
+    elif isinstance(obj, dict):
+        n = len(obj)
+        if n < 16:
+            out.append(0x80 | n)
+        elif n <= 0xffff:
+            out += struct.pack('>BH', 0xde, n)
+        else:
+            out += struct.pack('>BI', 0xdf, n)
+        for k, v in obj.items():
+            _packMsgpack(k, out)
+            _packMsgpack(v, out)
+    else:
+        raise TypeError(f"can't encode {type(obj)} as MessagePack")
+
+def packMsgpack(obj):
+    if msgpack is not None:
+        return msgpack.packb(obj, use_bin_type=True)
+    out = bytearray()
+    _packMsgpack(obj, out)
+    return bytes(out)
+
+def _unpackMsgpack(data, pos):
+    b = data[pos]
+    pos += 1
+    if b < 0x80:
+        return b, pos
+    if b >= 0xe0:
+        return b - 0x100, pos
+    if 0xa0 <= b <= 0xbf:
+        n = b & 0x1f
+        return data[pos:pos + n].decode('utf-8'), pos + n
+    if 0x90 <= b <= 0x9f:
+        return _unpackArray(data, pos, b & 0x0f)
+    if 0x80 <= b <= 0x8f:
+        return _unpackMap(data, pos, b & 0x0f)
+    if b == 0xc0:
+        return None, pos
+    if b == 0xc2:
+        return False, pos
+    if b == 0xc3:
+        return True, pos
+    fixed = { 0xcc: '>B', 0xcd: '>H', 0xce: '>I', 0xcf: '>Q', 0xd0: '>b', 0xd1: '>h', 0xd2: '>i', 0xd3: '>q',
+              0xca: '>f', 0xcb: '>d' }
+    if b in fixed:
+        fmt = fixed[b]
+        return struct.unpack_from(fmt, data, pos)[0], pos + struct.calcsize(fmt)
+    sized = { 0xd9: ('>B', 'str'), 0xda: ('>H', 'str'), 0xdb: ('>I', 'str'),
+              0xc4: ('>B', 'bin'), 0xc5: ('>H', 'bin'), 0xc6: ('>I', 'bin'),
+              0xdc: ('>H', 'array'), 0xdd: ('>I', 'array'), 0xde: ('>H', 'map'), 0xdf: ('>I', 'map') }
+    if b in sized:
+        fmt, kind = sized[b]
+        n = struct.unpack_from(fmt, data, pos)[0]
+        pos += struct.calcsize(fmt)
+        if kind == 'str':
+            return data[pos:pos + n].decode('utf-8'), pos + n
+        if kind == 'bin':
+            return bytes(data[pos:pos + n]), pos + n
+        if kind == 'array':
+            return _unpackArray(data, pos, n)
+        return _unpackMap(data, pos, n)
+    raise ValueError(f"unsupported MessagePack type 0x{b:02x}")
+
+def _unpackArray(data, pos, n):
+    items = []
+    for i in range(n):
+        item, pos = _unpackMsgpack(data, pos)
+        items.append(item)
+    return items, pos
+
+def _unpackMap(data, pos, n):
+    items = {}
+    for i in range(n):
+        k, pos = _unpackMsgpack(data, pos)
+        v, pos = _unpackMsgpack(data, pos)
+        items[k] = v
+    return items, pos
+
+def unpackMsgpack(data):
+    if msgpack is not None:
+        return msgpack.unpackb(data, raw=False)
+    obj, pos = _unpackMsgpack(data, 0)
+    return obj
+
+
+#
+# CBOR
+#
+def _cborHead(major, n, out):
+    if n < 24:
+        out.append((major << 5) | n)
+    elif n <= 0xff:
+        out += struct.pack('>BB', (major << 5) | 24, n)
+    elif n <= 0xffff:
+        out += struct.pack('>BH', (major << 5) | 25, n)
+    elif n <= 0xffffffff:
+        out += struct.pack('>BI', (major << 5) | 26, n)
+    else:
+        out += struct.pack('>BQ', (major << 5) | 27, n)
+
+def _packCbor(obj, out):
+    if obj is None:
+        out.append(0xf6)
+    elif obj is True:
+        out.append(0xf5)
+    elif obj is False:
+        out.append(0xf4)
+    elif isinstance(obj, int):
+        if obj >= 0:
+            _cborHead(0, obj, out)
+        else:
+            _cborHead(1, -1 - obj, out)
+    elif isinstance(obj, float):
+        out += struct.pack('>Bd', 0xfb, obj)
+    elif isinstance(obj, str):
+        b = obj.encode('utf-8')
+        _cborHead(3, len(b), out)
+        out += b
+    elif isinstance(obj, (bytes, bytearray)):
+        _cborHead(2, len(obj), out)
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        _cborHead(4, len(obj), out)
+        [ _packCbor(o, out) for o in obj ]
+    elif isinstance(obj, dict):
+        _cborHead(5, len(obj), out)
+        for k, v in obj.items():
+            _packCbor(k, out)
+            _packCbor(v, out)
+    else:
+        raise TypeError(f"can't encode {type(obj)} as CBOR")
+
+def packCbor(obj):
+    if cbor2 is not None:
+        return cbor2.dumps(obj)
+    out = bytearray()
+    _packCbor(obj, out)
+    return bytes(out)
+
+
+#
+# JSON
+#
+def fastJson(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'))
+
+
+#
+# Delta frames
+#
+def _isNumber(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+# DeltaFrameEncoder encodes the payloads of ONE device as MessagePack frames
+#
+#   frame = [ 1, flags, seq, fields, values ]
+#       1       format version
+#       flags   bit 0 set for a keyframe
+#       seq     frame counter of the device, wraps at 2**32
+#       fields  keyframe: list of the payload keys, in order -- delta frame: nil
+#       values  one entry per field
+#
+#   In a keyframe every value is absolute. In a delta frame, for a field whose previous
+# value was a number (int or float, not bool), a number entry is the delta to add to
+# the previous value and a one element array holds an absolute value instead (used when
+# the type changes or a float delta would not add back exactly). For any other field
+# the entry is the absolute value.
+#
+#   A keyframe is sent first, every keyframe_interval frames, and whenever the set of
+# keys changes, so a decoder that misses a frame (seq gap) recovers at the next one.
+#
+class DeltaFrameEncoder():
+    VERSION = 1
+    KEYFRAME = 0x01
+    # one per device, see MessagePayload.compilePayload
+    stateful = True
+
+    def __init__(self, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL) -> None:
+        self.keyframe_interval = max(int(keyframe_interval), 1)
+        self.fields = None
+        self.previous = None
+        self.seq = 0
+        self.since_keyframe = 0
+
+    def _delta(self, prev, cur):
+        if not _isNumber(prev):
+            return cur
+        if not _isNumber(cur):
+            return [ cur ]
+        if isinstance(prev, int) and isinstance(cur, int):
+            return cur - prev
+        d = cur - prev
+        # the decoder adds the delta back, only send it if that gives exactly cur
+        if not (isinstance(d, float) and math.isfinite(d)) or prev + d != cur or type(prev + d) is not type(cur):
+            return [ cur ]
+        return d
+
+    def encode(self, payload):
+        fields = list(payload.keys())
+        values = list(payload.values())
+
+        keyframe = (self.fields != fields) or (self.since_keyframe >= self.keyframe_interval)
+        if keyframe:
+            frame = [ self.VERSION, self.KEYFRAME, self.seq, fields, values ]
+            self.fields = fields
+            self.since_keyframe = 0
+        else:
+            frame = [ self.VERSION, 0, self.seq, None, [ self._delta(p, c) for p, c in zip(self.previous, values) ] ]
+
+        self.previous = values
+        self.seq = (self.seq + 1) & 0xffffffff
+        self.since_keyframe += 1
+        return packMsgpack(frame)
+
+    def __call__(self, payload):
+        return self.encode(payload)
+
+# DeltaFrameDecoder rebuilds the payloads of ONE device from its frames
+#   decode returns the payload dict, or None for a delta frame that can't be applied
+# because frames were lost -- decoding resumes at the next keyframe.
+class DeltaFrameDecoder():
+    def __init__(self) -> None:
+        self.fields = None
+        self.values = None
+        self.seq = None
+
+    def decode(self, data):
+        version, flags, seq, fields, values = unpackMsgpack(data)
+        if version != DeltaFrameEncoder.VERSION:
+            raise ValueError(f"unsupported delta frame version {version}")
+
+        if flags & DeltaFrameEncoder.KEYFRAME:
+            self.fields = fields
+            self.values = list(values)
+        else:
+            if self.values is None or seq != ((self.seq + 1) & 0xffffffff):
+                self.values = None
+                return None
+            current = []
+            for prev, entry in zip(self.values, values):
+                if _isNumber(prev):
+                    current.append(entry[0] if isinstance(entry, list) else prev + entry)
+                else:
+                    current.append(entry)
+            self.values = current
+
+        self.seq = seq
+        return dict(zip(self.fields, self.values))
+
+
+#
+# Arrays of encoded payloads, for batches
+#   the payloads are already encoded, only the array framing is added
+#
+def jsonArray(parts):
+    if len(parts) > 0 and isinstance(parts[0], (bytes, bytearray)):
+        return b'[' + b','.join(parts) + b']'
+    return '[' + ','.join(parts) + ']'
+
+def msgpackArray(parts):
+    out = bytearray()
+    n = len(parts)
+    if n < 16:
+        out.append(0x90 | n)
+    elif n <= 0xffff:
+        out += struct.pack('>BH', 0xdc, n)
+    else:
+        out += struct.pack('>BI', 0xdd, n)
+    [ out.extend(p) for p in parts ]
+    return bytes(out)
+
+def cborArray(parts):
+    out = bytearray()
+    _cborHead(4, len(parts), out)
+    [ out.extend(p) for p in parts ]
+    return bytes(out)
+
+# framing overhead of an array: bytes per element and at most for the header
+ARRAYS = {
+    'json': (jsonArray, 1, 2),
+    'json_fast': (jsonArray, 1, 2),
+    'msgpack': (msgpackArray, 0, 5),
+    'cbor': (cborArray, 0, 9),
+    'delta': (msgpackArray, 0, 5),
+}
+
+
+ENCODINGS = {
+    'json': lambda **config: json.dumps,
+    'json_fast': lambda **config: fastJson,
+    'msgpack': lambda **config: packMsgpack,
+    'cbor': lambda **config: packCbor,
+    'delta': lambda **config: DeltaFrameEncoder(config.get('keyframe_interval', DEFAULT_KEYFRAME_INTERVAL)),
+}
+
+# formatter for the named encoding
+#   stateful encodings (delta) give a new encoder per call, so make one per device
+def makeFormatter(name='json', **config):
+    try:
+        return ENCODINGS[name](**config)
+    except KeyError:
+        raise ValueError(f"unknown payload_encoding {name}, choose from {', '.join(ENCODINGS.keys())}")
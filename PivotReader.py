@@ -0,0 +1,111 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# PivotReader
+#
+#   Pivots long-format rows (one metric and one reading per row) into one wide sample
+# per timestamp. Consecutive rows whose time is within the tolerance of the first row
+# of the group are merged, the metric and reading columns of the merged sample hold
+# lists that DynamicLabelledPayload turns into one { metric: reading, ... } payload.
+#
+
+class PivotReader():
+    def __init__(self, reader, enabled=False, time_col_name='timestamp', metricKey='status', readingKey='value', tolerance=0.0):
+        self.reader = reader
+        self.pending = None
+        self.pending_index = None
+        self.at_eof = False
+        self.index = None
+        self.configure(enabled, time_col_name, metricKey, readingKey, tolerance)
+
+    def configure(self, enabled=False, time_col_name='timestamp', metricKey='status', readingKey='value', tolerance=0.0):
+        self.enabled = enabled
+        self.time_col_name = time_col_name
+        self.metricKey = metricKey
+        self.readingKey = readingKey
+        self.tolerance = float(tolerance or 0.0)
+
+    # everything else is the wrapped reader's
+    def __getattr__(self, name):
+        return getattr(self.reader, name)
+
+    def useFileURI(self, fileURI):
+        if self.reader.getFileURI() != fileURI:
+            self.pending = None
+            self.at_eof = False
+        self.reader.useFileURI(fileURI)
+
+    def reopen(self):
+        self.pending = None
+        self.at_eof = False
+        self.reader.reopen()
+
+    # swap in another reader, e.g. one a Prefetcher already opened
+    def useReader(self, reader):
+        self.pending = None
+        self.at_eof = False
+        self.reader.close()
+        self.reader = reader
+
+    # row number of the first row of the last sample
+    def getSampleIndex(self):
+        return self.index if self.enabled else self.reader.getSampleIndex()
+
+    def _sameTime(self, first, sample):
+        t0 = first.get(self.time_col_name)
+        t = sample.get(self.time_col_name)
+        if self.tolerance == 0.0:
+            return t == t0
+        try:
+            return abs(float(t) - float(t0)) <= self.tolerance
+        except (TypeError, ValueError) as e:
+            return t == t0
+
+    def getSample(self):
+        if not self.enabled:
+            return self.reader.getSample()
+
+        # the group before the end of the file was returned, now report the end
+        if self.at_eof:
+            self.at_eof = False
+            return {}
+
+        if self.pending is not None:
+            first, self.index = self.pending, self.pending_index
+            self.pending = None
+        else:
+            first = self.reader.getSample()
+            self.index = self.reader.getSampleIndex()
+        if len(first) == 0:
+            return first
+
+        metrics = [ first.get(self.metricKey) ]
+        readings = [ first.get(self.readingKey) ]
+        while True:
+            sample = self.reader.getSample()
+            if len(sample) == 0:
+                self.at_eof = True
+                break
+            if not self._sameTime(first, sample):
+                self.pending = sample
+                self.pending_index = self.reader.getSampleIndex()
+                break
+            metrics.append(sample.get(self.metricKey))
+            readings.append(sample.get(self.readingKey))
+
+        first[self.metricKey] = metrics
+        first[self.readingKey] = readings
+        return first
@@ -0,0 +1,118 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Playlist
+#
+#   An ordered or shuffled list of trip URIs, played one after the other with at_end
+# 'next', and a Prefetcher that loads the next ones in the background so the switch
+# to the next trip doesn't wait for a download or a parse.
+#
+#       playlist = Playlist(uris, order='shuffle')
+#       prefetcher.want(playlist.upcoming(2))
+#       ... at the end of the trip
+#       uri = playlist.advance()
+#       reader = prefetcher.take(uri)            # None if it wasn't prefetched
+#
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import random
+import threading
+
+ORDERS = ('ordered', 'shuffle')
+
+logger = logging.getLogger("TelemetryThing.playlist")
+
+
+class Playlist():
+    def __init__(self, uris, order='ordered', seed=None) -> None:
+        if order not in ORDERS:
+            raise ValueError(f"playlist_order must be one of {', '.join(ORDERS)}, not {order!r}")
+        if not uris:
+            raise ValueError("playlist is empty")
+        self.uris = list(uris)
+        self.order = order
+        self.random = random.Random(seed)
+        self.queue = deque()
+        self.current = self._pop()
+
+    # the same list and order
+    def isSame(self, uris, order):
+        return list(uris) == self.uris and order == self.order
+
+    # one pass over the list, a shuffle is new each pass
+    def _pass(self):
+        uris = list(self.uris)
+        if self.order == 'shuffle':
+            self.random.shuffle(uris)
+        return uris
+
+    def _pop(self):
+        if not self.queue:
+            self.queue.extend(self._pass())
+        return self.queue.popleft()
+
+    # the next count trips, without moving to them
+    def upcoming(self, count):
+        while len(self.queue) < count:
+            self.queue.extend(self._pass())
+        return [ self.queue[i] for i in range(count) ]
+
+    def advance(self):
+        self.current = self._pop()
+        return self.current
+
+
+# loads trips on one background thread, with load(uri) -> a reader, trip or anything else
+#   drop(loaded) is called for one that is no longer wanted
+class Prefetcher():
+    def __init__(self, load, drop=None) -> None:
+        self.load = load
+        self.drop = drop
+        self.lock = threading.Lock()
+        self.loads = {}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+
+    def _load(self, uri):
+        try:
+            return self.load(uri)
+        except Exception as e:
+            logger.warning(f"prefetching {uri} failed: {type(e)} {e}")
+            return None
+
+    # load the uris if not already, and forget the others
+    def want(self, uris):
+        with self.lock:
+            for uri in list(self.loads.keys()):
+                if uri not in uris:
+                    self._drop(self.loads.pop(uri))
+            for uri in uris:
+                if uri not in self.loads:
+                    self.loads[uri] = self.executor.submit(self._load, uri)
+
+    def _drop(self, future):
+        if future.cancel() or self.drop is None:
+            return
+        future.add_done_callback(lambda f: f.result() is not None and self.drop(f.result()))
+
+    # what was loaded for uri, waiting for it if still loading -- None if it wasn't wanted or failed
+    def take(self, uri):
+        with self.lock:
+            future = self.loads.pop(uri, None)
+        if future is None:
+            return None
+        return future.result()
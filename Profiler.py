@@ -0,0 +1,280 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Profiler
+#
+#   Profiles a running device on request, for when it is slow where no profiler can be
+# attached. A request comes in the 'profile' key of the state, usually from a shadow delta
+#
+#       { "mode": "cpu", "duration": 30, "id": "any" }
+#
+#   cpu       samples the replay thread's stack every 'interval' seconds (0.005), and
+#             writes the stacks in folded format, for flamegraph.pl or speedscope
+#   memory    traces allocations with tracemalloc, and writes the snapshot at the end
+#             (tracemalloc.Snapshot.load reads it)
+#   stages    times each stage of a row -- read, timestamp, format, topic, wait, publish
+#
+# The profile stops after 'duration' seconds, is written to profile_dir, and a summary is
+# passed to onResult -- the device reports it in the shadow as 'profile_result'. A new
+# request stops the one running, change the 'id' to run the same profile again.
+#
+#   Nothing runs while no profile is, stage timing is a check of Profiler.stages for None.
+#
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+from LatencyHistogram import LatencyHistogram
+
+MODES = ('cpu', 'memory', 'stages')
+MAX_FRAMES = 65535              # tracemalloc's limit on frames kept per allocation
+DEFAULT_DURATION = 30.0
+DEFAULT_INTERVAL = 0.005
+TOP = 5                         # entries in a summary, the shadow document is small
+
+logger = logging.getLogger("TelemetryThing.profiler")
+
+
+# raises ValueError unless request is a valid profile request
+def checkRequest(request):
+    if not isinstance(request, dict):
+        raise ValueError(f"profile must be an object, not {request!r}")
+    if request.get('mode') not in MODES:
+        raise ValueError(f"profile mode must be one of {', '.join(MODES)}, not {request.get('mode')!r}")
+    for k in ['duration', 'interval']:
+        v = request.get(k)
+        if v is not None and (not isinstance(v, (int, float)) or isinstance(v, bool) or v <= 0):
+            raise ValueError(f"profile {k} must be a positive number, not {v!r}")
+    frames = request.get('frames')
+    if frames is not None and (not isinstance(frames, int) or isinstance(frames, bool) or not 0 < frames <= MAX_FRAMES):
+        raise ValueError(f"profile frames must be a whole number from 1 to {MAX_FRAMES}, not {frames!r}")
+
+
+# time of each stage of a row, from one lap() to the next
+class StageTimer():
+    def __init__(self) -> None:
+        self.stages = {}
+        self.last = None
+
+    def begin(self):
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = LatencyHistogram()
+        histogram.record(now - self.last)
+        self.last = now
+
+    def getStats(self):
+        stats = { stage: h.getStats() for stage, h in self.stages.items() }
+        for stage, h in self.stages.items():
+            stats[stage]['total'] = h.total
+        return stats
+
+
+# samples one thread's stack from a thread of its own
+class StackSampler():
+    def __init__(self, thread_id, interval) -> None:
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.leaves = {}
+        self.samples = 0
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self._record(frame)
+            time.sleep(self.interval)
+
+    def _record(self, frame):
+        leaf = f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}:{frame.f_lineno}"
+        names = []
+        while frame is not None:
+            names.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+            frame = frame.f_back
+        stack = ";".join(reversed(names))
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.leaves[leaf] = self.leaves.get(leaf, 0) + 1
+        self.samples += 1
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+
+class Profiler():
+    def __init__(self, name, directory="/tmp", onResult=None) -> None:
+        self.name = name
+        self.directory = directory
+        self.onResult = onResult
+        self.lock = threading.Lock()
+
+        # the StageTimer while a stages profile runs, checked on every row
+        self.stages = None
+        self.request = None
+        self.running = None
+        self.sampler = None
+        self.memory_start = None
+        self.timer = None
+
+    # start request if it differs from the last one, called whenever the config changes
+    #   the cpu profile samples the calling thread
+    def configure(self, request):
+        if request == self.request:
+            return
+        self.request = request
+        self.stop()
+        if request is not None:
+            self.start(request)
+
+    #   a request that can't be started is reported as failed, the replay carries on
+    def start(self, request):
+        with self.lock:
+            try:
+                checkRequest(request)
+                mode = request['mode']
+                duration = request.get('duration') or DEFAULT_DURATION
+                self.running = { 'id': request.get('id'), 'mode': mode, 'status': 'running',
+                                    'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'duration': duration,
+                                    'monotonic': time.monotonic() }
+                if mode == 'cpu':
+                    self.sampler = StackSampler(threading.get_ident(), request.get('interval') or DEFAULT_INTERVAL)
+                elif mode == 'memory':
+                    tracemalloc.start(request.get('frames') or 1)
+                    self.memory_start = tracemalloc.take_snapshot()
+                else:
+                    self.stages = StageTimer()
+                self.timer = threading.Timer(duration, self.stop)
+                self.timer.daemon = True
+                self.timer.start()
+            except Exception as e:
+                logger.error(f"starting profile {request!r} failed: {e}")
+                self._abandon()
+                self._report({ 'id': request.get('id') if isinstance(request, dict) else None,
+                                'mode': request.get('mode') if isinstance(request, dict) else None,
+                                'status': 'failed', 'error': str(e) })
+                return
+        logger.info(f"{mode} profile started for {duration} sec")
+        self._report(self._status())
+
+    # undo a start that failed part way
+    def _abandon(self):
+        memory = self.running is not None and self.running['mode'] == 'memory'
+        self.running = None
+        self.stages = None
+        self.memory_start = None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
+        if memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def isRunning(self):
+        return self.running is not None
+
+    def _status(self):
+        return { k: v for k, v in self.running.items() if k != 'monotonic' }
+
+    # finish the running profile early or on time, writing it out
+    def stop(self):
+        with self.lock:
+            if self.running is None:
+                return
+            running = self.running
+            self.running = None
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            result = { k: v for k, v in running.items() if k != 'monotonic' }
+            result['status'] = 'done'
+            result['duration'] = round(time.monotonic() - running['monotonic'], 3)
+            stem = os.path.join(self.directory, f"{self.name}-{running['mode']}-{time.strftime('%Y%m%d-%H%M%S')}")
+            try:
+                if running['mode'] == 'cpu':
+                    result.update(self._stopCpu(stem))
+                elif running['mode'] == 'memory':
+                    result.update(self._stopMemory(stem))
+                else:
+                    result.update(self._stopStages(stem))
+            except Exception as e:
+                logger.error(f"writing {running['mode']} profile failed: {e}")
+                result['status'] = 'failed'
+                result['error'] = str(e)
+        logger.info(f"{running['mode']} profile done: {result.get('file')}")
+        self._report(result)
+
+    def _stopCpu(self, stem):
+        sampler = self.sampler
+        self.sampler = None
+        sampler.stop()
+
+        file = stem + ".folded"
+        with open(file, 'w') as f:
+            for stack, count in sorted(sampler.stacks.items(), key=lambda s: -s[1]):
+                f.write(f"{stack} {count}\n")
+        top = sorted(sampler.leaves.items(), key=lambda l: -l[1])[:TOP]
+        return { 'file': file, 'samples': sampler.samples,
+                    'top': [ { 'line': line, 'percent': round(100.0*count/sampler.samples, 1) } for line, count in top ] }
+
+    def _stopMemory(self, stem):
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        start = self.memory_start
+        self.memory_start = None
+
+        file = stem + ".tracemalloc"
+        snapshot.dump(file)
+        growth = snapshot.compare_to(start, 'lineno')[:TOP]
+        return { 'file': file, 'traced_bytes': current, 'peak_bytes': peak,
+                    'top': [ { 'line': str(s.traceback), 'bytes': s.size, 'growth_bytes': s.size_diff } for s in growth ] }
+
+    def _stopStages(self, stem):
+        stages = self.stages
+        self.stages = None
+
+        stats = stages.getStats()
+        file = stem + ".json"
+        with open(file, 'w') as f:
+            json.dump(stats, f, indent=2)
+        return { 'file': file,
+                    'stages': { stage: { 'count': s['count'], 'mean_ms': round(1000*s['mean'], 3) if s['mean'] is not None else None,
+                                            'p99_ms': round(1000*s['p99'], 3) if s['p99'] is not None else None }
+                                for stage, s in stats.items() } }
+
+    def _report(self, result):
+        if self.onResult is None:
+            return
+        try:
+            self.onResult(result)
+        except Exception as e:
+            logger.error(f"reporting profile failed: {e}")
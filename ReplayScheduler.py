@@ -0,0 +1,101 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# ReplayScheduler
+#
+#   Paces a replay against the monotonic clock. Each row is due at
+#       start + (timestamp - first timestamp)/time_warp
+# or, with a fixed rate, at start + n/(rate*time_warp). Time spent reading, formatting
+# and publishing is absorbed instead of added to every gap, so the replay doesn't drift.
+#
+#   A row that is late is sent at once, catching up. Once the replay is more than
+# max_lag seconds behind it gives up on the backlog and re-bases the timeline on now.
+# time_warp 'max' (or 0) sends as fast as possible.
+#
+
+import time
+
+
+class ReplayScheduler():
+    def __init__(self, time_warp=1.0, rate=None, max_lag=5.0, clock=time.monotonic, sleep=time.sleep) -> None:
+        self.clock = clock
+        self.sleep = sleep
+        self.stats = { 'rows': 0, 'late': 0, 'rebases': 0, 'lag_last': 0.0, 'lag_max': 0.0, 'lag_total': 0.0 }
+        self.configure(time_warp, rate, max_lag)
+
+    def configure(self, time_warp=1.0, rate=None, max_lag=5.0):
+        if time_warp in ('max', None) or float(time_warp) <= 0:
+            self.time_warp = None
+        else:
+            self.time_warp = float(time_warp)
+        self.rate = rate
+        self.max_lag = max_lag
+        self.reset()
+
+    # start a new timeline at the next row -- a new file, or the start of a repeat
+    def reset(self):
+        self.start = None
+        self.ts0 = None
+        self.count = 0
+
+    def _deadline(self, timestamp_s):
+        if self.start is None:
+            self.start = self.clock()
+            self.ts0 = timestamp_s
+        if self.time_warp is None:
+            return self.clock()
+        if self.rate is not None:
+            return self.start + self.count/(self.rate*self.time_warp)
+        return self.start + (timestamp_s - self.ts0)/self.time_warp
+
+    def _record(self, lag):
+        self.stats['rows'] += 1
+        self.stats['lag_last'] = lag
+        self.stats['lag_total'] += lag
+        if lag > self.stats['lag_max']:
+            self.stats['lag_max'] = lag
+        if lag > 0.001:
+            self.stats['late'] += 1
+        if self.max_lag is not None and lag > self.max_lag:
+            self.start += lag
+            self.stats['rebases'] += 1
+
+    # seconds until the row with timestamp_s is due, negative when it is late
+    #   record counts the row as sent now, for the lag statistics
+    def delay(self, timestamp_s, record=True):
+        d = self._deadline(timestamp_s) - self.clock()
+        if record:
+            self._record(max(-d, 0.0))
+            self.count += 1
+        return d
+
+    # seconds until the row after count rows is due, without counting it
+    def peek(self, timestamp_s):
+        return self.delay(timestamp_s, record=False)
+
+    # block until the row with timestamp_s is due
+    def wait(self, timestamp_s):
+        deadline = self._deadline(timestamp_s)
+        d = deadline - self.clock()
+        if d > 0:
+            self.sleep(d)
+        self._record(max(self.clock() - deadline, 0.0))
+        self.count += 1
+
+    def getStats(self):
+        stats = dict(self.stats)
+        stats['lag_mean'] = stats['lag_total']/stats['rows'] if stats['rows'] else 0.0
+        return stats
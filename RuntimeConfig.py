@@ -0,0 +1,151 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# RuntimeConfig
+#
+#   A snapshot of the settings the replay uses for every row, checked and compiled once
+# from the state dict, and never changed after. A shadow delta builds a new snapshot beside the
+# old one and swaps it in with a single assignment, so a loop holding a snapshot never
+# sees half of an update, and reads each setting as one attribute.
+#
+#       config = RuntimeConfig(state, thingName)     # ValueError if state is invalid
+#
+#   Anything that depends on the trip file as well -- the compiled payload strategy,
+# the timestamp column -- is still built where the file is opened.
+#
+
+import string
+import types
+
+import PayloadEncoding
+import MessagePayload
+import Playlist
+import Profiler
+import TImestampReader
+import TopicGenerator
+
+AT_END = ('stop', 'repeat', 'next')
+
+
+def _positive(name, value, allow_none=True):
+    if value is None and allow_none:
+        return None
+    try:
+        v = float(value)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"{name} must be a number, not {value!r}")
+    if v <= 0:
+        raise ValueError(f"{name} must be positive, not {value!r}")
+    return v
+
+
+class RuntimeConfig():
+    def __init__(self, state, thingName=None) -> None:
+        # a private copy, later changes to state don't leak in
+        s = types.MappingProxyType(dict(state))
+
+        self.state = s
+        self.file = s.get('file')
+        self.deviceid = s.get('deviceid', thingName)
+        self.time_col_name = s.get('time_col_name', 'Timestamp(ms)')
+        self.timestampReader = TImestampReader.makeTimestampReader(s)
+
+        at_end = s.get('at_end', 'stop')
+        if at_end not in AT_END:
+            raise ValueError(f"at_end must be one of {', '.join(AT_END)}, not {at_end!r}")
+        self.at_end = at_end
+
+        # trips to play in turn, the first in place of file
+        playlist = s.get('playlist')
+        if playlist is not None:
+            if isinstance(playlist, str) or not isinstance(playlist, (list, tuple)) or \
+                    not playlist or not all(isinstance(uri, str) for uri in playlist):
+                raise ValueError(f"playlist must be a list of file URIs, not {playlist!r}")
+            playlist = tuple(playlist)
+        elif at_end == 'next':
+            raise ValueError("at_end 'next' needs a playlist")
+        self.playlist = playlist
+        playlist_order = s.get('playlist_order', 'ordered')
+        if playlist_order not in Playlist.ORDERS:
+            raise ValueError(f"playlist_order must be one of {', '.join(Playlist.ORDERS)}, not {playlist_order!r}")
+        self.playlist_order = playlist_order
+        prefetch = s.get('playlist_prefetch', 2)
+        if not isinstance(prefetch, int) or prefetch < 0:
+            raise ValueError(f"playlist_prefetch must be a count, not {prefetch!r}")
+        self.playlist_prefetch = prefetch
+
+        # pacing
+        time_warp = s.get('time_warp', 1.0)
+        if time_warp not in ('max', 0):
+            time_warp = _positive('time_warp', time_warp, False)
+        self.time_warp = time_warp
+        self.rate = _positive('message_publish_rate', s.get('message_publish_rate'))
+        self.max_lag = _positive('max_lag', s.get('max_lag', 5.0))
+
+        # topic -- constant per device when the template only uses the deviceid
+        topic_strategy = getattr(TopicGenerator, s.get('topic_strategy', 'SimpleFormattedTopic'), None)
+        if not isinstance(topic_strategy, type) or not issubclass(topic_strategy, TopicGenerator.TopicGenerator):
+            raise ValueError(f"unknown topic_strategy {s.get('topic_strategy')!r}")
+        topic_name = s.get('topic_name', 'dt/cvra/{deviceid}/cardata')
+        self.topicGenerator = topic_strategy(topic_name)
+        topic = None
+        if topic_strategy is TopicGenerator.SimpleFormattedTopic:
+            try:
+                fields = { f for _, f, _, _ in string.Formatter().parse(topic_name) if f is not None }
+            except ValueError as e:
+                raise ValueError(f"topic_name {topic_name!r} is not a valid template: {e}")
+            if fields <= { 'deviceid' }:
+                topic = topic_name.format(deviceid=self.deviceid)
+        self.topic = topic
+
+        # payload
+        payload_strategy = s.get('payload_strategy', 'SimpleLabelledPayload')
+        strategy = getattr(MessagePayload, payload_strategy, None)
+        if not isinstance(strategy, type) or not issubclass(strategy, MessagePayload.MessagePayload):
+            raise ValueError(f"unknown payload_strategy {payload_strategy!r}")
+        self.payload_strategy = payload_strategy
+        encoding = s.get('payload_encoding', 'json')
+        if encoding not in PayloadEncoding.ENCODINGS:
+            raise ValueError(f"unknown payload_encoding {encoding!r}, choose from {', '.join(PayloadEncoding.ENCODINGS.keys())}")
+        self.payload_encoding = encoding
+        self.payload_config = types.MappingProxyType({
+            'preDropKeys': list(s.get('ignore_columns', [])),
+            'metricKey': s.get('measure_column'),
+            'readingKey': s.get('value_column'),
+            'time_col_name': s.get('time_col_name'),
+            'omit_empty': s.get('omit_empty', False)
+        })
+        self.infer_types = bool(s.get('infer_types', False))
+
+        self.batch_publish = bool(s.get('batch_publish', False))
+
+        # a profile to run, see Profiler.py
+        profile = s.get('profile')
+        if profile is not None:
+            Profiler.checkRequest(profile)
+        self.profile = profile
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    # the topic for a message, without formatting when it's the same for every message
+    def makeTopic(self, timestamp_ms):
+        if self.topic is not None:
+            return self.topic
+        return self.topicGenerator.make_topicname(deviceid=self.deviceid, timestamp_ms=timestamp_ms)
+
+    def getTopicArgs(self, timestamp_ms):
+        return { 'deviceid': self.deviceid, 'timestamp_ms': timestamp_ms }
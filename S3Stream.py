@@ -0,0 +1,187 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# S3Stream
+#
+#   Reads an S3 object as a text stream of ranged GETs, so the first rows can be replayed
+# as soon as the first range arrives instead of after the whole object is downloaded.
+# The next 'readahead' ranges are fetched in the background while the current one is
+# read, and with write through the ranges are written to the local copy as they are
+# read -- it is only put in place once the whole object has been read.
+#
+#   One client per endpoint is shared by the process, with its connection pool. Set the
+# endpoint_url to read from an S3 compatible server, e.g. minio on http://localhost:9000.
+#
+#       S3Stream.configure(endpoint_url=None, chunk_bytes=8*1024*1024, readahead=2, write_through=True)
+#       f = S3Stream.openText(bucket, key, cache_path)
+#
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import io
+import logging
+import os
+import threading
+
+import boto3
+from botocore.config import Config as BotoConfig
+
+DEFAULT_CHUNK_BYTES = 8*1024*1024
+DEFAULT_READAHEAD = 2
+
+logger = logging.getLogger("TelemetryThing.s3")
+
+settings = {
+    'endpoint_url': None,
+    'chunk_bytes': DEFAULT_CHUNK_BYTES,
+    'readahead': DEFAULT_READAHEAD,
+    'write_through': True,
+    'max_pool_connections': 10,
+}
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def configure(endpoint_url=None, chunk_bytes=DEFAULT_CHUNK_BYTES, readahead=DEFAULT_READAHEAD, write_through=True, max_pool_connections=10):
+    if int(chunk_bytes) <= 0:
+        raise ValueError(f"chunk_bytes must be positive, not {chunk_bytes!r}")
+    settings.update({ 'endpoint_url': endpoint_url, 'chunk_bytes': int(chunk_bytes), 'readahead': max(int(readahead), 1),
+                        'write_through': bool(write_through), 'max_pool_connections': int(max_pool_connections) })
+
+def configureFromState(state):
+    configure(endpoint_url=state.get('s3_endpoint_url'),
+                chunk_bytes=state.get('s3_chunk_bytes', DEFAULT_CHUNK_BYTES),
+                readahead=state.get('s3_readahead', DEFAULT_READAHEAD),
+                write_through=state.get('s3_write_through', True))
+
+# the process wide client for endpoint_url (the configured one by default), boto3 clients are thread safe
+def getClient(endpoint_url=None):
+    endpoint_url = endpoint_url if endpoint_url is not None else settings['endpoint_url']
+    with _clients_lock:
+        client = _clients.get(endpoint_url)
+        if client is None:
+            client = boto3.client('s3', endpoint_url=endpoint_url,
+                                    config=BotoConfig(max_pool_connections=settings['max_pool_connections']))
+            _clients[endpoint_url] = client
+        return client
+
+
+# the object's bytes, as a raw stream of ranged GETs
+class S3RangeReader(io.RawIOBase):
+    def __init__(self, bucket, key, client=None, chunk_bytes=None, readahead=None, cache_path=None) -> None:
+        super().__init__()
+        self.bucket = bucket
+        self.key = key
+        self.client = client if client is not None else getClient()
+        self.chunk_bytes = chunk_bytes or settings['chunk_bytes']
+        self.readahead = readahead or settings['readahead']
+
+        head = self.client.head_object(Bucket=bucket, Key=key)
+        self.size = head['ContentLength']
+        # every range comes from the same version of the object
+        self.etag = head.get('ETag')
+
+        self.executor = ThreadPoolExecutor(max_workers=self.readahead, thread_name_prefix="s3-readahead")
+        self.pending = deque()
+        self.next_offset = 0
+        self.chunk = memoryview(b'')
+        self.pos = 0
+        self.read_bytes = 0
+
+        self.cache_path = cache_path
+        self.cache = None
+        if cache_path is not None:
+            try:
+                os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+                self.cache = open(self._partPath(), 'wb')
+            except OSError as e:
+                logger.warning(f"not writing s3://{bucket}/{key} through to {cache_path}: {e}")
+
+        self._fill()
+
+    def _partPath(self):
+        return f"{self.cache_path}.{os.getpid()}.part"
+
+    def _getRange(self, start, end):
+        args = { 'Bucket': self.bucket, 'Key': self.key, 'Range': f"bytes={start}-{end}" }
+        if self.etag is not None:
+            args['IfMatch'] = self.etag
+        return self.client.get_object(**args)['Body'].read()
+
+    def _fill(self):
+        while len(self.pending) < self.readahead and self.next_offset < self.size:
+            end = min(self.next_offset + self.chunk_bytes, self.size) - 1
+            self.pending.append(self.executor.submit(self._getRange, self.next_offset, end))
+            self.next_offset = end + 1
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.pos >= len(self.chunk):
+            if not self.pending:
+                return 0
+            data = self.pending.popleft().result()
+            self._fill()
+            self.chunk = memoryview(data)
+            self.pos = 0
+            self.read_bytes += len(data)
+            self._writeThrough(data)
+
+        n = min(len(b), len(self.chunk) - self.pos)
+        b[:n] = self.chunk[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def _writeThrough(self, data):
+        if self.cache is None:
+            return
+        try:
+            self.cache.write(data)
+            if self.read_bytes >= self.size:
+                self.cache.close()
+                self.cache = None
+                os.replace(self._partPath(), self.cache_path)
+        except OSError as e:
+            logger.warning(f"stopped writing s3://{self.bucket}/{self.key} through to {self.cache_path}: {e}")
+            self._dropCache()
+
+    def _dropCache(self):
+        if self.cache is None:
+            return
+        try:
+            self.cache.close()
+            os.remove(self._partPath())
+        except OSError as e:
+            pass
+        self.cache = None
+
+    def close(self):
+        if not self.closed:
+            for f in self.pending:
+                f.cancel()
+            self.pending.clear()
+            self.executor.shutdown(wait=False)
+            # a partial copy is no copy
+            self._dropCache()
+        super().close()
+
+
+# the object as text, read like an open file
+def openText(bucket, key, cache_path=None, client=None, encoding='utf-8'):
+    raw = S3RangeReader(bucket, key, client=client, cache_path=cache_path if settings['write_through'] else None)
+    return io.TextIOWrapper(io.BufferedReader(raw, buffer_size=64*1024), encoding=encoding)
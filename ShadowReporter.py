@@ -0,0 +1,162 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# ShadowReporter
+#
+#   Reports the device state to its shadow as a diff. It remembers the reported document
+# the shadow last accepted, and sends only the keys that changed since, with None (null)
+# for a key that was removed -- the shadow merges the update into what it holds.
+#
+#   report() only takes a copy of the state. Changes within debounce seconds of each
+# other are coalesced into one update, sent from a timer thread with at most one update
+# waiting for an answer. An update that times out or can't be sent is tried again.
+#
+
+import copy
+import logging
+import threading
+
+logger = logging.getLogger("TelemetryThing.shadow")
+
+
+# the update that turns reported into state, nested objects diffed key by key
+def diffState(reported, state):
+    diff = {}
+    for k, v in state.items():
+        old = reported.get(k)
+        if isinstance(v, dict) and isinstance(old, dict):
+            d = diffState(old, v)
+            if d:
+                diff[k] = d
+        elif v != old or type(v) != type(old):
+            diff[k] = v
+    for k in reported:
+        if k not in state:
+            diff[k] = None
+    return diff
+
+# what the shadow holds after merging update into reported
+def applyDiff(reported, update):
+    merged = dict(reported)
+    for k, v in update.items():
+        if v is None:
+            merged.pop(k, None)
+        elif isinstance(v, dict) and isinstance(merged.get(k), dict):
+            merged[k] = applyDiff(merged[k], v)
+        else:
+            merged[k] = v
+    return merged
+
+
+class ShadowReporter():
+    def __init__(self, connection, debounce=1.0) -> None:
+        self.connection = connection
+        self.debounce = debounce
+        self.lock = threading.Lock()
+
+        self.reported = {}          # as last accepted by the shadow
+        self.state = {}             # as last given to report
+        self.extra = {}             # reported beside the state, see setExtra
+        self.latest = None          # state waiting to be reported
+        self.sending = None         # update waiting for an answer
+        self.timer = None
+        self.stats = { 'reports': 0, 'updates': 0, 'accepted': 0, 'failed': 0, 'keys_sent': 0 }
+
+    # report state, soon -- cheap enough to call on the telemetry path
+    def report(self, state):
+        snapshot = copy.deepcopy(state)
+        with self.lock:
+            self.state = snapshot
+            self.latest = dict(snapshot, **self.extra)
+            self.stats['reports'] += 1
+            self._schedule()
+
+    # report key: value beside every state, until set to None -- for what isn't config, like a profile result
+    def setExtra(self, key, value):
+        value = copy.deepcopy(value)
+        with self.lock:
+            if value is None:
+                self.extra.pop(key, None)
+            else:
+                self.extra[key] = value
+            self.latest = dict(self.state, **self.extra)
+            self._schedule()
+
+    def _schedule(self):
+        if self.timer is None and self.sending is None:
+            self.timer = threading.Timer(self.debounce, self._send)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _send(self):
+        with self.lock:
+            self.timer = None
+            if self.latest is None or self.sending is not None:
+                return
+            update = diffState(self.reported, self.latest)
+            self.latest = None
+            if not update:
+                return
+            self.sending = update
+
+        try:
+            sent = self.connection.updateShadow(update, self._answered)
+        except ConnectionError as e:
+            sent = False
+
+        with self.lock:
+            self.stats['updates'] += 1
+            self.stats['keys_sent'] += len(update)
+            if not sent:
+                self._failed(update)
+
+    # called on the shadow client's thread
+    def _answered(self, payload, responseStatus, token):
+        with self.lock:
+            update = self.sending
+            if update is None:
+                return
+            if responseStatus == 'accepted':
+                self.reported = applyDiff(self.reported, update)
+                self.stats['accepted'] += 1
+            elif responseStatus == 'rejected':
+                # sending it again won't help, wait for the next change
+                logger.warning(f"shadow update rejected: {payload}")
+                self.stats['failed'] += 1
+            else:
+                self._failed(update)
+                return
+            self.sending = None
+            if self.latest is not None:
+                self._schedule()
+
+    # report what failed again, unless something newer is waiting
+    def _failed(self, update):
+        self.stats['failed'] += 1
+        self.sending = None
+        if self.latest is None:
+            self.latest = applyDiff(self.reported, update)
+        self._schedule()
+
+    def getReported(self):
+        with self.lock:
+            return copy.deepcopy(self.reported)
+
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['pending'] = self.latest is not None or self.sending is not None
+            return stats
@@ -18,10 +18,144 @@
 #
 #   A few strategies for extracting/creating a timestamp from a string or number
 #
+#   A reader converts the values of the time column to epoch milliseconds, either
+# one value at a time or a whole column in one pass so the replay loop only has
+# to index precomputed integers. A lazy column (MappedTrip's) is converted a value at
+# a time as rows are replayed instead, so opening the trip doesn't read all of it.
+#
+
+from abc import ABC, abstractmethod
+from array import array
+from collections.abc import Sequence
+from datetime import datetime
+
+DEFAULT_SAMPLE_DURATION_MS = 1000
 
-from abc import ABC, abstractclassmethod
+# formats that datetime.fromisoformat parses far faster than strptime
+ISO_FORMATS = {
+    '%Y-%m-%d': False,
+    '%Y-%m-%d %H:%M:%S': False,
+    '%Y-%m-%dT%H:%M:%S': False,
+    '%Y-%m-%d %H:%M:%S.%f': True,
+    '%Y-%m-%dT%H:%M:%S.%f': True,
+}
+
+MEMO_LIMIT = 4096
 
 class TimestampReader(ABC):
     # timestamp_format is the parse format for strings,
-    def __init__(self, timestamp_format, scale=1.0 ) -> None:
-        
\ No newline at end of file
+    #   scale is units/second of numeric stamps, offset is added to numeric stamps
+    def __init__(self, timestamp_format, scale=1.0, offset=0.0) -> None:
+        self.timestamp_format = timestamp_format
+        self.scale = float(scale)
+        self.offset = offset
+
+    @abstractmethod
+    def getTimestampMS(self, value):
+        raise NotImplementedError("TimestampReader must be subclassed with an implementation of #getTimestampMS")
+
+    # convert a whole column in one pass
+    #   returns None if any value can't be converted, so the caller can fall back to
+    # the per row conversion and surface the error for the row that has it
+    def getTimestampsMS(self, values):
+        try:
+            return array('q', [ self.getTimestampMS(v) for v in values ])
+        except (ValueError, TypeError, OverflowError) as e:
+            return None
+
+    # the timestamps of a column -- converted in one pass, or as they are read for a lazy column
+    def getColumnTimestampsMS(self, column):
+        if getattr(column, 'lazy', False):
+            return LazyTimestamps(self, column)
+        return self.getTimestampsMS(column)
+
+
+# timestamps of a lazy column, each converted when its row is asked for
+class LazyTimestamps(Sequence):
+    def __init__(self, reader, column) -> None:
+        self.reader = reader
+        self.column = column
+
+    def __len__(self):
+        return len(self.column)
+
+    def __getitem__(self, r):
+        return self.reader.getTimestampMS(self.column[r])
+
+# NumericTimestampReader for stamps that are numbers of seconds (or scaled units)
+#
+class NumericTimestampReader(TimestampReader):
+    def getTimestampMS(self, value):
+        return int((float(value) + self.offset)/self.scale*1000)
+
+    def getTimestampsMS(self, values):
+        offset = self.offset
+        scale = self.scale
+        try:
+            return array('q', [ int((float(v) + offset)/scale*1000) for v in values ])
+        except (ValueError, TypeError, OverflowError) as e:
+            return None
+
+# FormattedTimestampReader parses string stamps with timestamp_format
+#   ISO-8601 formats go through fromisoformat, and parsed values are memoized since
+# many rows often share one stamp
+class FormattedTimestampReader(TimestampReader):
+    def __init__(self, timestamp_format, scale=1.0, offset=0.0) -> None:
+        super().__init__(timestamp_format, scale, offset)
+        self.iso = timestamp_format in ISO_FORMATS
+        self.iso_fraction = ISO_FORMATS.get(timestamp_format, False)
+        self.memo = {}
+
+    def _parse(self, value):
+        if self.iso:
+            try:
+                dt = datetime.fromisoformat(value)
+                # only trust the fast path when strptime would have accepted the same text
+                if dt.tzinfo is None and (self.iso_fraction == ('.' in value)):
+                    return dt
+            except (ValueError, TypeError) as e:
+                pass
+        return datetime.strptime(value, self.timestamp_format)
+
+    def getTimestampMS(self, value):
+        timestamp_ms = self.memo.get(value)
+        if timestamp_ms is None:
+            timestamp_ms = int(self._parse(value).timestamp()*1000)
+            if len(self.memo) >= MEMO_LIMIT:
+                self.memo.clear()
+            self.memo[value] = timestamp_ms
+        return timestamp_ms
+
+    def getTimestampsMS(self, values):
+        parsed = {}
+        result = array('q')
+        try:
+            for v in values:
+                timestamp_ms = parsed.get(v)
+                if timestamp_ms is None:
+                    timestamp_ms = int(self._parse(v).timestamp()*1000)
+                    parsed[v] = timestamp_ms
+                result.append(timestamp_ms)
+        except (ValueError, TypeError, OverflowError) as e:
+            return None
+        return result
+
+
+_readers = {}
+
+# reader for the timestamp settings in state -- one instance per distinct setting
+#   the defaults match telemetryThing's
+def makeTimestampReader(state):
+    timestamp_format = state.get('timestamp_format')
+    scale = float(state.get('time_scale', 1000.0))
+    offset = state.get('timestamp_offset', 0.0)
+
+    key = (timestamp_format, scale, offset)
+    reader = _readers.get(key)
+    if reader is None:
+        if timestamp_format is None:
+            reader = NumericTimestampReader(timestamp_format, scale, offset)
+        else:
+            reader = FormattedTimestampReader(timestamp_format, scale, offset)
+        _readers[key] = reader
+    return reader
@@ -0,0 +1,100 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Transport
+#
+#   Where GreengrassAwareConnection gets its MQTT client, shadow client and discovery
+# provider. AWSIoTTransport makes the real ones from v1 of the Python SDK, LocalTransport
+# makes in-process stand-ins with the same methods, for testing without AWS.
+#
+#   The SDK's exceptions are re-exported from here, so a stand-in raises the same classes
+# the connection catches. Without the SDK installed only the local transport works.
+#
+
+import logging
+import time
+
+try:
+    from AWSIoTPythonSDK.core.greengrass.discovery.providers import DiscoveryInfoProvider
+    from AWSIoTPythonSDK.core.protocol.connection.cores import ProgressiveBackOffCore
+    from AWSIoTPythonSDK.exception.AWSIoTExceptions import DiscoveryFailure, DiscoveryInvalidRequestException, publishQueueFullException
+    from AWSIoTPythonSDK.exception.AWSIoTExceptions import publishError
+    from AWSIoTPythonSDK.core.protocol.paho.client import MQTT_ERR_SUCCESS
+    from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient, AWSIoTMQTTShadowClient, DROP_OLDEST
+    HAS_SDK = True
+except ImportError as e:
+    HAS_SDK = False
+    DROP_OLDEST = 0
+    MQTT_ERR_SUCCESS = 0
+
+    class SDKException(Exception):
+        def __init__(self, message="") -> None:
+            super().__init__(message)
+            self.message = message
+
+    class DiscoveryFailure(SDKException):
+        pass
+
+    class DiscoveryInvalidRequestException(SDKException):
+        pass
+
+    class publishQueueFullException(SDKException):
+        pass
+
+    class publishError(SDKException):
+        pass
+
+    class ProgressiveBackOffCore():
+        def __init__(self) -> None:
+            self.backoff = 1
+
+        def backOff(self):
+            time.sleep(self.backoff)
+            self.backoff = min(self.backoff*2, 32)
+
+logger = logging.getLogger("GreengrassAwareConnection.transport")
+
+
+class AWSIoTTransport():
+    # real sockets -- endpoints can be raced and discovery cached
+    local = False
+
+    def __init__(self) -> None:
+        if not HAS_SDK:
+            raise ImportError("AWSIoTPythonSDK is not installed, only TRANSPORT 'local' can be used")
+
+    def makeDiscoveryInfoProvider(self):
+        return DiscoveryInfoProvider()
+
+    def makeClient(self, clientId):
+        return AWSIoTMQTTClient(clientId)
+
+    def makeShadowClient(self, clientId):
+        return AWSIoTMQTTShadowClient(clientId)
+
+    def makeBackOffCore(self):
+        return ProgressiveBackOffCore()
+
+
+# the transport named by config['TRANSPORT'], 'aws' (default) or 'local'
+def makeTransport(config):
+    name = config.get('TRANSPORT', 'aws')
+    if name == 'aws':
+        return AWSIoTTransport()
+    if name == 'local':
+        import LocalTransport
+        return LocalTransport.LocalTransport(LocalTransport.getBroker(config))
+    raise ValueError(f"unknown TRANSPORT {name}, choose from aws, local")
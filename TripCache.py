@@ -0,0 +1,301 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# TripCache
+#
+#   Compiles a trip CSV into a compact binary columnar cache stored next to the file.
+# Numeric columns are kept as typed arrays, text columns as indexes into a string
+# dictionary. A cache is only used while the size and mtime of its source match.
+#
+#   Cache file layout
+#       b'TRPC'                 magic
+#       uint32 (little endian)  length of the JSON header
+#       JSON header             cols, row count, source stat, per column kind/offset/size
+#       column data             raw array bytes, offsets relative to the end of the header
+#
+
+from array import array
+import json
+import os
+import stat
+import struct
+import sys
+
+CACHE_SUFFIX = '.tripcache'
+MAGIC = b'TRPC'
+VERSION = 1
+
+INT_MIN = -(2**63)
+INT_MAX = 2**63 - 1
+
+# column kinds
+#   values are only stored typed when converting them back gives the original text,
+# so samples served from the cache are identical to those read from the CSV
+INT = 'int'
+FLOAT = 'float'
+STRING = 'str'
+
+
+def _isInt(v):
+    try:
+        i = int(v)
+        return str(i) == v and INT_MIN <= i <= INT_MAX
+    except ValueError:
+        return False
+
+def _isFloat(v):
+    try:
+        return repr(float(v)) == v
+    except ValueError:
+        return False
+
+def _columnKind(values):
+    present = [ v for v in values if v != '' ]
+    if len(present) == 0:
+        return STRING
+    if all(_isInt(v) for v in present):
+        return INT
+    if all(_isFloat(v) for v in present):
+        return FLOAT
+    return STRING
+
+
+class TripCache():
+    def __init__(self, cols, kinds, data, nulls, dictionaries, nrows, source, record_separator=",", quote_records=False):
+        self.cols = cols
+        self.kinds = kinds
+        self.data = data
+        self.nulls = nulls
+        self.dictionaries = dictionaries
+        self.nrows = nrows
+        self.source = source
+        self.record_separator = record_separator
+        self.quote_records = quote_records
+        self._columns = None
+        self._nullable = []
+
+    @staticmethod
+    def cachePath(path):
+        return path + CACHE_SUFFIX
+
+    @staticmethod
+    def isCacheable(path):
+        # pipes and other streams can only be read once
+        try:
+            return stat.S_ISREG(os.stat(path).st_mode)
+        except OSError:
+            return False
+
+    @staticmethod
+    def _sourceStat(path):
+        st = os.stat(path)
+        return { 'size': st.st_size, 'mtime_ns': st.st_mtime_ns }
+
+    # return the cache for the CSV at path, compiling it if missing or stale
+    @classmethod
+    def getCache(cls, path, record_separator=",", quote_records=False):
+        cache = cls.load(path, record_separator, quote_records)
+        if cache is None:
+            cache = cls.compile(path, record_separator, quote_records)
+            try:
+                cache.save(path)
+            except OSError as e:
+                print(f'unable to write trip cache for {path}: {e}')
+        return cache
+
+    @classmethod
+    def compile(cls, path, record_separator=",", quote_records=False):
+        source = cls._sourceStat(path)
+        with open(path, 'r') as f:
+            cols = f.readline().rstrip().split(record_separator)
+            if quote_records:
+                cols = [ c.strip('"') for c in cols ]
+
+            # same row rules as FileReader -- a short row ends the file
+            ncols = len(cols)
+            columns = [ [] for c in cols ]
+            for lineCSV in f:
+                line = lineCSV.rstrip().split(record_separator)
+                if len(line) < ncols:
+                    break
+                if quote_records:
+                    line = [ c.strip('"') for c in line ]
+                for i in range(ncols):
+                    columns[i].append(line[i])
+
+        nrows = len(columns[0]) if ncols > 0 else 0
+        kinds = []
+        data = []
+        nulls = []
+        dictionaries = []
+        for values in columns:
+            kind = _columnKind(values)
+            mask = bytearray(v == '' for v in values) if '' in values else bytearray()
+            dictionary = []
+            if kind == INT:
+                a = array('q', [ int(v) if v != '' else 0 for v in values ])
+            elif kind == FLOAT:
+                a = array('d', [ float(v) if v != '' else 0.0 for v in values ])
+            else:
+                index = {}
+                for v in values:
+                    if v not in index:
+                        index[v] = len(dictionary)
+                        dictionary.append(v)
+                a = array('I', [ index[v] for v in values ])
+                mask = bytearray()
+            kinds.append(kind)
+            data.append(a)
+            nulls.append(mask)
+            dictionaries.append(dictionary)
+
+        return cls(cols, kinds, data, nulls, dictionaries, nrows, source, record_separator, quote_records)
+
+    def save(self, path):
+        blobs = []
+        offset = 0
+        columns = []
+        for i in range(len(self.cols)):
+            d = self.data[i].tobytes()
+            n = bytes(self.nulls[i])
+            columns.append({
+                'kind': self.kinds[i],
+                'typecode': self.data[i].typecode,
+                'offset': offset, 'nbytes': len(d),
+                'nulls_offset': offset + len(d), 'nulls_nbytes': len(n),
+                'dictionary': self.dictionaries[i]
+            })
+            blobs.extend([d, n])
+            offset += len(d) + len(n)
+
+        header = json.dumps({
+            'version': VERSION,
+            'byteorder': sys.byteorder,
+            'source': self.source,
+            'record_separator': self.record_separator,
+            'quote_records': self.quote_records,
+            'cols': self.cols,
+            'nrows': self.nrows,
+            'columns': columns
+        }).encode('utf-8')
+
+        # write beside the final name and rename so readers never see a partial cache
+        cachePath = self.cachePath(path)
+        tmpPath = f"{cachePath}.{os.getpid()}.tmp"
+        with open(tmpPath, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            [ f.write(b) for b in blobs ]
+        os.replace(tmpPath, cachePath)
+
+    @classmethod
+    def load(cls, path, record_separator=",", quote_records=False):
+        cachePath = cls.cachePath(path)
+        try:
+            with open(cachePath, 'rb') as f:
+                if f.read(4) != MAGIC:
+                    return None
+                (hlen,) = struct.unpack('<I', f.read(4))
+                header = json.loads(f.read(hlen).decode('utf-8'))
+                if (header.get('version') != VERSION
+                        or header.get('source') != cls._sourceStat(path)
+                        or header.get('record_separator') != record_separator
+                        or header.get('quote_records') != quote_records):
+                    return None
+                body = f.read()
+        except (OSError, ValueError, struct.error):
+            return None
+
+        kinds = []
+        data = []
+        nulls = []
+        dictionaries = []
+        for c in header['columns']:
+            a = array(c['typecode'])
+            a.frombytes(body[c['offset']:c['offset'] + c['nbytes']])
+            if header['byteorder'] != sys.byteorder:
+                a.byteswap()
+            kinds.append(c['kind'])
+            data.append(a)
+            nulls.append(bytearray(body[c['nulls_offset']:c['nulls_offset'] + c['nulls_nbytes']]))
+            dictionaries.append(c['dictionary'])
+
+        return cls(header['cols'], kinds, data, nulls, dictionaries, header['nrows'],
+                    header['source'], record_separator, quote_records)
+
+    # is this cache still current for the CSV at path
+    def isValidFor(self, path):
+        try:
+            return self._sourceStat(path) == self.source
+        except OSError:
+            return False
+
+    def __len__(self):
+        return self.nrows
+
+    # per column (data, to text), and the columns with empty numbers
+    #   made once per cache, a row is then decoded on its own -- no text copy of the trip is kept
+    def _textColumns(self):
+        if self._columns is None:
+            columns = []
+            for i in range(len(self.cols)):
+                kind = self.kinds[i]
+                if kind == STRING:
+                    columns.append((self.data[i], self.dictionaries[i].__getitem__))
+                else:
+                    columns.append((self.data[i], str if kind == INT else repr))
+            self._nullable = [ i for i in range(len(self.cols)) if self.kinds[i] != STRING and self.nulls[i] ]
+            self._columns = columns
+        return self._columns
+
+    # the value of column i in row r as int, float or str -- None for an empty number
+    def _value(self, i, r):
+        kind = self.kinds[i]
+        if kind == STRING:
+            return self.dictionaries[i][self.data[i][r]]
+        if self.nulls[i] and self.nulls[i][r]:
+            return None
+        return self.data[i][r]
+
+    # sample dict for row r, identical to FileReader's parse of the same line
+    def getSample(self, r):
+        if r < 0 or r >= self.nrows:
+            raise IndexError(r)
+        values = [ text(data[r]) for data, text in self._textColumns() ]
+        for i in self._nullable:
+            if self.nulls[i][r]:
+                values[i] = ''
+        return dict(zip(self.cols, values))
+
+    # typed values for row r, in column order
+    def getRow(self, r):
+        if r < 0 or r >= self.nrows:
+            raise IndexError(r)
+        return [ self._value(i, r) for i in range(len(self.cols)) ]
+
+    # every value of the named column, typed -- None if there is no such column
+    def getColumn(self, name):
+        if name not in self.cols:
+            return None
+        # a repeated column name reads its last field, as in the sample dict
+        i = len(self.cols) - 1 - self.cols[::-1].index(name)
+        if self.kinds[i] == STRING:
+            dictionary = self.dictionaries[i]
+            return [ dictionary[x] for x in self.data[i] ]
+        if self.nulls[i]:
+            return [ None if n else v for v, n in zip(self.data[i], self.nulls[i]) ]
+        return self.data[i]
@@ -36,6 +36,8 @@ state = {
 
     # Select a Strategy from MessagePayload.py to define how to format a payload from the record
     'payload_strategy': 'SimpleLabelledPayload',
+    'infer_types': True,
+    'omit_empty': True,
 
     # Topic to publish messages, different payload_strategies may need different templates using local vars
     'topic_name': "vt/cvra/{deviceid}/cardata/{timestamp_ms}",
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# dot_payload.py
+#
+#   Compares DotLabelledPayload built per sample with the compiled formatter on wide,
+# generated records. Every message is checked to be byte-identical before timing.
+#
+#   python3 benchmarks/dot_payload.py [--rows 2000] [--groups 20] [--repeat 5]
+#
+
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import MessagePayload
+
+
+# header of dotted keys, groups of nested metrics plus a few plain and literal columns
+def makeHeader(groups):
+    cols = [ 'Timestamp(ms)', 'VehId', 'l' ]
+    for g in range(groups):
+        cols.extend([ f"g{g}.t", f"g{g}.h", f"g{g}.s.x", f"g{g}.s.y", f"g{g}.name" ])
+    return cols
+
+def makeRecords(cols, rows, seed=42):
+    rnd = random.Random(seed)
+    cells = [ {'c':{'o':'AT&T', 'a':[{'i':1704310, 'l':56986, 'c':310, 'n':410}]}},
+              {'c':{'o':'AT&T', 'a':[{'i':1707951, 'l':56986, 'c':310, 'n':410}]}} ]
+    records = []
+    for r in range(rows):
+        values = []
+        for c in cols:
+            if c == 'Timestamp(ms)':
+                values.append(str(r*1000))
+            elif c == 'VehId':
+                values.append('465')
+            elif c == 'l':
+                values.append(str(rnd.choice(cells)))
+            elif c.endswith('.name'):
+                values.append(rnd.choice([ 'ICE', 'HEV', 'NO DATA', '007', 'True', ' 5', "'quoted'" ]))
+            elif c.endswith('.y'):
+                values.append(rnd.choice([ str(rnd.randint(-50, 50)), '', '1e3', '-0.0' ]))
+            else:
+                values.append(repr(rnd.normalvariate(20.0, 5.0)))
+        records.append(dict(zip(cols, values)))
+    return records
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    cols = makeHeader(args.groups)
+    records = makeRecords(cols, args.rows)
+    config = { 'preDropKeys': [] }
+
+    def perSample():
+        return [ MessagePayload.DotLabelledPayload(dict(r), config).message(json.dumps) for r in records ]
+
+    compiled = MessagePayload.DotLabelledPayload.compile(cols, config, json.dumps)
+    def perCompiled():
+        return [ compiled(dict(r)) for r in records ]
+
+    if perSample() != perCompiled():
+        print("compiled DotLabelledPayload output differs")
+        sys.exit(1)
+
+    result = { 'rows': args.rows, 'columns': len(cols) }
+    for name, fn in [ ('per_sample', perSample), ('compiled', perCompiled) ]:
+        best = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+        result[name] = { 'seconds': best, 'rows_per_second': args.rows/best }
+    result['speedup'] = result['per_sample']['seconds']/result['compiled']['seconds']
+
+    print(json.dumps(result, indent=2))
+
+if __name__ == "__main__":
+    run()
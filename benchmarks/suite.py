@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+# suite.py
+#
+#   Benchmarks of the telemetry pipeline, on the files shipped in the repo --
+#       stages      FileReader.getSample on OBDII_Capture.csv and the VED-Sample trips,
+#                   reading lines, from a TripCache and mapped
+#       payload     each MessagePayload strategy, per sample and compiled, and the
+#                   json / json_fast encoders
+#       end_to_end  rows through telemetryThing.do_something, publishing to the local
+#                   transport with no PUBACK delay
+#
+#   Each result is the best of --repeat runs, as rows per second. Results are printed
+# as JSON (or written to --output), and a saved result can be given as --baseline to
+# report each benchmark against it -- the run fails when one is more than --tolerance
+# slower.
+#
+#   python3 benchmarks/suite.py [--only stages,payload,end_to_end] [--repeat 5]
+#                               [--output results.json] [--baseline baseline.json] [--tolerance 0.1]
+#
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import Config
+from FileReader import FileReader
+import MessagePayload
+import PayloadEncoding
+from RuntimeConfig import RuntimeConfig
+
+PARTS = [ 'stages', 'payload', 'end_to_end' ]
+
+# the trips read, and how
+DATASETS = {
+    'obdii': { 'file': 'OBDII_Capture.csv', 'record_separator': ';', 'quote_records': True },
+    'ved_988': { 'file': 'VED-Sample/988_465.csv', 'record_separator': ',', 'quote_records': False },
+    'ved_2117': { 'file': 'VED-Sample/2117_465.csv', 'record_separator': ',', 'quote_records': False },
+}
+
+# each strategy on the trip it is meant for, with that trip's settings
+STRATEGIES = [
+    ('SimpleLabelledPayload', 'ved_988', { 'time_col_name': 'Timestamp(ms)', 'ignore_columns': [] }),
+    ('DotLabelledPayload', 'ved_988', { 'time_col_name': 'Timestamp(ms)', 'ignore_columns': [] }),
+    ('DynamicLabelledPayload', 'obdii', {}),
+    ('UntimedDynamicLabelledPayload', 'obdii', {}),
+]
+
+
+def best(fn, repeat):
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+def result(rows, seconds):
+    return { 'rows': rows, 'seconds': seconds, 'rows_per_second': rows/seconds }
+
+
+# copies of the trips in a scratch directory, so the caches written beside them stay out of the repo
+def stageData(workdir):
+    for d in DATASETS.values():
+        dst = os.path.join(workdir, d['file'])
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copyfile(os.path.join(ROOT, d['file']), dst)
+
+def makeReader(workdir, dataset, mode):
+    d = DATASETS[dataset]
+    return FileReader(f"file:///{d['file']}", local_dir=workdir,
+                        record_separator=d['record_separator'], quote_records=d['quote_records'],
+                        use_cache=(mode == 'cache'), use_mmap=(mode == 'mmap'))
+
+def readAll(workdir, dataset, mode):
+    reader = makeReader(workdir, dataset, mode)
+    return [ reader.getSample() for r in range(countRows(workdir, dataset)) ]
+
+_row_counts = {}
+def countRows(workdir, dataset):
+    if dataset not in _row_counts:
+        with open(os.path.join(workdir, DATASETS[dataset]['file'])) as f:
+            _row_counts[dataset] = sum(1 for line in f) - 1
+    return _row_counts[dataset]
+
+
+def benchStages(workdir, repeat):
+    results = {}
+    for dataset in DATASETS:
+        rows = countRows(workdir, dataset)
+        for mode in [ 'stream', 'cache', 'mmap' ]:
+            # the first read compiles the cache, replays after it load it
+            readAll(workdir, dataset, mode)
+            results[f"stages.{dataset}.{mode}"] = result(rows, best(lambda: readAll(workdir, dataset, mode), repeat))
+    return results
+
+def benchPayload(workdir, repeat):
+    results = {}
+    for strategy, dataset, settings in STRATEGIES:
+        d = DATASETS[dataset]
+        config = RuntimeConfig(dict(Config.state, payload_strategy=strategy, **settings), 'bench').payload_config
+        cols = makeReader(workdir, dataset, 'stream').cols
+        samples = readAll(workdir, dataset, 'stream')
+        cls = getattr(MessagePayload, strategy)
+
+        def perSample():
+            return [ cls(dict(s), dict(config)).message(json.dumps) for s in samples ]
+        compiled = MessagePayload.compilePayload(strategy, cols, dict(config), json.dumps)
+        def perCompiled():
+            return [ compiled(dict(s)) for s in samples ]
+
+        if perSample() != perCompiled():
+            print(f"compiled {strategy} output differs", file=sys.stderr)
+            sys.exit(1)
+        results[f"payload.{strategy}.per_sample"] = result(len(samples), best(perSample, repeat))
+        results[f"payload.{strategy}.compiled"] = result(len(samples), best(perCompiled, repeat))
+
+    # serializing the records of a wide trip
+    samples = readAll(workdir, 'ved_988', 'stream')
+    for encoding in [ 'json', 'json_fast' ]:
+        encode = PayloadEncoding.makeFormatter(encoding)
+        results[f"payload.encode.{encoding}"] = result(len(samples), best(lambda: [ encode(s) for s in samples ], repeat))
+    return results
+
+# telemetryThing connects when imported, so this runs once per process
+def benchEndToEnd(workdir, repeat, rows):
+    Config.state.update({
+        'local_dir': workdir,
+        'file': f"file:///{DATASETS['obdii']['file']}",
+        'time_warp': 'max',
+        'at_end': 'repeat',
+        'metrics_log_interval': 0,
+        'TRANSPORT': 'local',
+        'LOCAL_PUBACK_LATENCY': 0.0,
+        'GROUP_CA_PATH': os.path.join(workdir, 'groupCA'),
+    })
+    sys.argv = [ 'telemetryThing.py', '-e', 'localhost', '-r', 'none', '-n', 'bench', '-t', 'local' ]
+    import logging
+    logging.getLogger("GreengrassAwareConnection").setLevel(logging.WARNING)
+    import telemetryThing
+    telemetryThing.logger.setLevel(logging.WARNING)
+
+    def replay():
+        for r in range(rows):
+            # at the end of the trip it starts over, the pause it asks for is skipped
+            telemetryThing.do_something()
+
+    replay()
+    return { 'end_to_end.obdii.do_something': result(rows, best(replay, repeat)) }
+
+
+# each benchmark against the baseline, returns the names of those more than tolerance slower
+def compare(results, baseline, tolerance):
+    regressions = []
+    print(f"{'benchmark':<48} {'baseline':>12} {'current':>12} {'change':>8}", file=sys.stderr)
+    for name, r in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<48} {'-':>12} {r['rows_per_second']:>12.0f}", file=sys.stderr)
+            continue
+        change = r['rows_per_second']/base['rows_per_second'] - 1.0
+        flag = ''
+        if change < -tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:<48} {base['rows_per_second']:>12.0f} {r['rows_per_second']:>12.0f} {change:>+8.1%}{flag}", file=sys.stderr)
+    return regressions
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", default=",".join(PARTS), help="comma separated parts to run, from " + ", ".join(PARTS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--rows", type=int, default=5000, help="rows replayed by end_to_end")
+    parser.add_argument("--output", help="write the results to this file as well")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="fraction slower than the baseline that counts as a regression")
+    args = parser.parse_args()
+
+    parts = [ p.strip() for p in args.only.split(",") if p.strip() ]
+    for p in parts:
+        if p not in PARTS:
+            parser.error(f"unknown part {p}, choose from {', '.join(PARTS)}")
+
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="telemetry-bench-")
+    try:
+        stageData(workdir)
+        if 'stages' in parts:
+            results.update(benchStages(workdir, args.repeat))
+        if 'payload' in parts:
+            results.update(benchPayload(workdir, args.repeat))
+        if 'end_to_end' in parts:
+            results.update(benchEndToEnd(workdir, args.repeat, args.rows))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'benchmarks': results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['benchmarks']
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} benchmarks more than {args.tolerance:.0%} slower than {args.baseline}", file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# fleetThing
+#
+#   Runs a fleet of simulated vehicles from one process. See samples/fleet.json
+# for the format of the fleet file.
+#
+
+import argparse
+import json
+import logging
+
+from Fleet import Fleet, Vehicle, expandVehicles, makeVehicleState
+from GreengrassAwareConnection import *
+import Metrics
+from Observer import ObservableDeepArray
+import LocalCache
+import S3Stream
+
+#  defaults for every vehicle
+from Config import state
+
+# Configure logging
+logger = logging.getLogger("TelemetryThing")
+logger.setLevel(logging.INFO)
+streamHandler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+streamHandler.setFormatter(formatter)
+logger.addHandler(streamHandler)
+
+# Read in command-line parameters
+parser = argparse.ArgumentParser()
+
+parser.add_argument("-e", "--endpoint", action="store", required=True, dest="host", help="Your AWS IoT custom endpoint")
+parser.add_argument("-r", "--rootCA", action="store", required=True, dest="rootCAPath", help="Root CA file path")
+parser.add_argument("-c", "--cert", action="store", dest="certificatePath", help="Default certificate file path")
+parser.add_argument("-k", "--key", action="store", dest="privateKeyPath", help="Default private key file path")
+parser.add_argument("-f", "--fleet", action="store", required=True, dest="fleetPath", help="Fleet definition file")
+parser.add_argument("-t", "--transport", action="store", dest="transport", choices=["aws", "local"], help="'local' to publish to an in-process broker instead of AWS IoT")
+
+args = parser.parse_args()
+if args.transport is not None:
+    state['TRANSPORT'] = args.transport
+
+
+def run():
+    with open(args.fleetPath) as f:
+        fleetDef = json.load(f)
+
+    # one s3 client and local file cache for the process, set up from the fleet's state
+    fleetState = dict(state, **fleetDef.get('state', {}))
+    S3Stream.configureFromState(fleetState)
+    LocalCache.configure(fleetState.get('local_cache_max_bytes'))
+    fleet = Fleet()
+    for v in expandVehicles(fleetDef):
+        thingName = v['thingName']
+        try:
+            vstate = makeVehicleState(state, fleetDef, v)
+            deltas = ObservableDeepArray()
+            connection = GreengrassAwareConnection(args.host, args.rootCAPath,
+                                                    v.get('cert', args.certificatePath),
+                                                    v.get('key', args.privateKeyPath),
+                                                    thingName, deltas, vstate)
+            fleet.addVehicle(Vehicle(thingName, connection, vstate, deltas), v.get('time_offset', 0.0))
+        except Exception as e:
+            logger.error(f'{thingName} - {str(type(e))} Error')
+
+    Metrics.startFromConfig(state, logger)
+    logger.info(f"starting fleet of {len(fleet.vehicles)} vehicles")
+    fleet.run()
+    logger.info(f"fleet done - {fleet.messageCount()} messages")
+
+if __name__ == "__main__":
+    run()
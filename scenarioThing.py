@@ -0,0 +1,322 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# scenarioThing
+#
+#   Runs a load test scenario -- a fleet, driven through timed phases with faults
+# injected along the way -- and reports for each phase the messages per second, CPU,
+# RSS and the seconds from a row being due to its PUBACK. See samples/scenario.json
+# for the format of the scenario file.
+#
+#   The target is the in-process broker ('local', the default) or AWS IoT ('aws', which
+# needs the endpoint and certificates).
+#
+
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+
+from Fleet import Fleet, Vehicle, expandVehicles, makeVehicleState
+from GreengrassAwareConnection import GreengrassAwareConnection
+from LatencyHistogram import LatencyHistogram
+import LocalTransport
+from Observer import ObservableDeepArray
+import LocalCache
+import S3Stream
+
+#  defaults for every vehicle
+from Config import state
+
+# Configure logging
+logger = logging.getLogger("TelemetryThing.scenario")
+logger.setLevel(logging.INFO)
+streamHandler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+streamHandler.setFormatter(formatter)
+logger.addHandler(streamHandler)
+
+
+# the broker a scenario runs against, and the faults it can inject
+#   vehicles are the ones the fault applies to
+class LocalTarget():
+    def __init__(self, config) -> None:
+        self.broker = LocalTransport.getBroker(config)
+
+    def disconnect(self, vehicles):
+        for v in vehicles:
+            self.broker.disconnect(v.thingName)
+            self.broker.disconnect(v.thingName + "-shadow")
+
+    def reconnect(self, vehicles):
+        for v in vehicles:
+            self.broker.reconnect(v.thingName)
+            self.broker.reconnect(v.thingName + "-shadow")
+
+    def queueFull(self, full):
+        self.broker.setQueueFull(full)
+
+    def failPublishes(self, count):
+        self.broker.failNextPublishes(count)
+
+    def pubAckLatency(self, latency, jitter):
+        self.broker.setPubAckLatency(latency, jitter)
+
+# the network can't be cut from here, so a disconnect is a clean one
+class IoTTarget():
+    def __init__(self, config) -> None:
+        pass
+
+    def disconnect(self, vehicles):
+        for v in vehicles:
+            v.connection.disconnect()
+
+    def reconnect(self, vehicles):
+        for v in vehicles:
+            try:
+                v.connection.connect()
+                v.connection.connectShadow()
+            except Exception as e:
+                logger.error(f"{v.thingName} - reconnect failed: {type(e)}")
+
+    def queueFull(self, full):
+        logger.warning("queue_full can't be injected into AWS IoT, ignored")
+
+    def failPublishes(self, count):
+        logger.warning("fail_publishes can't be injected into AWS IoT, ignored")
+
+    def pubAckLatency(self, latency, jitter):
+        logger.warning("puback_latency can't be injected into AWS IoT, ignored")
+
+TARGETS = { 'local': LocalTarget, 'aws': IoTTarget }
+
+
+# current resident set size, in MB
+def getRSS():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/(1024*1024)
+    except (OSError, ValueError) as e:
+        # the peak, where /proc isn't there -- KB on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak/(1024*1024) if sys.platform == 'darwin' else peak/1024
+
+
+class Scenario():
+    def __init__(self, scenario, target, host, rootCA, cert, key) -> None:
+        self.scenario = scenario
+        self.target = target
+        self.fleet = Fleet()
+
+        # a thousand connections would log a thousand connects
+        logging.disable(logging.INFO)
+        try:
+            for v in expandVehicles(scenario):
+                thingName = v['thingName']
+                try:
+                    vstate = makeVehicleState(state, scenario, v)
+                    deltas = ObservableDeepArray()
+                    connection = GreengrassAwareConnection(host, rootCA, v.get('cert', cert), v.get('key', key),
+                                                            thingName, deltas, vstate)
+                    self.fleet.addVehicle(Vehicle(thingName, connection, vstate, deltas), v.get('time_offset', 0.0))
+                except Exception as e:
+                    logger.error(f'{thingName} - {str(type(e))} Error')
+        finally:
+            logging.disable(logging.NOTSET)
+
+    # the first fraction (or count) of the vehicles
+    def _select(self, fault):
+        vehicles = self.fleet.vehicles
+        if 'count' in fault:
+            return vehicles[:fault['count']]
+        return vehicles[:round(len(vehicles)*fault.get('fraction', 1.0))]
+
+    def _inject(self, fault):
+        kind = fault['fault']
+        logger.info(f"injecting {kind}")
+        if kind == 'disconnect':
+            self.target.disconnect(self._select(fault))
+        elif kind == 'reconnect':
+            self.target.reconnect(self._select(fault))
+        elif kind == 'queue_full':
+            self.target.queueFull(True)
+        elif kind == 'queue_ok':
+            self.target.queueFull(False)
+        elif kind == 'fail_publishes':
+            self.target.failPublishes(fault.get('count', 1))
+        elif kind == 'puback_latency':
+            self.target.pubAckLatency(fault.get('latency', 0.005), fault.get('jitter', 0.0))
+        else:
+            logger.error(f"unknown fault {kind}, ignored")
+
+    # what undoes a fault given a 'duration'
+    def _revert(self, fault):
+        undo = { 'disconnect': 'reconnect', 'queue_full': 'queue_ok' }.get(fault['fault'])
+        if undo is None:
+            logger.warning(f"{fault['fault']} has no duration, ignored")
+            return None
+        return dict(fault, fault=undo)
+
+    def _totals(self):
+        totals = { 'messages': 0, 'acked': 0, 'rows': 0, 'lag_total': 0.0 }
+        for v in self.fleet.vehicles:
+            totals['messages'] += v.message_count
+            totals['acked'] += v.connection.inflight_stats['acked']
+            totals['rows'] += v.replay.stats['rows']
+            totals['lag_total'] += v.replay.stats['lag_total']
+        return totals
+
+    def runPhase(self, phase):
+        name = phase.get('name', 'phase')
+        duration = phase['duration']
+        events = []
+        for fault in phase.get('faults', []):
+            events.append((fault.get('at', 0.0), fault))
+            if fault.get('duration') is not None:
+                revert = self._revert(fault)
+                if revert is not None:
+                    events.append((fault.get('at', 0.0) + fault['duration'], revert))
+        events.sort(key=lambda e: e[0])
+
+        # every message acked in the phase is counted in it
+        enqueue_latency = LatencyHistogram()
+        for v in self.fleet.vehicles:
+            v.enqueue_latency = enqueue_latency
+            v.connection.ack_latency.reset()
+
+        logger.info(f"phase {name} - {duration} sec")
+        before = self._totals()
+        cpu = time.process_time()
+        start = time.monotonic()
+        rss_max = getRSS()
+        while True:
+            elapsed = time.monotonic() - start
+            while events and events[0][0] <= elapsed:
+                self._inject(events.pop(0)[1])
+            if elapsed >= duration:
+                break
+            time.sleep(min(1.0, duration - elapsed, events[0][0] - elapsed if events else 1.0))
+            rss_max = max(rss_max, getRSS())
+
+        wall = time.monotonic() - start
+        cpu = time.process_time() - cpu
+        after = self._totals()
+        rows = after['rows'] - before['rows']
+        result = {
+            'name': name,
+            'seconds': wall,
+            'messages': after['messages'] - before['messages'],
+            'messages_per_second': (after['messages'] - before['messages'])/wall,
+            'acked': after['acked'] - before['acked'],
+            'cpu_percent': 100.0*cpu/wall,
+            'rss_mb': getRSS(),
+            'rss_max_mb': rss_max,
+            'lag_mean': (after['lag_total'] - before['lag_total'])/rows if rows else 0.0,
+            'enqueue_to_ack': enqueue_latency.getStats(),
+            'ack_latency': LatencyHistogram.merged([ v.connection.ack_latency for v in self.fleet.vehicles ]).getStats(),
+        }
+        if phase.get('slo', True):
+            result['slo_failures'] = checkSLO(self.scenario.get('slo', {}), result)
+        return result
+
+    def run(self):
+        runner = threading.Thread(target=self.fleet.run, name="fleet", daemon=True)
+        logger.info(f"starting {self.scenario.get('name', 'scenario')} -- {len(self.fleet.vehicles)} vehicles")
+        runner.start()
+        try:
+            results = [ self.runPhase(p) for p in self.scenario.get('phases', []) ]
+        finally:
+            self.fleet.stop()
+        return results
+
+
+# the SLO limits a phase's result breaks
+#   enqueue_to_ack_p50/p95/p99/max and ack_latency_* are upper limits in seconds,
+# min_messages_per_second a lower limit and max_cpu_percent, max_rss_mb upper limits
+def checkSLO(slo, result):
+    failures = []
+    for k, limit in slo.items():
+        if k == 'min_messages_per_second':
+            value, ok = result['messages_per_second'], result['messages_per_second'] >= limit
+        elif k in ('max_cpu_percent', 'max_rss_mb'):
+            value = result['cpu_percent'] if k == 'max_cpu_percent' else result['rss_max_mb']
+            ok = value <= limit
+        else:
+            latency, _, stat = k.rpartition('_')
+            stats = result.get(latency)
+            if not isinstance(stats, dict) or stat not in stats:
+                logger.warning(f"unknown slo {k}, ignored")
+                continue
+            value = stats[stat]
+            ok = value is not None and value <= limit
+        if not ok:
+            failures.append({ 'slo': k, 'limit': limit, 'value': value })
+    return failures
+
+def formatLatency(stats):
+    if not stats['count']:
+        return "-"
+    return f"p50 {stats['p50']*1000:.1f} p95 {stats['p95']*1000:.1f} p99 {stats['p99']*1000:.1f} ms"
+
+def logResult(r):
+    logger.info(f"{r['name']}: {r['messages_per_second']:.0f} msg/s, cpu {r['cpu_percent']:.0f}%, rss {r['rss_max_mb']:.0f} MB, "
+                f"lag {r['lag_mean']*1000:.1f} ms, enqueue to ack {formatLatency(r['enqueue_to_ack'])}")
+    for f in r.get('slo_failures', []):
+        logger.warning(f"{r['name']}: {f['slo']} {f['value']} is over the limit of {f['limit']}")
+
+
+def run():
+    # Read in command-line parameters
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--scenario", action="store", required=True, dest="scenarioPath", help="Scenario file")
+    parser.add_argument("-t", "--target", action="store", dest="target", choices=list(TARGETS.keys()), help="Broker to run against, overrides the scenario's")
+    parser.add_argument("-e", "--endpoint", action="store", dest="host", default="localhost", help="Your AWS IoT custom endpoint, for the aws target")
+    parser.add_argument("-r", "--rootCA", action="store", dest="rootCAPath", help="Root CA file path")
+    parser.add_argument("-c", "--cert", action="store", dest="certificatePath", help="Default certificate file path")
+    parser.add_argument("-k", "--key", action="store", dest="privateKeyPath", help="Default private key file path")
+    parser.add_argument("-o", "--output", action="store", dest="output", help="Write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    with open(args.scenarioPath) as f:
+        scenario = json.load(f)
+
+    targetName = args.target or scenario.get('target', 'local')
+    state['TRANSPORT'] = targetName
+    scenarioState = dict(state, **scenario.get('state', {}))
+    target = TARGETS[targetName](scenarioState)
+    S3Stream.configureFromState(scenarioState)
+    LocalCache.configure(scenarioState.get('local_cache_max_bytes'))
+
+    phases = Scenario(scenario, target, args.host, args.rootCAPath, args.certificatePath, args.privateKeyPath).run()
+    [ logResult(r) for r in phases ]
+
+    # the connection prints publish errors, so the report only goes to stdout without a file
+    report = { 'scenario': scenario.get('name', args.scenarioPath), 'target': targetName, 'phases': phases }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if any(r.get('slo_failures') for r in phases):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    run()
@@ -16,20 +16,36 @@
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+from AsyncPipeline import AsyncPipeline
+from BatchPublisher import BatchPublisher, IOT_MAX_MESSAGE_BYTES
 from collections.abc import Iterable
+import ColumnTypes
 from datetime import datetime
+from dict_recursive_update import recursive_update
 from FileReader import FileReader
 from GreengrassAwareConnection import *
 import MessagePayload
+import Metrics
 from Observer import *
-import TopicGenerator
+import PayloadEncoding
+from PivotReader import PivotReader
+import LocalCache
+from Playlist import Playlist, Prefetcher
+from Profiler import Profiler
+from ReplayScheduler import ReplayScheduler
+from RuntimeConfig import RuntimeConfig
+import S3Stream
+from ShadowReporter import ShadowReporter
 
 import argparse
+import asyncio
+import copy
 from datetime import datetime
 import json
 import logging
 import time
 import sys
+import threading
 
 #  singleton config/state/globals
 from Config import state
@@ -50,6 +66,7 @@ parser.add_argument("-r", "--rootCA", action="store", required=True, dest="rootC
 parser.add_argument("-c", "--cert", action="store", dest="certificatePath", help="Certificate file path")
 parser.add_argument("-k", "--key", action="store", dest="privateKeyPath", help="Private key file path")
 parser.add_argument("-n", "--thingName", action="store", dest="thingName", default="Bot", help="Targeted thing name")
+parser.add_argument("-t", "--transport", action="store", dest="transport", choices=["aws", "local"], help="'local' to publish to an in-process broker instead of AWS IoT")
 
 args = parser.parse_args()
 host = args.host
@@ -57,6 +74,8 @@ rootCA = args.rootCAPath
 cert = args.certificatePath
 key = args.privateKeyPath
 thingName = args.thingName
+if args.transport is not None:
+    state['TRANSPORT'] = args.transport
 
 
 # State variables
@@ -68,91 +87,237 @@ def_state = {
 }
 for k in set(def_state.keys()) - set(state.keys()):
     state[k] = def_state[k]
-state_dirty = True
-
-
-tripSrc = FileReader(local_dir=state.get('local_dir', "."), record_separator=state.get('record_separator', ','), quote_records=state.get('quote_records', False))
 
+# the compiled config snapshot the replay runs from, swapped whole when a delta arrives
+#   the replay applies a new one at its next row
+config = RuntimeConfig(state, thingName)
+applied = None
+state_lock = threading.Lock()
+
+
+# profiles requested through the shadow, the summary is reported beside the state
+profiler = Profiler(thingName, state.get('profile_dir', "/tmp"), lambda result: shadowReporter.setExtra('profile_result', result))
+
+S3Stream.configureFromState(state)
+LocalCache.configure(state.get('local_cache_max_bytes'))
+def makeReader(fileURI=None):
+    return FileReader(fileURI, local_dir=state.get('local_dir', "."), record_separator=state.get('record_separator', ','), quote_records=state.get('quote_records', False),
+                        use_cache=state.get('trip_cache', True), use_mmap=state.get('mmap_reader', False),
+                        stream_s3=state.get('s3_streaming', False))
+tripSrc = PivotReader(makeReader())
+
+# with a playlist, the trip playing and the next ones opened in the background
+playlist = None
+prefetcher = Prefetcher(makeReader, lambda reader: reader.close())
+def usePlaylist(cfg):
+    global playlist
+    if cfg.playlist is None:
+        playlist = None
+        prefetcher.want([])
+        return cfg.file
+    # a delta changing anything else carries on from the trip playing
+    if playlist is None or not playlist.isSame(cfg.playlist, cfg.playlist_order):
+        playlist = Playlist(cfg.playlist, cfg.playlist_order)
+    prefetcher.want(playlist.upcoming(cfg.playlist_prefetch))
+    return playlist.current
+
+# on to the next trip, opened already if the prefetcher got to it
+def nextTrip(cfg):
+    uri = playlist.advance()
+    logger.info(f"next trip {uri}")
+    reader = prefetcher.take(uri)
+    if reader is not None and reader.isOpen():
+        tripSrc.useReader(reader)
+    elif uri == tripSrc.getFileURI():
+        # the trip that just ended, closed at its end
+        tripSrc.reopen()
+    else:
+        tripSrc.useFileURI(uri)
+    prefetcher.want(playlist.upcoming(cfg.playlist_prefetch))
+    # the columns may differ from the last trip
+    useTimestamps(cfg)
+    usePayloadFormatter(cfg)
+    replay.reset()
+
+# called on the shadow client's thread, a delta that doesn't make a valid config is ignored
 class DeltaProcessor(Observer):
     def update(self, updateList):
-        global state_dirty
+        global config
 
-        [ state.update(u) for u in updateList ]
-        state_dirty = True
+        with state_lock:
+            # a delta only holds the nested keys that changed, merge it into a copy
+            candidate = copy.deepcopy(state)
+            [ recursive_update(candidate, u) for u in updateList ]
+            try:
+                snapshot = RuntimeConfig(candidate, thingName)
+            except Exception as e:
+                logger.error(f"ignoring shadow delta {updateList}: {e}")
+                return
+            state.update(candidate)
+            config = snapshot
 
 try:
+    # observe deltas before connecting, the first may come as soon as the shadow is subscribed
     deltas = ObservableDeepArray()
-    iotConnection = GreengrassAwareConnection(host, rootCA, cert, key, thingName, deltas, state)
-
-    time.sleep(10)
-
     deltaProcessor = DeltaProcessor()
     deltas.addObserver(deltaProcessor)
+
+    # connected and subscribed when it returns, no need to wait
+    iotConnection = GreengrassAwareConnection(host, rootCA, cert, key, thingName, deltas, state)
+    shadowReporter = ShadowReporter(iotConnection, state.get('shadow_debounce', 1.0))
+
+    Metrics.startFromConfig(state, logger)
 except Exception as e:
     logger.error(f'{str(type(e))} Error')
 
 
-def getTopicGenerator():
-    topic_strategy = getattr(TopicGenerator, state.get('topic_strategy', 'SimpleFormattedTopic'))
-    return topic_strategy(state.get('topic_name', 'dt/cvra/{deviceid}/cardata'))
+# payload strategy compiled for the current header, rebuilt when the file or config changes
+#   the encoder is kept while the encoding and its settings are unchanged, delta frames carry on across changes
+payloadFormatter = None
+payloadEncoder = None
+payloadEncoding = None
+def usePayloadFormatter(cfg):
+    global payloadFormatter, payloadEncoder, payloadEncoding
+    encoding = (cfg.payload_encoding, cfg.get('delta_keyframe_interval', PayloadEncoding.DEFAULT_KEYFRAME_INTERVAL))
+    if payloadEncoder is None or encoding != payloadEncoding:
+        payloadEncoder = PayloadEncoding.makeFormatter(encoding[0], keyframe_interval=encoding[1])
+        payloadEncoding = encoding
+
+    payload_config = dict(cfg.payload_config)
+    if cfg.infer_types:
+        payload_config['column_types'] = ColumnTypes.inferColumnTypes(tripSrc.cols, tripSrc.sampleRows(ColumnTypes.SCHEMA_SAMPLE_ROWS))
+    payloadFormatter = MessagePayload.compilePayload(cfg.payload_strategy, tripSrc.cols, payload_config, payloadEncoder)
 
 def makePayload(telemetry):
-    payload_strategy = getattr(MessagePayload, state.get('payload_strategy', 'SimpleLabelledPayload'))
-    return payload_strategy(telemetry, {
-        'preDropKeys':state.get('ignore_columns',[]),
-        'metricKey': state.get('measure_column'),
-        'readingKey': state.get('value_column'),
-        'time_col_name': state.get('time_col_name')
-    }).message(json.dumps)
+    return payloadFormatter(telemetry)
+
+# timestamps of the whole trip, converted in one pass when the file or time settings change
+#   or as each row is replayed for a mapped trip, see TImestampReader
+timestampReader = None
+time_col_name = None
+timestamps = None
+def useTimestamps(cfg):
+    global timestampReader, time_col_name, timestamps
+    timestampReader = cfg.timestampReader
+    time_col_name = cfg.time_col_name
+    timestamps = None
+
+    source = tripSrc.getIndexedSource()
+    if source is not None:
+        column = source.getColumn(time_col_name)
+        if column is not None:
+            timestamps = timestampReader.getColumnTimestampsMS(column)
 
 def getTimestampMS(telemetry):
-    time_col_name = state.get('time_col_name', 'Timestamp(ms)')
-    time_scale = float(state.get('time_scale', 1000.0))
-    timestamp = telemetry.get(time_col_name, DEFAULT_SAMPLE_DURATION_MS)
-    time_format = state.get('timestamp_format')
-    timestamp_offset = state.get('timestamp_offset', 0.0)
-    # convert to milliseconds
-    if time_format == None:
-        timestamp_ms = (float(timestamp) + timestamp_offset)/time_scale*1000
-    else:
-        timestamp_ms = datetime.strptime(timestamp, time_format).timestamp()*1000
-    
-    return int(timestamp_ms)
+    row = tripSrc.getSampleIndex()
+    if timestamps is not None and row is not None and row < len(timestamps):
+        return timestamps[row]
+
+    return timestampReader.getTimestampMS(telemetry.get(time_col_name, DEFAULT_SAMPLE_DURATION_MS))
+
+
+# with batch_publish, records are packed into array messages instead of one publish each
+batcher = None
+def useBatching(cfg):
+    global batcher
+    if not cfg.batch_publish:
+        if batcher is not None:
+            batcher.flush()
+            batcher = None
+        return
+
+    if batcher is None:
+        batcher = BatchPublisher(iotConnection)
+    batcher.configure(max_records=cfg.get('batch_max_records', 50),
+                        max_bytes=cfg.get('batch_max_bytes', IOT_MAX_MESSAGE_BYTES),
+                        max_latency=cfg.get('batch_max_latency', 1.0),
+                        topic_from=cfg.get('batch_topic_from', 'first'),
+                        encoding=cfg.payload_encoding)
+
+def publish(payload, topic, cfg, timestamp_ms):
+    if batcher is not None:
+        return batcher.add(payload, cfg.topicGenerator, cfg.getTopicArgs(timestamp_ms))
+    return iotConnection.publishMessageOnTopic(payload, topic, qos=1)
+
+
+# paces the rows on the recorded timeline, or at message_publish_rate, sped up by time_warp
+replay = ReplayScheduler()
+Metrics.gauge('telemetry_scheduler_lag_seconds', 'how late the last row was sent', lambda: replay.stats['lag_last'])
+Metrics.gauge('telemetry_batch_pending', 'records waiting in batches', lambda: batcher.pending() if batcher is not None else None)
+publish_blocked = Metrics.counter('telemetry_publish_blocked_total', 'publishes retried after a backoff')
+def useScheduler(cfg):
+    replay.configure(cfg.time_warp, cfg.rate, cfg.max_lag)
 
 
 DEFAULT_SAMPLE_DURATION_MS = 1000
 message_count = 0
-def do_something():
-    # send current state to shadow
-    global state_dirty, message_count
-    if state_dirty:
-        tripSrc.useFileURI(state['file'])
+# the current config snapshot, applied and reported to the shadow when it's new
+def useConfig():
+    global applied
+    cfg = config
+    if cfg is not applied:
+        tripSrc.configure(cfg.get('pivot', False), cfg.time_col_name,
+                            cfg.get('measure_column'), cfg.get('value_column'), cfg.get('pivot_tolerance', 0.0))
+        tripSrc.useFileURI(usePlaylist(cfg))
+        useTimestamps(cfg)
+        usePayloadFormatter(cfg)
+        useBatching(cfg)
+        useScheduler(cfg)
+        profiler.configure(cfg.profile)
+
+        shadowReporter.report(dict(cfg.state))
+        applied = cfg
+    return cfg
 
-        iotConnection.updateShadow(state)
-        state_dirty = False
+def do_something():
+    global message_count
+    cfg = useConfig()
+    # only while a stages profile runs
+    stages = profiler.stages
+    if stages is not None:
+        stages.begin()
 
     # assemble telemetry
     telemetry = tripSrc.getSample()
     # print(json.dumps(telemetry) + "\n")
+    if stages is not None:
+        stages.lap('read')
 
     if len(telemetry) == 0:
-        if state.get('at_end') == 'stop':
+        if cfg.at_end == 'stop':
             logger.info("end of file reached")
+            if batcher is not None:
+                batcher.flush()
             time.sleep(600) # wait 10 min for queued messages to clear
             sys.exit()
+        if cfg.at_end == 'next':
+            nextTrip(cfg)
+            return 0
+        replay.reset()
         return 30       # wait 30 seconds between runs
 
-    deviceid = state.get('deviceid', thingName)
     timestamp_ms = getTimestampMS(telemetry)
+    if stages is not None:
+        stages.lap('timestamp')
 
     payload = makePayload(telemetry)
-    topic = getTopicGenerator().make_topicname(deviceid=deviceid, timestamp_ms=timestamp_ms)
+    if stages is not None:
+        stages.lap('format')
+    topic = cfg.makeTopic(timestamp_ms)
+    if stages is not None:
+        stages.lap('topic')
+
+    # hold the message until it is due
+    replay.wait(timestamp_ms/1000.0)
+    if stages is not None:
+        stages.lap('wait')
 
     message_count += 1
     logger.info(f"{message_count} - {topic}:{payload}")
 
     sleep = [0, 1]
-    while not iotConnection.publishMessageOnTopic(payload, topic, qos=1):
+    while not publish(payload, topic, cfg, timestamp_ms):
+        publish_blocked.inc()
         logger.info("waiting to clear block")
         # fibonacci backoff on wait
         sleep.append(sum(sleep))
@@ -169,24 +334,54 @@ def do_something():
 
             sleep = [0, 1]
         time.sleep(timeout/10.0)
+    if stages is not None:
+        stages.lap('publish')
 
-    # return the timestamp of the leg
-    return timestamp_ms/1000.0
+    # the scheduler paces the next row
+    return 0
 
-timeout = 5
-def run():
-    rate = state.get('message_publish_rate')
+# the asyncio pipeline's stages
+#   a row carries the formatter and topic of when it was read, a config change may
+# replace them while it waits in a queue
+def readRow():
+    cfg = useConfig()
+    telemetry = tripSrc.getSample()
+    if len(telemetry) == 0:
+        if cfg.at_end == 'stop':
+            logger.info("end of file reached")
+            return None
+        if cfg.at_end == 'next':
+            nextTrip(cfg)
+            return 0
+        replay.reset()
+        return 30       # wait 30 seconds between runs
 
-    last_time = do_something()
-    sleep_time = 0.05 if rate == None else 1.0/rate
-    while True:
-        time.sleep(sleep_time if sleep_time > 0 else timeout)
+    timestamp_ms = getTimestampMS(telemetry)
+    return (timestamp_ms, (telemetry, payloadFormatter, cfg, timestamp_ms))
+
+def formatRow(row):
+    telemetry, formatter, cfg, timestamp_ms = row
+    return formatter(telemetry), cfg.makeTopic(timestamp_ms)
+
+def runPipeline():
+    if state.get('batch_publish', False):
+        logger.warning("batch_publish is not used by the async pipeline")
+    pipeline = AsyncPipeline(iotConnection, readRow, formatRow, replay,
+                                window=state.get('publish_window', 32),
+                                queue_depth=state.get('pipeline_queue_depth', 256),
+                                ack_timeout=state.get('ack_timeout', 30.0))
+    asyncio.run(pipeline.run())
+    logger.info(f"pipeline finished: {pipeline.getStats()}")
 
-        cur_time = do_something()
+def run():
+    if state.get('async_pipeline', False):
+        runPipeline()
+        sys.exit()
 
-        if rate == None:
-            sleep_time = cur_time - last_time if timeout >= last_time else 0
-            last_time = cur_time
+    while True:
+        sleep_time = do_something()
+        if sleep_time > 0:
+            time.sleep(sleep_time)
 
 if __name__ == "__main__":
     run()
@@ -0,0 +1,90 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import gc
+import os
+import tempfile
+import unittest
+
+from MappedTrip import MappedTrip
+
+
+class TestMappedTrip(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "trip.csv")
+        with open(self.path, 'w') as f:
+            f.write("time,speed,name\n")
+            for i in range(10):
+                f.write(f"{i*100},{i*1.5},car{i}\n")
+
+    def tearDown(self):
+        for trip in list(MappedTrip._trips.values()):
+            if trip.path == self.path:
+                while trip.refs > 0:
+                    trip.release()
+        self.dir.cleanup()
+
+    def test_shared_between_holders(self):
+        first = MappedTrip.get(self.path)
+        second = MappedTrip.get(self.path)
+        self.assertIs(first, second)
+        self.assertEqual(first.refs, 2)
+        self.assertIn(first.key, MappedTrip._trips)
+
+        first.release()
+        self.assertFalse(first.isClosed())
+        self.assertIs(MappedTrip.get(self.path), first)
+        first.release()
+
+    def test_closed_by_last_release(self):
+        first = MappedTrip.get(self.path)
+        second = MappedTrip.get(self.path)
+        first.release()
+        self.assertFalse(second.isClosed())
+        second.release()
+        self.assertTrue(second.isClosed())
+        self.assertNotIn(second.key, MappedTrip._trips)
+
+        # the next reader maps the file again
+        third = MappedTrip.get(self.path)
+        self.assertIsNot(third, second)
+        self.assertFalse(third.isClosed())
+        third.release()
+
+    def test_sample_outlives_the_mapping(self):
+        trip = MappedTrip.get(self.path)
+        sample = trip.getSample(3)
+        trip.release()
+        gc.collect()
+        self.assertTrue(trip.isClosed())
+        self.assertEqual(dict(sample), {'time': '300', 'speed': '4.5', 'name': 'car3'})
+
+    def test_time_column_is_lazy(self):
+        trip = MappedTrip.get(self.path)
+        column = trip.getColumn('time')
+        self.assertTrue(column.lazy)
+        self.assertEqual(len(column), 10)
+        self.assertEqual(column[9], '900')
+        self.assertEqual(list(column)[:3], ['0', '100', '200'])
+        with self.assertRaises(IndexError):
+            column[10]
+        self.assertIsNone(trip.getColumn('missing'))
+        trip.release()
+
+
+if __name__ == '__main__':
+    unittest.main()
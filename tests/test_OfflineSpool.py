@@ -0,0 +1,84 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import tempfile
+import unittest
+
+from OfflineSpool import OfflineSpool
+
+
+class TestOfflineSpool(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.spool = OfflineSpool(self.dir.name)
+
+    def tearDown(self):
+        self.spool.close()
+        self.dir.cleanup()
+
+    def _sendAll(self):
+        sent = []
+        while True:
+            record = self.spool.next()
+            if record is None:
+                return sent
+            sent.append(record)
+
+    def test_in_order(self):
+        for i in range(3):
+            self.spool.append('t', f"m{i}")
+        sent = self._sendAll()
+        self.assertEqual([ r[2] for r in sent ], ['m0', 'm1', 'm2'])
+        for r in sent:
+            self.spool.ack(r[0])
+        self.assertEqual(self.spool.pending(), 0)
+        self.assertEqual(self.spool.unackedCount(), 0)
+
+    def test_rewind_sends_unacked_again(self):
+        for i in range(3):
+            self.spool.append('t', f"m{i}")
+        sent = self._sendAll()
+        self.spool.ack(sent[0][0])
+        self.spool.rewind()
+        self.assertEqual(self.spool.pending(), 2)
+        self.assertEqual([ r[2] for r in self._sendAll() ], ['m1', 'm2'])
+
+    def test_rewind_after_out_of_order_ack(self):
+        for i in range(3):
+            self.spool.append('t', f"m{i}")
+        sent = self._sendAll()
+        self.spool.ack(sent[1][0])
+        self.spool.rewind()
+        self.assertEqual(self.spool.pending(), 2)
+        again = self._sendAll()
+        self.assertEqual([ r[2] for r in again ], ['m0', 'm2'])
+        for r in again:
+            self.spool.ack(r[0])
+        self.assertEqual(self.spool.pending(), 0)
+        self.assertEqual(self.spool.unackedCount(), 0)
+
+    def test_resumes_from_ack_cursor(self):
+        for i in range(3):
+            self.spool.append('t', f"m{i}")
+        sent = self._sendAll()
+        self.spool.ack(sent[0][0])
+        self.spool.close()
+        self.spool = OfflineSpool(self.dir.name)
+        self.assertEqual([ r[2] for r in self._sendAll() ], ['m1', 'm2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
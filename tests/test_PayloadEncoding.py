@@ -0,0 +1,80 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import unittest
+
+import PayloadEncoding
+from PayloadEncoding import DeltaFrameDecoder, DeltaFrameEncoder, unpackMsgpack
+
+
+def payloads(n, start=0):
+    return [{'time': 1000 + 100*i, 'speed': 10.5 + i*0.25, 'gear': i % 5, 'state': 'run' if i % 7 else 'idle'}
+            for i in range(start, start + n)]
+
+def isKeyframe(frame):
+    return bool(unpackMsgpack(frame)[1] & DeltaFrameEncoder.KEYFRAME)
+
+
+class TestDeltaFrames(unittest.TestCase):
+    def test_round_trip(self):
+        encoder = DeltaFrameEncoder(keyframe_interval=4)
+        decoder = DeltaFrameDecoder()
+        frames = [encoder(p) for p in payloads(10)]
+        self.assertEqual([isKeyframe(f) for f in frames], [i % 4 == 0 for i in range(10)])
+        self.assertEqual([decoder.decode(f) for f in frames], payloads(10))
+
+    def test_interval_change_on_the_encoder(self):
+        encoder = DeltaFrameEncoder(keyframe_interval=3)
+        decoder = DeltaFrameDecoder()
+        frames = [encoder(p) for p in payloads(5)]
+        encoder.keyframe_interval = 2
+        frames += [encoder(p) for p in payloads(5, 5)]
+        # 3 frames since the keyframe at 3 means the next one is due at once
+        self.assertEqual([i for i, f in enumerate(frames) if isKeyframe(f)], [0, 3, 5, 7, 9])
+        self.assertEqual([decoder.decode(f) for f in frames], payloads(10))
+
+    def test_interval_change_rebuilds_the_encoder(self):
+        # the replay makes a new encoder when delta_keyframe_interval changes, the
+        # decoder must follow its sequence back to 0
+        decoder = DeltaFrameDecoder()
+        first = PayloadEncoding.makeFormatter('delta', keyframe_interval=5)
+        frames = [first(p) for p in payloads(7)]
+        second = PayloadEncoding.makeFormatter('delta', keyframe_interval=2)
+        frames += [second(p) for p in payloads(5, 7)]
+        self.assertTrue(isKeyframe(frames[7]))
+        self.assertEqual(unpackMsgpack(frames[7])[2], 0)
+        self.assertEqual([decoder.decode(f) for f in frames], payloads(12))
+
+    def test_lost_frame_resumes_at_keyframe(self):
+        encoder = DeltaFrameEncoder(keyframe_interval=4)
+        decoder = DeltaFrameDecoder()
+        frames = [encoder(p) for p in payloads(9)]
+        del frames[2]
+        decoded = [decoder.decode(f) for f in frames]
+        expected = payloads(9)
+        self.assertEqual(decoded[:2], expected[:2])
+        self.assertEqual(decoded[2:3], [None])
+        self.assertEqual(decoded[3:], expected[4:])
+
+    def test_type_change_is_absolute(self):
+        encoder = DeltaFrameEncoder(keyframe_interval=10)
+        decoder = DeltaFrameDecoder()
+        sent = [{'v': 1}, {'v': 2.5}, {'v': 'n/a'}, {'v': 0.1}, {'v': 0.30000000000000004}]
+        self.assertEqual([decoder.decode(encoder(p)) for p in sent], sent)
+
+
+if __name__ == '__main__':
+    unittest.main()
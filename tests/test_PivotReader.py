@@ -0,0 +1,92 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import unittest
+
+from PivotReader import PivotReader
+
+
+# a FileReader over a list of rows
+class ListReader():
+    def __init__(self, rows):
+        self.rows = rows
+        self.row = 0
+
+    def getSample(self):
+        if self.row >= len(self.rows):
+            return {}
+        self.row += 1
+        return dict(self.rows[self.row - 1])
+
+    def getSampleIndex(self):
+        return self.row - 1 if self.row else None
+
+    def getFileURI(self):
+        return "list"
+
+def longFormat(times):
+    return [ {'timestamp': t, 'status': f"m{i}", 'value': str(i)} for i, t in enumerate(times) ]
+
+def readAll(pivot):
+    samples = []
+    while True:
+        sample = pivot.getSample()
+        if len(sample) == 0:
+            return samples
+        samples.append((pivot.getSampleIndex(), sample))
+
+
+class TestPivotReader(unittest.TestCase):
+    def checkAgainstInput(self, rows, samples):
+        # every long-format row appears once, in order, in the group of its first row's time
+        metrics = [ m for _, s in samples for m in s['status'] ]
+        readings = [ v for _, s in samples for v in s['value'] ]
+        self.assertEqual(metrics, [ r['status'] for r in rows ])
+        self.assertEqual(readings, [ r['value'] for r in rows ])
+        for index, sample in samples:
+            self.assertEqual(sample['timestamp'], rows[index]['timestamp'])
+
+    def test_exact_times(self):
+        rows = longFormat(['1', '1', '1', '2', '2', '3'])
+        samples = readAll(PivotReader(ListReader(rows), enabled=True))
+        self.assertEqual([ i for i, _ in samples ], [0, 3, 5])
+        self.assertEqual(samples[0][1], {'timestamp': '1', 'status': ['m0', 'm1', 'm2'], 'value': ['0', '1', '2']})
+        self.checkAgainstInput(rows, samples)
+
+    def test_tolerance_window(self):
+        # within 0.5 of the FIRST row of the group -- 1.51 is close to 1.5 but starts a new group
+        rows = longFormat(['1.0', '1.2', '1.5', '1.51', '1.9', '2.2', '9'])
+        samples = readAll(PivotReader(ListReader(rows), enabled=True, tolerance=0.5))
+        self.assertEqual([ s['status'] for _, s in samples ], [['m0', 'm1', 'm2'], ['m3', 'm4'], ['m5'], ['m6']])
+        self.checkAgainstInput(rows, samples)
+
+    def test_trailing_partial_group(self):
+        rows = longFormat(['1', '1', '2', '2', '2', '3', '3'])
+        pivot = PivotReader(ListReader(rows), enabled=True)
+        samples = readAll(pivot)
+        self.assertEqual(samples[-1], (5, {'timestamp': '3', 'status': ['m5', 'm6'], 'value': ['5', '6']}))
+        self.checkAgainstInput(rows, samples)
+        # the end stays the end
+        self.assertEqual(pivot.getSample(), {})
+
+    def test_disabled_passes_rows_through(self):
+        rows = longFormat(['1', '1', '2'])
+        pivot = PivotReader(ListReader(rows))
+        self.assertEqual([ s for _, s in readAll(pivot) ], rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import unittest
+
+from ReplayScheduler import ReplayScheduler
+
+
+# a clock that only moves when slept on, or when work is simulated
+class FakeClock():
+    def __init__(self, now=100.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+TIMESTAMPS = [ 10.0, 10.5, 11.0, 13.0, 13.25 ]
+
+# work is the seconds each row takes after it is sent, or a list of them
+def sendTimes(time_warp, work=0.0, **settings):
+    clock = FakeClock()
+    replay = ReplayScheduler(time_warp, clock=clock, sleep=clock.sleep, **settings)
+    sent = []
+    for i, ts in enumerate(TIMESTAMPS):
+        replay.wait(ts)
+        sent.append(round(clock() - 100.0, 9))
+        clock.now += work[i] if isinstance(work, list) else work
+    return sent, replay
+
+
+class TestReplayScheduler(unittest.TestCase):
+    def test_real_time(self):
+        sent, replay = sendTimes(1)
+        self.assertEqual(sent, [ 0.0, 0.5, 1.0, 3.0, 3.25 ])
+        self.assertEqual(replay.getStats()['late'], 0)
+
+    def test_twice_as_fast(self):
+        sent, replay = sendTimes(2)
+        self.assertEqual(sent, [ 0.0, 0.25, 0.5, 1.5, 1.625 ])
+
+    def test_max(self):
+        for warp in ('max', 0):
+            sent, replay = sendTimes(warp, work=0.1)
+            # no waiting at all, only the time the work took
+            self.assertEqual(sent, [ 0.0, 0.1, 0.2, 0.3, 0.4 ])
+            self.assertEqual(replay.getStats()['lag_max'], 0.0)
+
+    def test_work_is_absorbed(self):
+        # 0.2 sec of work after each row doesn't push the later rows back
+        sent, replay = sendTimes(1, work=0.2)
+        self.assertEqual(sent, [ 0.0, 0.5, 1.0, 3.0, 3.25 ])
+
+    def test_late_rows_catch_up_then_rebase(self):
+        # the rows due at 0.25, 0.5 and 1.625 are late by less than max_lag and sent at
+        # once, 1.5 is on time again
+        sent, replay = sendTimes(2, work=0.4, max_lag=0.5)
+        self.assertEqual(sent, [ 0.0, 0.4, 0.8, 1.5, 1.9 ])
+        self.assertEqual(replay.getStats()['late'], 3)
+        self.assertEqual(replay.getStats()['rebases'], 0)
+
+        # a 2 sec stall makes the row due at 1.0 late by 1.5, the rest move back by that
+        sent, replay = sendTimes(1, work=[ 0.0, 2.0, 0.0, 0.0, 0.0 ], max_lag=0.5)
+        self.assertEqual(sent, [ 0.0, 0.5, 2.5, 4.5, 4.75 ])
+        self.assertEqual(replay.getStats()['late'], 1)
+        self.assertEqual(replay.getStats()['rebases'], 1)
+
+    def test_fixed_rate(self):
+        sent, replay = sendTimes(2, rate=4)
+        self.assertEqual(sent, [ 0.0, 0.125, 0.25, 0.375, 0.5 ])
+
+    def test_peek_and_delay_for_async(self):
+        clock = FakeClock()
+        replay = ReplayScheduler(2, clock=clock, sleep=clock.sleep)
+        self.assertEqual(replay.peek(10.0), 0.0)
+        self.assertEqual(replay.delay(10.0), 0.0)
+        self.assertEqual(replay.peek(11.0), 0.5)
+        self.assertEqual(replay.peek(11.0), 0.5)
+        clock.now += 0.5
+        self.assertEqual(replay.delay(11.0), 0.0)
+        self.assertEqual(replay.getStats()['rows'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()